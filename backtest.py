@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from monitoring.backtest import DETECTORS, Recording, load_anomalies, run_backtest
+from monitoring.collector import Collector
+from monitoring.export import export_range, load_export, parse_time
+
+# Tunes the detection parameters offline by replaying recorded series through
+# the detectors for every combination of window size, z-score threshold and
+# IsolationForest contamination, e.g.
+#
+#   python backtest.py --export dataset --anomalies incidents.json --window-sizes 10,50,100
+#
+# Series come from an export written by fetch_prometheus_data.py, or from range
+# queries when selectors are given instead. Labelled anomalies are a .npy mask
+# shaped like the export's values, or a JSON list of
+# {"match": {label: value}, "start": unix time, "end": unix time} intervals.
+# Each config reports its alerts, CPU time and speedup over real time, and
+# with labels its precision, recall and detection latency.
+PROMETHEUS_URL = "http://localhost:9090"
+OUTPUT = "backtest_results.json"
+WINDOW_SIZES = [10, 50, 100]  # health_api.py and executeScript.py use 10 and 100
+STD_DEV_THRESHOLDS = [2, 2.5, 3]
+CONTAMINATIONS = [0.01, 0.05, 0.1]
+STEP = 30  # Seconds between points fetched by range queries; the scrape_interval replays every sample
+START = "-1d"
+END = "now"
+MODEL_DRIFT_THRESHOLD = 3  # Refit when the rolling mean drifts this many fit-time std devs
+MODEL_MAX_AGE = 600  # Refit models older than this many seconds of replayed time
+REQUEST_TIMEOUT = 120  # Seconds before a range query times out
+
+
+def number_list(value, parse=float):
+    return [parse(item) for item in value.split(",") if item]
+
+
+def rounded(value, digits=3):
+    return "-" if value is None else round(value, digits)
+
+
+def load_series(args, scratch):
+    """(labels, timestamps, values) from the export directory, or from range queries exported to scratch."""
+    if args.export:
+        return load_export(args.export)
+    now = time.time()
+    collector = Collector(args.prometheus_url, timeout=REQUEST_TIMEOUT)
+    try:
+        export_range(collector, args.selectors, parse_time(args.start, now), parse_time(args.end, now),
+                     args.step, scratch)
+    finally:
+        collector.close()
+    return load_export(scratch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded series to tune the detection parameters")
+    parser.add_argument("selectors", nargs="*", help="Series selectors to fetch when --export is not given")
+    parser.add_argument("--export", help="Directory written by fetch_prometheus_data.py")
+    parser.add_argument("--prometheus-url", default=PROMETHEUS_URL)
+    parser.add_argument("--start", default=START, help="Unix time, ISO 8601 time, or an offset such as --start=-6h")
+    parser.add_argument("--end", default=END)
+    parser.add_argument("--step", type=float, default=STEP)
+    parser.add_argument("--anomalies", help="Labelled anomalies, a .npy mask or a JSON list of intervals")
+    parser.add_argument("--window-sizes", type=lambda value: number_list(value, int), default=WINDOW_SIZES)
+    parser.add_argument("--thresholds", type=number_list, default=STD_DEV_THRESHOLDS)
+    parser.add_argument("--contaminations", type=number_list, default=CONTAMINATIONS)
+    parser.add_argument("--detectors", type=lambda value: value.split(","), default=list(DETECTORS),
+                        help=f"Any of {', '.join(DETECTORS)}")
+    parser.add_argument("--retrain-every", type=int, help="Samples between model refits; the window size by default")
+    parser.add_argument("--tolerance", type=int, default=0, help="Samples after an anomaly a flag still counts for it")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes replaying IsolationForest")
+    parser.add_argument("--output", default=OUTPUT, help="JSON results file")
+    args = parser.parse_args()
+
+    if not args.export and not args.selectors:
+        parser.error("Give --export or series selectors to fetch")
+    unknown = [detector for detector in args.detectors if detector not in DETECTORS]
+    if unknown:
+        parser.error(f"Unknown detectors {unknown}, expected any of {list(DETECTORS)}")
+
+    with tempfile.TemporaryDirectory() as scratch:
+        labels, timestamps, values = load_series(args, scratch)
+        anomalies = load_anomalies(args.anomalies, labels, timestamps) if args.anomalies else None
+        recording = Recording(labels, timestamps, values, anomalies)
+    print(f"Replaying {len(recording)} samples of {len(labels)} series over {recording.span_seconds / 3600:.1f}h")
+    results = run_backtest(
+        recording, args.window_sizes, args.thresholds, args.contaminations, detectors=args.detectors,
+        tolerance=args.tolerance, workers=args.workers,
+        registry_kwargs={
+            "retrain_every": args.retrain_every,
+            "drift_threshold": MODEL_DRIFT_THRESHOLD,
+            "max_model_age": MODEL_MAX_AGE,
+        },
+    )
+
+    for result in results:
+        params = f"window {result['window_size']}"
+        if result["threshold"] is not None:
+            params += f", threshold {result['threshold']}"
+        if result["contamination"] is not None:
+            params += f", contamination {result['contamination']}"
+        line = f"{result['detector']} ({params}): {result['alerts']} alerts, {result['cpu_seconds']:.2f}s CPU"
+        if result.get("events") is not None:
+            latency = result["latency_seconds"] or {}
+            line += (f", precision {rounded(result['precision'])}, recall {rounded(result['recall'])}"
+                     f", latency p50 {rounded(latency.get('p50'), 1)}s")
+        print(line)
+    with open(args.output, "w") as f:
+        json.dump({
+            "created_at": time.time(),
+            "source": args.export or args.selectors,
+            "series": len(labels),
+            "samples": len(recording),
+            "span_seconds": recording.span_seconds,
+            "results": results,
+        }, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+
+# A fake Prometheus HTTP API serving synthetic series, for benchmarks that
+# need neither Prometheus nor real applications. Every series is a noisy sine
+# wave that advances one sample each time an instant query returns it, so
+# adaptive polling sees each series at its own pace. Spikes are injected into
+# a configurable share of those samples; GET /bench/served reports (and
+# resets) the samples served and the series whose sample was a spike, which
+# is the ground truth for precision and recall. It also answers the
+# label_replace'd avg/stddev/quantile_over_time queries of health_api's server
+# window mode (every metric is a gauge in /api/v1/metadata), computing them
+# over the samples before each series' next step.
+PORT = 9091
+METRICS = 50  # Metric names
+SERIES_PER_METRIC = 4  # Series (label sets) per metric name
+APPS = 4  # Distinct `job` label values, used as appids by /check_health
+LATENCY = 0.0  # Seconds added to every query
+ANOMALY_RATE = 0.002  # Share of served samples that are spikes
+ANOMALY_SIZE = 10  # Spike height in noise std devs
+SEED = 1
+SAMPLE_INTERVAL = 30  # Seconds between two steps of a series, for range selectors such as [3000s]
+
+STEP_OFFSET = 1 << 32  # Keeps steps positive for hashing; range queries reach before step 0
+SELECTOR_NAME_RE = re.compile(r'__name__=~"([^"]*)"')
+SELECTOR_BARE_NAME_RE = re.compile(r"^\s*([a-zA-Z_:][a-zA-Z0-9_:]*)")
+MATCHER_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+LABEL_REPLACE_RE = re.compile(r'^label_replace\((.*), "__name__", "[^"]*", "", ""\)$')
+OVER_TIME_RE = re.compile(r"^(avg|stddev|quantile)_over_time\((?:([0-9.]+), )?(.*)\[(\d+)s\]\)$")
+
+
+def _uniform(seed, index, steps, salt):
+    """Deterministic uniform values in (0, 1) per (series, step), splitmix64 hashed."""
+    x = index.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    x ^= (steps + STEP_OFFSET).astype(np.uint64) * np.uint64(0xD1B54A32D192ED03)
+    x ^= np.uint64(seed * 0x100 + salt)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return ((x >> np.uint64(11)).astype(np.float64) + 0.5) / float(1 << 53)
+
+
+class SyntheticSeries:
+    """Values of `metrics * series_per_metric` series, reproducible from the seed.
+
+    Series i is the (i % series_per_metric)-th series of metric
+    i // series_per_metric. Its value at a step only depends on the seed, i
+    and the step, so a run can be repeated sample for sample.
+    """
+
+    def __init__(self, metrics, series_per_metric, apps, anomaly_rate, anomaly_size, seed):
+        self.series_per_metric = series_per_metric
+        self.apps = apps
+        self.anomaly_rate = anomaly_rate
+        self.anomaly_size = anomaly_size
+        self.seed = seed
+        self.names = [f"bench_metric_{m}" for m in range(metrics)]
+        self._name_ids = {metric_name: m for m, metric_name in enumerate(self.names)}
+        count = metrics * series_per_metric
+        rng = np.random.default_rng(seed)
+        self.base = rng.uniform(10, 1000, count)
+        self.noise = self.base * rng.uniform(0.01, 0.05, count)
+        self.amplitude = self.noise * rng.uniform(0, 3, count)
+        self.period = rng.integers(30, 240, count)
+        self.phase = rng.uniform(0, 2 * np.pi, count)
+        self.steps = np.zeros(count, dtype=np.int64)  # Next step served per series
+        self._lock = threading.Lock()
+        self._masks = {}  # Label matchers -> series of a metric that match them
+        self.samples = 0  # Served by instant queries since the last report
+        self.injected = []  # Series whose served sample was a spike since the last report
+
+    def labels(self, i):
+        k = i % self.series_per_metric
+        return {
+            "__name__": self.names[i // self.series_per_metric],
+            "job": f"app-{k % self.apps}",
+            "instance": f"host-{k}",
+        }
+
+    def values(self, index, steps, inject):
+        """Values of series `index` at `steps`, with spikes where inject is true; also the spike mask."""
+        index = np.broadcast_to(index, steps.shape)
+        wave = self.amplitude[index] * np.sin(2 * np.pi * steps / self.period[index] + self.phase[index])
+        # Box-Muller from two hashed uniforms
+        u1 = _uniform(self.seed, index, steps, 1)
+        u2 = _uniform(self.seed, index, steps, 2)
+        noise = np.sqrt(-2 * np.log(u1)) * np.cos(2 * np.pi * u2) * self.noise[index]
+        values = self.base[index] + wave + noise
+        spikes = inject & (_uniform(self.seed, index, steps, 3) < self.anomaly_rate)
+        values = np.where(spikes, values + self.anomaly_size * self.noise[index], values)
+        return values, spikes
+
+    def select(self, query):
+        """Series matching a selector as built by monitoring.prometheus, e.g. `{__name__=~"a|b",job="x"}`."""
+        match = SELECTOR_NAME_RE.search(query)
+        if match is not None:
+            metric_names = match.group(1).split("|")
+        else:
+            match = SELECTOR_BARE_NAME_RE.match(query)
+            metric_names = [match.group(1)] if match else []
+        matchers = tuple(
+            (name, value.replace('\\"', '"').replace("\\\\", "\\"))
+            for name, value in MATCHER_RE.findall(query) if name != "__name__"
+        )
+        mask = self._masks.get(matchers)
+        if mask is None:
+            mask = np.array([
+                all(self.labels(k).get(name) == value for name, value in matchers)
+                for k in range(self.series_per_metric)
+            ])
+            self._masks[matchers] = mask
+        offsets = np.flatnonzero(mask)
+        index = [
+            self._name_ids[metric_name] * self.series_per_metric + offsets
+            for metric_name in metric_names if metric_name in self._name_ids
+        ]
+        return np.concatenate(index) if index else np.zeros(0, dtype=np.int64)
+
+    def series(self, selectors):
+        """Label sets of the series matching any of the selectors."""
+        index = np.unique(np.concatenate([self.select(selector) for selector in selectors] or [[]]).astype(np.int64))
+        return [self.labels(i) for i in index.tolist()]
+
+    def instant(self, query):
+        """Latest sample of each matching series, advancing them by one step.
+
+        A query of label_replace'd terms joined by `or`, as built by
+        monitoring.aggregate, returns the union of its terms.
+        """
+        if query.startswith("label_replace("):
+            return [item for term in query.split(" or ") for item in self.term(term)]
+        index = self.select(query)
+        with self._lock:
+            steps = self.steps[index]
+            self.steps[index] += 1
+            values, spikes = self.values(index, steps, True)
+            self.samples += len(index)
+            self.injected.extend(self.labels(i) for i in index[spikes])
+        now = time.time()
+        return [
+            {"metric": self.labels(i), "value": [now, repr(value)]}
+            for i, value in zip(index.tolist(), values.tolist())
+        ]
+
+    def term(self, term):
+        """One label_replace'd selector or avg/stddev/quantile_over_time of one; `__name__` is kept either way."""
+        match = LABEL_REPLACE_RE.match(term.strip())
+        if match is None:
+            raise ValueError(f"Unsupported term {term[:80]}")
+        expression = match.group(1)
+        match = OVER_TIME_RE.match(expression)
+        if match is None:
+            if "(" in expression:
+                raise ValueError(f"Unsupported expression {expression[:80]}")
+            return self.instant(expression)
+        function, quantile, selector, seconds = match.groups()
+        index = self.select(selector)
+        points = max(1, int(seconds) // SAMPLE_INTERVAL)
+        with self._lock:
+            steps = self.steps[index, None] - points + np.arange(points)
+        values, _ = self.values(index[:, None], steps, False)
+        if function == "avg":
+            statistics = values.mean(axis=1)
+        elif function == "stddev":
+            statistics = values.std(axis=1)
+        else:
+            statistics = np.quantile(values, float(quantile), axis=1)
+        now = time.time()
+        return [
+            {"metric": self.labels(i), "value": [now, repr(value)]}
+            for i, value in zip(index.tolist(), statistics.tolist())
+        ]
+
+    def metadata(self):
+        """Metric types as /api/v1/metadata returns them; every synthetic metric is a gauge."""
+        return {metric_name: [{"type": "gauge", "help": "", "unit": ""}] for metric_name in self.names}
+
+    def range(self, query, start, end, step):
+        """The `points` samples before each matching series' next step; history has no spikes."""
+        index = self.select(query)
+        points = int((end - start) / step) + 1
+        with self._lock:
+            steps = self.steps[index, None] - points + np.arange(points)
+        values, _ = self.values(index[:, None], steps, False)
+        timestamps = [start + n * step for n in range(points)]
+        return [
+            {"metric": self.labels(i), "values": [[t, repr(value)] for t, value in zip(timestamps, row)]}
+            for i, row in zip(index.tolist(), values.tolist())
+        ]
+
+    def report(self):
+        """Samples served and spiked series since the last report."""
+        with self._lock:
+            report = {"samples": self.samples, "injected": self.injected}
+            self.samples = 0
+            self.injected = []
+        return report
+
+
+def make_handler(series, latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, like Prometheus
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, body, status=200):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self, params):
+            path = urlparse(self.path).path
+            if path == "/bench/served":
+                return self._send(series.report())
+            if path == "/api/v1/label/__name__/values":
+                return self._send({"status": "success", "data": series.names})
+            if path == "/api/v1/metadata":
+                return self._send({"status": "success", "data": series.metadata()})
+            if path == "/api/v1/series":
+                return self._send({"status": "success", "data": series.series(params.get("match[]", []))})
+            if path not in ("/api/v1/query", "/api/v1/query_range"):
+                return self._send({"status": "error", "error": f"Unknown path {path}"}, 404)
+            if latency:
+                time.sleep(latency)
+            try:
+                query = params["query"][0]
+                if path == "/api/v1/query":
+                    data = {"resultType": "vector", "result": series.instant(query)}
+                else:
+                    start, end, step = (float(params[name][0]) for name in ("start", "end", "step"))
+                    data = {"resultType": "matrix", "result": series.range(query, start, end, step)}
+            except (KeyError, ValueError) as e:
+                return self._send({"status": "error", "errorType": "bad_data", "error": str(e)}, 400)
+            self._send({"status": "success", "data": data})
+
+        def do_GET(self):
+            self._handle(parse_qs(urlparse(self.path).query))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            params = parse_qs(urlparse(self.path).query)
+            params.update(parse_qs(body))
+            self._handle(params)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Prometheus HTTP API serving synthetic series")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--metrics", type=int, default=METRICS)
+    parser.add_argument("--series-per-metric", type=int, default=SERIES_PER_METRIC)
+    parser.add_argument("--apps", type=int, default=APPS)
+    parser.add_argument("--latency", type=float, default=LATENCY)
+    parser.add_argument("--anomaly-rate", type=float, default=ANOMALY_RATE)
+    parser.add_argument("--anomaly-size", type=float, default=ANOMALY_SIZE)
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args()
+
+    series = SyntheticSeries(
+        args.metrics, args.series_per_metric, args.apps, args.anomaly_rate, args.anomaly_size, args.seed
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(series, args.latency))
+    server.daemon_threads = True
+    print(f"Fake Prometheus serving {len(series.steps)} series on http://127.0.0.1:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+import numpy as np
+
+from run_benchmarks import ROOT, git_commit
+
+sys.path.insert(0, ROOT)
+from monitoring.scheduler import PollScheduler, STABLE, VOLATILE
+
+# Checks that PollScheduler keeps a polling loop within its query budget. Each
+# config drives a scheduler the way the agents do (due(), one Prometheus query
+# per batch of keys, report(), sleep for wait_time()) on a virtual clock, so
+# an hour of polling takes seconds. A random share of polls reports the key
+# volatile, which halves its interval. The report has the queries per second
+# actually sent; the exit status is 1 if any config sent more than its budget
+# allows.
+CONFIGS = {
+    "per_metric": {"keys_per_query": 1},  # BATCH_FETCH = False
+    "batch": {"keys_per_query": 200},  # BATCH_CHUNK_SIZE
+    "server_windows": {"keys_per_query": 20, "queries_per_batch": 5},  # AGGREGATE_CHUNK_SIZE, one query per statistic
+}
+OUTPUT = "poll_budget_results.json"
+METRICS = 4000  # Keys scheduled
+QUERY_BUDGET = 0.5  # Queries per second; low enough that the batch configs are limited by it
+SCRAPE_INTERVAL = 30
+MAX_FETCH_INTERVAL = 600
+DURATION = 3600  # Virtual seconds of polling per config
+VOLATILE_SHARE = 0.2  # Share of polls that report the key volatile
+SLEEP_OVERHEAD = 0.01  # Seconds the agents add to every wait_time() sleep
+SEED = 1
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+def simulate(config, args):
+    """Queries and polls a loop sends in args.duration virtual seconds under one config."""
+    clock = VirtualClock()
+    rng = np.random.default_rng(args.seed)
+    scheduler = PollScheduler(
+        SCRAPE_INTERVAL, max_interval=MAX_FETCH_INTERVAL, qps=args.qps, clock=clock.monotonic, **config
+    )
+    scheduler.sync(range(args.metrics))
+    queries = 0
+    wakeups = 0
+    while clock.now < args.duration:
+        due = scheduler.due()
+        wakeups += 1
+        if due:
+            queries += math.ceil(len(due) / config["keys_per_query"]) * config.get("queries_per_batch", 1)
+            levels = np.where(rng.random(len(due)) < args.volatile_share, VOLATILE, STABLE)
+            scheduler.report_many(due, levels.tolist())
+        wait = scheduler.wait_time()
+        clock.now += (SCRAPE_INTERVAL if wait is None else wait) + SLEEP_OVERHEAD
+    allowed = args.qps * clock.now + scheduler._burst  # The budget plus the bucket's initial burst
+    return {
+        "queries": queries,
+        "queries_per_second": queries / clock.now,
+        "allowed_queries": allowed,
+        "within_budget": queries <= allowed,
+        "polls": scheduler.polls,
+        "deferred": scheduler.deferred,
+        "wakeups": wakeups,
+        "keys_per_query": scheduler.polls / queries if queries else None,  # Per Prometheus query, not per batch
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that PollScheduler keeps polling within its query budget")
+    parser.add_argument("configs", nargs="*", default=list(CONFIGS), help=f"Any of {', '.join(CONFIGS)}")
+    parser.add_argument("--output", default=OUTPUT, help="JSON results file")
+    parser.add_argument("--metrics", type=int, default=METRICS)
+    parser.add_argument("--qps", type=float, default=QUERY_BUDGET)
+    parser.add_argument("--duration", type=float, default=DURATION)
+    parser.add_argument("--volatile-share", type=float, default=VOLATILE_SHARE)
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args()
+
+    unknown = [name for name in args.configs if name not in CONFIGS]
+    if unknown:
+        parser.error(f"Unknown configs {unknown}, expected any of {list(CONFIGS)}")
+
+    report = {
+        "created_at": time.time(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "metrics": args.metrics, "qps": args.qps, "duration": args.duration,
+            "volatile_share": args.volatile_share, "seed": args.seed,
+        },
+        "configs": {},
+    }
+    for name in args.configs:
+        results = simulate(CONFIGS[name], args)
+        report["configs"][name] = results
+        verdict = "within budget" if results["within_budget"] else "OVER BUDGET"
+        print(f"{name}: {results['queries_per_second']:.2f} queries/s of {args.qps} ({verdict}), "
+              f"{results['polls']} polls in {results['queries']} queries, {results['deferred']} deferred")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    if not all(results["within_budget"] for results in report["configs"].values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
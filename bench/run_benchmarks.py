@@ -0,0 +1,407 @@
+import argparse
+import contextlib
+import functools
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import requests
+
+from fake_prometheus import ANOMALY_RATE, ANOMALY_SIZE, APPS, LATENCY, METRICS, SEED, SERIES_PER_METRIC
+
+# Benchmarks the detection loops against bench/fake_prometheus.py and writes a
+# JSON results file for regression tracking. Each scenario runs in its own
+# process against a fresh fake Prometheus, so module state and peak RSS are
+# per scenario. Agents run their real loops with a virtual clock: their
+# sleeps until the next poll return at once, so a run of many poll intervals
+# only takes as long as the cycles themselves.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_PROMETHEUS = os.path.join(ROOT, "bench", "fake_prometheus.py")
+SCENARIOS = ["health_api", "health_api_server_windows", "execute_script", "prometheus_polling_agent", "poll"]
+OUTPUT = "bench_results.json"
+CYCLES = 20  # Monitoring cycles per scenario
+CHECK_HEALTH_REQUESTS = 200  # /check_health requests after the health_api cycles
+POLL_METRICS = 20  # poll.py queries one metric at a time; it polls this many
+SCENARIO_TIMEOUT = 1800  # Seconds before a scenario is abandoned
+STARTUP_TIMEOUT = 30  # Seconds to wait for the fake Prometheus to listen
+
+
+class BenchmarkDone(Exception):
+    """Raised from the virtual clock's sleep to leave an agent loop once enough cycles ran."""
+
+
+class VirtualClock:
+    """Stands in for the `time` module of an agent; sleep() only advances the clock.
+
+    sleep() raises BenchmarkDone once `done()` is true, or after `timeout`
+    real seconds. Everything but monotonic, time and sleep is the real time module.
+    """
+
+    def __init__(self, done, timeout):
+        self._now = time.monotonic()
+        self._offset = time.time() - self._now
+        self._done = done
+        self._deadline = time.monotonic() + timeout
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def monotonic(self):
+        return self._now
+
+    def time(self):
+        return self._now + self._offset
+
+    def sleep(self, seconds):
+        if self._done() or time.monotonic() > self._deadline:
+            raise BenchmarkDone()
+        self._now += max(seconds, 0)
+
+
+class Detections:
+    """Scores the anomalies an agent reports against the spikes the fake Prometheus injected.
+
+    Agents report series as `flag(key)`; `settle()` fetches the spikes
+    served since the last call and counts the cycle's true and false
+    positives. `truth` turns the injected label sets into the same keys.
+    """
+
+    def __init__(self, prometheus_url, truth):
+        self.prometheus_url = prometheus_url
+        self.truth = truth
+        self.flagged = set()
+        self.samples = 0
+        self.injected = 0
+        self.true_positives = 0
+        self.false_positives = 0
+        self.false_negatives = 0
+
+    def flag(self, key):
+        self.flagged.add(key)
+
+    def settle(self):
+        served = requests.get(f"{self.prometheus_url}/bench/served", timeout=30).json()
+        injected = {key for key in map(self.truth, served["injected"]) if key is not None}
+        self.samples += served["samples"]
+        self.injected += len(injected)
+        self.true_positives += len(self.flagged & injected)
+        self.false_positives += len(self.flagged - injected)
+        self.false_negatives += len(injected - self.flagged)
+        self.flagged.clear()
+
+    def results(self):
+        flagged = self.true_positives + self.false_positives
+        return {
+            "injected": self.injected,
+            "flagged": flagged,
+            "true_positives": self.true_positives,
+            "false_positives": self.false_positives,
+            "false_negatives": self.false_negatives,
+            "precision": self.true_positives / flagged if flagged else None,
+            "recall": self.true_positives / self.injected if self.injected else None,
+        }
+
+
+class CycleRecorder:
+    """Replaces an agent's CYCLE_SECONDS histogram, keeping every cycle's duration.
+
+    Detections are settled as each cycle starts, because agents report
+    anomalies after the timed block; the last cycle is settled by the caller.
+    """
+
+    def __init__(self, detections):
+        self.detections = detections
+        self.durations = []
+
+    @contextlib.contextmanager
+    def time(self):
+        self.detections.settle()
+        started = time.perf_counter()
+        yield
+        self.durations.append(time.perf_counter() - started)
+
+
+def describe(labels):
+    """Series in the notation of SeriesIndex.describe, which agents report anomalies in."""
+    metric_name = labels.get("__name__", "")
+    rest = ",".join(f'{name}="{value}"' for name, value in sorted(labels.items()) if name != "__name__")
+    return f"{metric_name}{{{rest}}}" if rest else metric_name
+
+
+def percentiles(values):
+    if not values:
+        return None
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(np.max(values)),
+        "mean": float(np.mean(values)),
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_loop(loop):
+    try:
+        loop()
+    except BenchmarkDone:
+        pass
+
+
+def bench_health_api(args, clock, cycles, detections):
+    """health_api.monitoring_agent for `cycles` cycles, then /check_health for every appid."""
+    import health_api
+
+    health_api.collector.prometheus_url = args.prometheus_url
+    health_api.CHECKPOINT_INTERVAL = 0
+    health_api.time = clock
+    health_api.poll_scheduler.clock = clock.monotonic
+    health_api.discovery.clock = clock.monotonic
+    health_api.CYCLE_SECONDS = cycles
+    health_api.send_to_agent = lambda series_name, metric_value: detections.flag(series_name)
+    health_api.engine.start()
+    run_loop(health_api.monitoring_agent)
+
+    client = health_api.app.test_client()
+    latencies = []
+    statuses = {}
+    for n in range(args.check_health_requests):
+        started = time.perf_counter()
+        response = client.get(f"/check_health?appid=app-{n % args.apps}", headers={"Accept-Encoding": "gzip"})
+        response.get_data()
+        latencies.append(time.perf_counter() - started)
+        statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+    cascade = health_api.detectors["cascade"]
+    return {
+        "check_health": {"requests": len(latencies), "statuses": statuses, "seconds": percentiles(latencies)},
+        # model_runs stays 0 if the cascade never reaches IsolationForest
+        "cascade": {"model_runs": cascade.model_runs, "skipped": cascade.skipped},
+    }
+
+
+def bench_health_api_server_windows(args, clock, cycles, detections):
+    """bench_health_api with WINDOW_MODE "server", where the fake Prometheus computes the window statistics."""
+    os.environ["WINDOW_MODE"] = "server"  # Read when health_api is imported
+    return bench_health_api(args, clock, cycles, detections)
+
+
+def bench_execute_script(args, clock, cycles, detections):
+    """prom_poll_agent/executeScript.py's main loop, unsharded and without checkpoints."""
+    import executeScript as agent
+
+    agent.collector.prometheus_url = args.prometheus_url
+    agent.METRICS_PORT = 0
+    agent.CHECKPOINT_INTERVAL = 0
+    agent.HEALTH_API_URL = None
+    agent.time = clock
+    agent.discovery.clock = clock.monotonic
+    agent.PollScheduler = functools.partial(agent.PollScheduler, clock=clock.monotonic)
+    agent.CYCLE_SECONDS = cycles
+    agent.send_to_autogen_agent = lambda result: detections.flag(result["metric_name"])
+    run_loop(agent.main)
+    return {}
+
+
+def bench_prometheus_polling_agent(args, clock, cycles, detections):
+    """prom_poll_agent/prometheus_polling_agent.py's fetch loop."""
+    import prometheus_polling_agent as agent
+
+    agent.collector.prometheus_url = args.prometheus_url
+    agent.time = clock
+    agent.poll_scheduler.clock = clock.monotonic
+    agent.discovery.clock = clock.monotonic
+    agent.CYCLE_SECONDS = cycles
+    agent.send_to_master_agent = lambda series_id, metric_value: detections.flag(agent.series_index.describe(series_id))
+    run_loop(agent.fetch_metrics)
+    return {}
+
+
+def bench_poll(args, clock, cycles, detections):
+    """prom_poll_agent/poll.py's loop over its first POLL_METRICS metrics, one query each."""
+    import poll as agent
+
+    agent.collector.prometheus_url = args.prometheus_url
+    agent.METRIC_NAMES = agent.collector.get_all_metrics()[:args.poll_metrics]
+    agent.model_registry.max_models = len(agent.METRIC_NAMES) * agent.MAX_SERIES_PER_METRIC
+    agent.time = clock
+    agent.poll_scheduler.clock = clock.monotonic
+    agent.CYCLE_SECONDS = cycles
+    agent.send_to_master_agent = lambda series_id, metric_value: detections.flag(agent.series_index.describe(series_id))
+    run_loop(agent.fetch_metrics)
+    return {}
+
+
+BENCHMARKS = {
+    "health_api": (bench_health_api, describe),
+    "health_api_server_windows": (bench_health_api_server_windows, describe),
+    "execute_script": (bench_execute_script, describe),
+    "prometheus_polling_agent": (bench_prometheus_polling_agent, describe),
+    "poll": (bench_poll, describe),
+}
+
+
+def run_scenario(args):
+    """Run one scenario in this process and write its results to args.result_file."""
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, "prom_poll_agent"))
+    benchmark, truth = BENCHMARKS[args.run_scenario]
+    detections = Detections(args.prometheus_url, truth)
+    cycles = CycleRecorder(detections)
+    clock = VirtualClock(lambda: len(cycles.durations) >= args.cycles, SCENARIO_TIMEOUT)
+    started = time.perf_counter()
+    extra = benchmark(args, clock, cycles, detections)
+    wall_seconds = time.perf_counter() - started
+    detections.settle()
+    cycle_seconds = sum(cycles.durations)
+    results = {
+        "cycles": len(cycles.durations),
+        "samples": detections.samples,
+        "samples_per_second": detections.samples / cycle_seconds if cycle_seconds else None,
+        "cycle_seconds": percentiles(cycles.durations),
+        "wall_seconds": wall_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "detection": detections.results(),
+    }
+    results.update(extra)
+    with open(args.result_file, "w") as f:
+        json.dump(results, f)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def fake_prometheus(args):
+    """Start a fresh fake Prometheus process, yielding its URL."""
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, FAKE_PROMETHEUS, "--port", str(port), "--metrics", str(args.metrics),
+        "--series-per-metric", str(args.series_per_metric), "--apps", str(args.apps),
+        "--latency", str(args.latency), "--anomaly-rate", str(args.anomaly_rate),
+        "--anomaly-size", str(args.anomaly_size), "--seed", str(args.seed),
+    ], stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                requests.get(f"{url}/api/v1/label/__name__/values", timeout=1)
+                break
+            except requests.exceptions.ConnectionError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError(f"Fake Prometheus did not start on port {port}")
+                time.sleep(0.1)
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def scenario_args(args, scenario, prometheus_url, result_file):
+    return [
+        sys.executable, os.path.abspath(__file__), "--run-scenario", scenario,
+        "--prometheus-url", prometheus_url, "--result-file", result_file,
+        "--cycles", str(args.cycles), "--apps", str(args.apps),
+        "--check-health-requests", str(args.check_health_requests), "--poll-metrics", str(args.poll_metrics),
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the detection loops against a fake Prometheus")
+    parser.add_argument("scenarios", nargs="*", default=SCENARIOS, help=f"Any of {', '.join(SCENARIOS)}")
+    parser.add_argument("--output", default=OUTPUT, help="JSON results file")
+    parser.add_argument("--cycles", type=int, default=CYCLES)
+    parser.add_argument("--metrics", type=int, default=METRICS)
+    parser.add_argument("--series-per-metric", type=int, default=SERIES_PER_METRIC)
+    parser.add_argument("--apps", type=int, default=APPS)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="Seconds added to every Prometheus query")
+    parser.add_argument("--anomaly-rate", type=float, default=ANOMALY_RATE, help="Share of samples that are spikes")
+    parser.add_argument("--anomaly-size", type=float, default=ANOMALY_SIZE, help="Spike height in noise std devs")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--check-health-requests", type=int, default=CHECK_HEALTH_REQUESTS)
+    parser.add_argument("--poll-metrics", type=int, default=POLL_METRICS)
+    parser.add_argument("--verbose", action="store_true", help="Show the agents' output")
+    parser.add_argument("--run-scenario", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--prometheus-url", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        return run_scenario(args)
+
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios {unknown}, expected any of {SCENARIOS}")
+
+    config = {
+        name: getattr(args, name) for name in (
+            "cycles", "metrics", "series_per_metric", "apps", "latency", "anomaly_rate", "anomaly_size",
+            "seed", "check_health_requests", "poll_metrics",
+        )
+    }
+    report = {
+        "created_at": time.time(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": config,
+        "scenarios": {},
+    }
+    for scenario in args.scenarios:
+        print(f"Running {scenario}...", flush=True)
+        with fake_prometheus(args) as prometheus_url, tempfile.TemporaryDirectory() as scratch:
+            result_file = os.path.join(scratch, "result.json")
+            try:
+                # Scenarios run in the scratch directory so nothing they write lands in the tree.
+                completed = subprocess.run(
+                    scenario_args(args, scenario, prometheus_url, result_file), cwd=scratch,
+                    stdout=None if args.verbose else subprocess.DEVNULL, timeout=SCENARIO_TIMEOUT,
+                )
+                if completed.returncode == 0:
+                    with open(result_file) as f:
+                        results = json.load(f)
+                else:
+                    results = {"error": f"Exited with status {completed.returncode}"}
+            except subprocess.TimeoutExpired:
+                results = {"error": f"Timed out after {SCENARIO_TIMEOUT}s"}
+        report["scenarios"][scenario] = results
+        if "error" in results:
+            print(f"  {scenario} failed: {results['error']}")
+        else:
+            cycle_seconds = results["cycle_seconds"] or {}
+            detection = results["detection"]
+            print(f"  {results['samples_per_second'] or 0:.0f} samples/s, cycle p50 {cycle_seconds.get('p50', 0):.3f}s "
+                  f"p99 {cycle_seconds.get('p99', 0):.3f}s, peak RSS {results['peak_rss_mb']:.0f} MB, "
+                  f"precision {detection['precision']}, recall {detection['recall']}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
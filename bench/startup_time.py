@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from run_benchmarks import ROOT, git_commit
+
+# Measures how long each entry point takes to import, which is what a cold
+# start or a new gunicorn worker pays before serving anything. Each target is
+# imported in a fresh interpreter `--runs` times; the report has the median
+# wall time (less a bare interpreter's startup) and, from the fastest run's
+# `python -X importtime` output, the import time per top-level package and
+# the slowest imports. HEAVY packages are listed when a target imports them,
+# so a change that makes one load eagerly again shows up.
+TARGETS = {
+    "health_api": ("health_api", {}),
+    "health_api_worker": ("health_api", {"SERVE_ROLE": "worker"}),
+    "serve": ("serve", {}),
+    "execute_script": ("executeScript", {}),
+    "prometheus_polling_agent": ("prometheus_polling_agent", {}),
+    "poll": ("poll", {}),
+}
+HEAVY = ("autogen", "sklearn", "scipy")  # Packages no entry point should import before it needs them
+OUTPUT = "startup_results.json"
+RUNS = 5  # Fresh interpreters per target
+TOP_IMPORTS = 15  # Slowest imports (by cumulative time) kept per target
+TIMEOUT = 120  # Seconds before an import is abandoned
+
+
+def parse_importtime(stderr):
+    """(module, self_us, cumulative_us, depth) for each line `python -X importtime` wrote."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        module = name.strip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((module, int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def import_once(module, env, scratch):
+    """Import `module` in a new interpreter; returns its wall time and importtime lines."""
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}" if module else "pass"],
+        cwd=scratch, env=env, capture_output=True, text=True, timeout=TIMEOUT,
+    )
+    wall_seconds = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else
+                           f"Exited with status {completed.returncode}")
+    return wall_seconds, parse_importtime(completed.stderr)
+
+
+def measure(module, extra_env, runs, baseline):
+    env = dict(os.environ, **extra_env)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [ROOT, os.path.join(ROOT, "prom_poll_agent")] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    with tempfile.TemporaryDirectory() as scratch:
+        # Targets run in a scratch directory so nothing they write lands in the tree.
+        measured = [import_once(module, env, scratch) for _ in range(runs)]
+    walls = [wall for wall, _ in measured]
+    _, imports = min(measured, key=lambda run: run[0])
+    packages = {}
+    for name, self_us, _, _ in imports:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    slowest = sorted(imports, key=lambda entry: entry[2], reverse=True)[:TOP_IMPORTS]
+    return {
+        "wall_seconds": statistics.median(walls),
+        "import_seconds": max(statistics.median(walls) - baseline, 0),
+        "importtime_seconds": sum(cumulative for _, _, cumulative, depth in imports if depth == 0) / 1e6,
+        "modules": len(imports),
+        "heavy_imported": [package for package in HEAVY if package in packages],
+        "packages": {
+            package: self_us / 1e6
+            for package, self_us in sorted(packages.items(), key=lambda item: item[1], reverse=True)
+        },
+        "slowest": [{"module": name, "cumulative_seconds": cumulative / 1e6} for name, _, cumulative, _ in slowest],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of each entry point")
+    parser.add_argument("targets", nargs="*", default=list(TARGETS), help=f"Any of {', '.join(TARGETS)}")
+    parser.add_argument("--output", default=OUTPUT, help="JSON results file")
+    parser.add_argument("--runs", type=int, default=RUNS)
+    parser.add_argument("--detection-only", action="store_true", help="Import with DETECTION_ONLY=1")
+    args = parser.parse_args()
+
+    unknown = [target for target in args.targets if target not in TARGETS]
+    if unknown:
+        parser.error(f"Unknown targets {unknown}, expected any of {list(TARGETS)}")
+
+    extra_env = {"DETECTION_ONLY": "1"} if args.detection_only else {}
+    baseline = statistics.median(
+        wall for wall, _ in (import_once(None, os.environ, tempfile.gettempdir()) for _ in range(args.runs))
+    )
+    report = {
+        "created_at": time.time(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"runs": args.runs, "detection_only": args.detection_only},
+        "interpreter_seconds": baseline,
+        "targets": {},
+    }
+    for target in args.targets:
+        module, target_env = TARGETS[target]
+        try:
+            results = measure(module, dict(extra_env, **target_env), args.runs, baseline)
+        except (RuntimeError, subprocess.TimeoutExpired) as e:
+            results = {"error": str(e)}
+        report["targets"][target] = results
+        if "error" in results:
+            print(f"{target}: failed: {results['error']}")
+            continue
+        packages = ", ".join(f"{package} {seconds:.3f}s" for package, seconds in list(results["packages"].items())[:5])
+        heavy = f", imports {' '.join(results['heavy_imported'])}" if results["heavy_imported"] else ""
+        print(f"{target}: {results['import_seconds']:.3f}s ({results['modules']} modules{heavy}); {packages}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
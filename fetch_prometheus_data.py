@@ -1,58 +1,70 @@
-import requests
+import argparse
+import time
 
-# Prometheus server URL
+from monitoring.collector import Collector
+from monitoring.export import CHUNK_SAMPLES, FORMATS, export_range, parse_time
+
+# Exports Prometheus history to columnar files for offline training and
+# testing, e.g.
+#
+#   python fetch_prometheus_data.py '{job="flask-app"}' --start=-7d --step 30 --output dataset
+#
+# Every series the selectors match is fetched with concurrent range queries
+# over consecutive time chunks and written to the output directory as it
+# arrives: a memory-mappable series x step matrix (values.npy) or compressed
+# Parquet rows (samples.parquet), with the series labels and time axis in
+# export.json. Read it back with monitoring.export.load_export. Without
+# selectors, the available metric names are listed.
 PROMETHEUS_URL = "http://localhost:9090"
 ##PROMETHEUS_URL = "https://e742-2406-7400-98-79f0-58e3-9b48-242c-a6a2.ngrok-free.app/"
+OUTPUT_DIR = "prometheus_export"
+STEP = 30  # Seconds between exported points; the Prometheus scrape_interval keeps every sample
+START = "-1d"  # Unix time, ISO 8601 time, or an offset from now such as -6h
+END = "now"
+MAX_WORKERS = 4  # Concurrent range queries
+REQUEST_TIMEOUT = 120  # Seconds before a range query times out
+REQUEST_RETRIES = 3  # Retries with jittered backoff for failed range queries
 
-def get_all_metrics():
-    """Fetch all available metric names from Prometheus."""
-    response = requests.get(f"{PROMETHEUS_URL}/api/v1/label/__name__/values")
-    if response.status_code == 200:
-        return response.json().get("data", [])
-    else:
-        print("Error fetching metrics:", response.text)
-        return []
-
-def fetch_metric_data(metric_name):
-    """Fetch the latest data for the selected metric."""
-    response = requests.get(f"{PROMETHEUS_URL}/api/v1/query", params={"query": metric_name})
-    if response.status_code == 200:
-        data = response.json().get("data", {}).get("result", [])
-        
-        if data:
-            for item in data:
-                metric_value = item['value'][1]
-                result_str = f"Metric: {item['metric']}, Value: {item['value']}"
-                print(result_str)
-                print(f"Metric Value: {metric_value}")
-        else:
-            print("No data available for this metric.")
-    else:
-        print("Error fetching metric data:", response.text)
 
 def main():
-    """Main function to list metrics and allow user selection."""
-    print("Fetching available metrics...")
-    metrics = get_all_metrics()
-    
-    if not metrics:
-        print("No metrics found.")
+    parser = argparse.ArgumentParser(description="Export Prometheus history to columnar files")
+    parser.add_argument("selectors", nargs="*", help="Series selectors, e.g. '{job=\"api\"}' or a metric name")
+    parser.add_argument("--prometheus-url", default=PROMETHEUS_URL)
+    parser.add_argument("--start", default=START, help="Unix time, ISO 8601 time, or an offset such as --start=-6h")
+    parser.add_argument("--end", default=END)
+    parser.add_argument("--step", type=float, default=STEP, help="Seconds between points")
+    parser.add_argument("--output", default=OUTPUT_DIR, help="Directory to write the export to")
+    parser.add_argument("--format", choices=FORMATS, default="npy")
+    parser.add_argument("--dtype", choices=("float64", "float32"), default="float64")
+    parser.add_argument("--chunk-samples", type=int, default=CHUNK_SAMPLES, help="Samples per range query")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Concurrent range queries")
+    args = parser.parse_args()
+
+    collector = Collector(
+        args.prometheus_url, max_workers=args.workers, timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES
+    )
+    if not args.selectors:
+        metrics = collector.get_all_metrics()
+        print("\n".join(metrics) if metrics else "No metrics found.")
         return
-    
-    print("\nAvailable Metrics:")
-    for i, metric in enumerate(metrics):
-        print(f"{i + 1}. {metric}")
 
+    now = time.time()
+    start = parse_time(args.start, now)
+    end = parse_time(args.end, now)
+    if end < start:
+        parser.error("--end is before --start")
     try:
-        choice = int(input("\nEnter the number of the metric you want to fetch data for: ")) - 1
-        if 0 <= choice < len(metrics):
-            selected_metric = metrics[choice]
-            print(f"\nFetching data for: {selected_metric}")
-            fetch_metric_data(selected_metric)
-        else:
-            print("Invalid selection.")
-    except ValueError:
-        print("Please enter a valid number.")
+        metadata = export_range(
+            collector, args.selectors, start, end, args.step, args.output,
+            export_format=args.format, dtype=args.dtype, chunk_samples=args.chunk_samples,
+        )
+    except Exception as e:
+        print(f"Exception while exporting: {e}")
+        raise SystemExit(1)
+    finally:
+        collector.close()
+    print(f"Exported {metadata['samples']} samples of {len(metadata['series'])} series to {args.output}")
+
 
 if __name__ == "__main__":
     main()
@@ -1,78 +1,324 @@
+import os
+import queue
+import tempfile
 import time
 import threading
-import requests
 import numpy as np
+import requests
 from flask import Flask, request, jsonify
-from sklearn.ensemble import IsolationForest
-from autogen import ConversableAgent
-from autogen.coding import LocalCommandLineCodeExecutor
+from monitoring.agent import CodeExecutorAgent
+from monitoring.aggregate import WindowAggregates
+from monitoring.backfill import fetch_backfill, fill_windows
+from monitoring.checkpoint import load_checkpoint, save_checkpoint
+from monitoring.collector import Collector
+from monitoring.detectors import (
+    DetectorCascade, DetectorPolicy, EWMADetector, IsolationForestDetector, MADDetector, SeasonalDetector,
+    ZScoreDetector, evaluate_aggregates,
+)
+from monitoring.discovery import MetricDiscovery
+from monitoring.dispatch import AnomalyDispatcher
+from monitoring.engine import DetectionEngine
+from monitoring.instrumentation import (
+    CYCLE_SECONDS, DETECTION_SECONDS, record_windows, register_dispatcher, render_metrics,
+)
+from monitoring.model_registry import ModelRegistry
+from monitoring.parallel import ScoringExecutor
+from monitoring.profiler import SlowCycleProfiler
+from monitoring.remote_write import RemoteWriteError, iter_series
+from monitoring.scheduler import ANOMALOUS, PollScheduler, STABLE, VOLATILE, activity_levels
+from monitoring.series import SeriesIndex
+from monitoring.sharding import merge_snapshots
+from monitoring.snapshot import SnapshotPublisher, SnapshotReader, write_snapshot
+from monitoring.window_store import WindowStore
 
 app = Flask(__name__)
 
 PROMETHEUS_URL = "http://localhost:9090"
+API_PORT = int(os.environ.get("API_PORT", "6075"))  # Port of the public API
+DEBUG = os.environ.get("FLASK_DEBUG") == "1"  # Flask debugger for `python health_api.py`; never the reloader, which would start a second agent
+SERVE_ROLE = os.environ.get("SERVE_ROLE", "standalone")  # "standalone" does everything in one process; serve.py runs one "detector" and many "worker"s
+SNAPSHOT_FILE = os.environ.get("SNAPSHOT_FILE", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "health_api_snapshot.json"
+))  # Where the detector shares the latest snapshot with workers; /dev/shm keeps it in memory
+DETECTOR_URL = os.environ.get("DETECTOR_URL", "http://127.0.0.1:6076")  # Detector's local API, which workers forward requests to
+DETECTOR_TIMEOUT = 60  # Seconds a worker waits for a forwarded request
+SHUTDOWN_TIMEOUT = 30  # Seconds to finish the running cycle and deliver pending anomalies when stopping
+DETECTION_ONLY = os.environ.get("DETECTION_ONLY") == "1"  # Detect, log and alert without the autogen agent, which is then never imported
 WINDOW_SIZE = 10
 STD_DEV_THRESHOLD = 2
-FETCH_INTERVAL = 10  # Interval in seconds to fetch metrics
+SCRAPE_INTERVAL = 30  # Prometheus global scrape_interval (prometheus.yml); polling faster re-reads samples
+FETCH_INTERVAL = SCRAPE_INTERVAL  # Shortest interval in seconds between polls of a metric
+MAX_FETCH_INTERVAL = 300  # Stable metrics back off up to this many seconds between polls
+FETCH_BACKOFF = 2  # Interval multiplier after a poll where all of a metric's series were stable
+VOLATILE_SCORE = 1  # Std devs the newest value must move for a series to count as volatile
+QUERY_BUDGET = 5  # Prometheus queries per second across all scheduled polls
+METRICS_REFRESH_INTERVAL = 300  # Seconds the discovered list of metric names is cached
+METRIC_INCLUDE = []  # Regexes of metric names to monitor; empty monitors every name that is not excluded
+METRIC_EXCLUDE = [r"^go_", r"^python_gc_", r"^scrape_", r"^promhttp_", r"^prometheus_"]  # Runtime and scrape internals
+METRIC_MATCH = []  # Series selectors sent as match[] (e.g. '{job="flask-app"}') to discover only their metric names
+METRICS_LOOKBACK = 3600  # Seconds a metric may go without samples before it is no longer discovered
+INGEST_MODE = os.environ.get("INGEST_MODE", "poll")  # "poll" queries Prometheus; "remote_write" only takes pushes
+WINDOW_MODE = os.environ.get("WINDOW_MODE", "client")  # "client" keeps windows of polled values; "server" has Prometheus compute window statistics
+COUNTER_RATE_WINDOW = 4 * SCRAPE_INTERVAL  # Seconds of samples per rate() of a counter in server window mode
+AGGREGATE_QUANTILES = (0.05, 0.95)  # Server window mode only flags values outside these window quantiles
+REMOTE_WRITE_BATCH_SIZE = 500  # Series per detection engine task while ingesting a remote write push
+REMOTE_WRITE_MAX_PENDING = 32  # Engine queue depth at which pushes get 429 so Prometheus backs off
+REMOTE_WRITE_TIMEOUT = 30  # Seconds a push may wait for room in the engine queue
+REMOTE_WRITE_CAPTURE_DIR = os.environ.get("REMOTE_WRITE_CAPTURE_DIR")  # Save raw pushes here for replay
+SHARD_STALE_AFTER = 600  # Seconds without a push from a sharded agent before its snapshot is reported stale
+BATCH_FETCH = True  # Fetch all metrics with a few vector queries instead of one query per metric
+BATCH_CHUNK_SIZE = 200  # Metric names per vector query, keeps responses under Prometheus limits
+COLLECTOR_MAX_WORKERS = 8  # Concurrent requests to Prometheus over the shared connection pool
+REQUEST_TIMEOUT = 5  # Seconds before a single Prometheus request times out
+REQUEST_RETRIES = 2  # Retries with jittered backoff for failed requests
+CYCLE_DEADLINE = FETCH_INTERVAL  # Seconds after which unfinished fetches in a cycle are skipped
+MODEL_RETRAIN_EVERY = WINDOW_SIZE  # Refit a series model once its window has fully turned over
+MODEL_DRIFT_THRESHOLD = 3  # Refit when the rolling mean drifts this many fit-time std devs
+MODEL_MAX_AGE = 600  # Refit models older than this many seconds
+MAX_MODELS = 5000  # Least recently used models are evicted beyond this many series
+SCORING_WORKERS = int(os.environ.get("SCORING_WORKERS", "0"))  # Worker processes for model scoring; 0 scores in-process
+BACKFILL_ON_START = True  # Fill windows from Prometheus range queries before live polling starts
+CHECKPOINT_DIR = os.environ.get("CHECKPOINT_DIR", "checkpoints")  # Where windows and models are checkpointed
+CHECKPOINT_INTERVAL = 300  # Seconds between checkpoints; 0 disables checkpointing
+CHECKPOINT_MODELS = True  # Also checkpoint fitted models, not just windows
+GZIP_RESPONSES = True  # Gzip /check_health bodies for clients that accept it
+APP_LABEL = "job"  # Label whose value is the appid, for appids not listed in APP_SELECTORS
+APP_SELECTORS = {}  # appid -> {label: value} selecting its series, e.g. {"shop": {"namespace": "shop-prod"}}
+MAX_PAGE_SIZE = 1000  # Most series per /check_health page
+MAX_BATCH_APPIDS = 100  # Most appids per /check_health/batch request
+PROFILE_SLOW_CYCLES = float(os.environ.get("PROFILE_SLOW_CYCLES", "0"))  # Print the hottest stacks of cycles slower than this many seconds; 0 disables
+MAX_SERIES_PER_METRIC = 50  # Label sets tracked per metric name; the largest values win beyond this
+MAX_SERIES = 20000  # Total series tracked across all metrics
+DISPATCH_QUEUE_SIZE = 1000  # Series with undelivered anomalies; further anomalies are dropped and counted
+DISPATCH_COALESCE_WINDOW = 2  # Seconds to gather a burst of anomalies into one agent message
+DISPATCH_MAX_BATCH = 50  # Anomalies per agent message
+DISPATCH_MIN_INTERVAL = 5  # Minimum seconds between agent messages
+ALERT_DEDUP_INTERVAL = 300  # Seconds before the same series is reported to the agent again
+DETECTOR_RULES = [  # (metric name regex, detector) pairs; the first match wins, None disables detection
+    (r".*", "cascade"),
+]
+EWMA_ALPHA = 0.3  # Weight of the newest value in the exponentially weighted mean
+EWMA_THRESHOLD = 3  # Exponentially weighted std devs to flag an anomaly
+MAD_THRESHOLD = 3.5  # Scaled median absolute deviations to flag an anomaly
+SEASONAL_PERIOD = 120  # Samples per season (an hour at FETCH_INTERVAL); needs WINDOW_SIZE above two periods
+SEASONAL_THRESHOLD = 3  # Std devs of period-over-period differences to flag an anomaly
+CASCADE_VARIANCE_RATIO = 2  # Run Isolation Forest when recent std dev exceeds this multiple of the older values'
+CASCADE_RECENT = 3  # Newest values used for the recent std dev
+CASCADE_CONFIRM = False  # Require Isolation Forest to confirm anomalies flagged by the cheap detectors
 
-# Dictionary to store metric values for anomaly detection
-metric_values_dict = {}
+# Series ids for every tracked label set, owned by the detection engine
+series_index = SeriesIndex(max_series_per_metric=MAX_SERIES_PER_METRIC, max_series=MAX_SERIES)
 
-# Create a local command line code executor
-executor = LocalCommandLineCodeExecutor(timeout=10, work_dir=".")
+# Sliding windows of values per series id for anomaly detection, owned by the detection engine
+metric_windows = WindowStore(WINDOW_SIZE)
 
-# Create an agent with code executor configuration
-code_executor_agent = ConversableAgent(
-    "code_executor_agent",
-    llm_config=False,
-    code_execution_config={"executor": executor},
-    human_input_mode="NEVER",
+# Concurrent Prometheus client shared by the monitoring agent and API requests
+collector = Collector(
+    PROMETHEUS_URL,
+    max_workers=COLLECTOR_MAX_WORKERS,
+    timeout=REQUEST_TIMEOUT,
+    retries=REQUEST_RETRIES,
+    cycle_deadline=CYCLE_DEADLINE,
+    chunk_size=BATCH_CHUNK_SIZE,
 )
 
-def fetch_metric_data(metric_name):
-    """Fetch the latest data for the selected metric."""
-    try:
-        response = requests.get(f"{PROMETHEUS_URL}/api/v1/query", params={"query": metric_name})
-        if response.status_code == 200:
-            data = response.json().get("data", {}).get("result", [])
-            if data:
-                return float(data[0]['value'][1])
-            else:
-                print(f"No data available for metric: {metric_name}")
-                return None
-        else:
-            print(f"Error fetching metric data for {metric_name}: {response.text}")
-            return None
-    except Exception as e:
-        print(f"Exception while fetching metric data for {metric_name}: {e}")
-        return None
+# Window statistics per series from Prometheus, used instead of metric_windows when WINDOW_MODE is "server"
+aggregates = WindowAggregates(
+    collector,
+    WINDOW_SIZE * FETCH_INTERVAL,
+    FETCH_INTERVAL,
+    COUNTER_RATE_WINDOW,
+    quantiles=AGGREGATE_QUANTILES,
+)
+
+# Process pool for model scoring; models then live in the workers instead of model_registry
+scoring_executor = None
+if SCORING_WORKERS > 0:
+    scoring_executor = ScoringExecutor(
+        SCORING_WORKERS,
+        WINDOW_SIZE,
+        contamination=0.1,
+        retrain_every=MODEL_RETRAIN_EVERY,
+        drift_threshold=MODEL_DRIFT_THRESHOLD,
+        max_model_age=MODEL_MAX_AGE,
+        max_models=MAX_MODELS,
+    )
+
+# Latest health results, published by the monitoring agent and served by /check_health;
+# workers read the ones the detector process writes to SNAPSHOT_FILE
+snapshots = SnapshotReader(SNAPSHOT_FILE) if SERVE_ROLE == "worker" else SnapshotPublisher()
+
+# Latest health result per series id, owned by the detection engine; polls update a subset
+series_results = {}
+
+# Latest health snapshot pushed by each sharded polling agent, by shard id, merged by /cluster_health
+shard_snapshots = {}
+shard_lock = threading.Lock()
+
+# When each metric is polled next, adapted to how active its series are
+poll_scheduler = PollScheduler(
+    SCRAPE_INTERVAL,
+    min_interval=FETCH_INTERVAL,
+    max_interval=MAX_FETCH_INTERVAL,
+    backoff=FETCH_BACKOFF,
+    qps=QUERY_BUDGET,
+    keys_per_query=aggregates.chunk_size if WINDOW_MODE == "server" else BATCH_CHUNK_SIZE if BATCH_FETCH else 1,
+    queries_per_batch=len(WindowAggregates.STATISTICS) if WINDOW_MODE == "server" else 1,  # One per window statistic
+)
+
+# Only one monitoring cycle runs at a time, whether started by the agent or a refresh
+cycle_lock = threading.RLock()
+
+# Samples stacks during cycles and prints where slow ones spent their time
+cycle_profiler = SlowCycleProfiler(PROFILE_SLOW_CYCLES)
+
+# Single writer for series_index, metric_windows and model_registry; other threads submit work to it
+engine = DetectionEngine()
+
+# Fitted Isolation Forest models, one per series, owned by the detection engine
+model_registry = ModelRegistry(
+    contamination=0.1,
+    retrain_every=MODEL_RETRAIN_EVERY,
+    drift_threshold=MODEL_DRIFT_THRESHOLD,
+    max_model_age=MODEL_MAX_AGE,
+    max_models=MAX_MODELS,
+    seed_by_series=True,
+)
+
+# Agent with a local command line code executor, imported and created on the first anomaly sent
+code_executor_agent = CodeExecutorAgent(work_dir=".", timeout=10)
+
+# Detectors by name, chosen per metric by DETECTOR_RULES
+isolation_forest = IsolationForestDetector(model_registry, executor=scoring_executor)
+zscore = ZScoreDetector(STD_DEV_THRESHOLD)
+detectors = {
+    "zscore": zscore,
+    "ewma": EWMADetector(EWMA_ALPHA, EWMA_THRESHOLD),
+    "mad": MADDetector(MAD_THRESHOLD),
+    "seasonal": SeasonalDetector(SEASONAL_PERIOD, SEASONAL_THRESHOLD),
+    "isolation_forest": isolation_forest,
+    "cascade": DetectorCascade(
+        [zscore],
+        isolation_forest,
+        variance_ratio=CASCADE_VARIANCE_RATIO,
+        recent=CASCADE_RECENT,
+        confirm=CASCADE_CONFIRM,
+        window_size=WINDOW_SIZE,
+    ),
+}
+detector_policy = DetectorPolicy(DETECTOR_RULES, detectors)
+
+def send_anomaly_batch(anomalies):
+    """Send a batch of (metric_name, metric_value) anomalies to the agent as one message."""
+    lines = "\n".join(f"- {metric_name}, value: {metric_value}" for metric_name, metric_value in anomalies)
+    message = f"Anomalies detected for {len(anomalies)} metrics:\n{lines}"
+    print(f"Sending to agent: {message}")
+    code_executor_agent.handle_message(message)
+
+# Delivers anomalies to the agent in the background so a slow agent never stalls detection
+dispatcher = AnomalyDispatcher(
+    send_anomaly_batch,
+    queue_size=DISPATCH_QUEUE_SIZE,
+    coalesce_window=DISPATCH_COALESCE_WINDOW,
+    max_batch=DISPATCH_MAX_BATCH,
+    min_interval=DISPATCH_MIN_INTERVAL,
+    dedup_interval=ALERT_DEDUP_INTERVAL,
+)
+register_dispatcher(dispatcher)
+
+# Delivers /simulate_health anomalies apart from live ones, so demos never dedup or crowd out real alerts
+simulation_dispatcher = AnomalyDispatcher(
+    send_anomaly_batch,
+    queue_size=DISPATCH_QUEUE_SIZE,
+    coalesce_window=DISPATCH_COALESCE_WINDOW,
+    max_batch=DISPATCH_MAX_BATCH,
+    min_interval=DISPATCH_MIN_INTERVAL,
+    dedup_interval=0,
+    name="simulated-anomaly-dispatch",
+)
+register_dispatcher(simulation_dispatcher)
+
+def apply_metric_changes(added, removed):
+    """Start polling newly discovered metrics and forget the ones Prometheus no longer has."""
+    if INGEST_MODE != "poll":
+        return  # Pushed series do not depend on discovery
+    for metric_name in removed:
+        poll_scheduler.remove(metric_name)
+    if removed:
+        print(f"Forgetting {len(removed)} metrics no longer in Prometheus")
+        engine.submit(forget_metrics, removed)
+    for metric_name in added:
+        poll_scheduler.add(metric_name)
+    if added and BACKFILL_ON_START and WINDOW_MODE == "client":
+        backfill_metrics(added)
+
+# Metric names to monitor, cached and filtered; changes reach the scheduler and windows through apply_metric_changes
+discovery = MetricDiscovery(
+    collector,
+    ttl=METRICS_REFRESH_INTERVAL,
+    include=METRIC_INCLUDE,
+    exclude=METRIC_EXCLUDE,
+    match=METRIC_MATCH,
+    lookback=METRICS_LOOKBACK,
+    on_change=apply_metric_changes,
+)
 
-def check_for_anomalies(metric_name, metric_values):
-    """Check for anomalies using Isolation Forest and Standard Deviation methods."""
-    model = IsolationForest(contamination=0.1)
-    model.fit(np.array(metric_values).reshape(-1, 1))
-    predictions = model.predict(np.array(metric_values).reshape(-1, 1))
-    mean = np.mean(metric_values)
-    std_dev = np.std(metric_values)
-    anomalies = []
-
-    for i, value in enumerate(metric_values):
-        is_anomaly = False
-        if predictions[i] == -1:
-            is_anomaly = True
-        if abs(value - mean) > STD_DEV_THRESHOLD * std_dev:
-            is_anomaly = True
-        anomalies.append(is_anomaly)
-    
-    return anomalies[-1] if anomalies else False
+def app_selector(appid):
+    """Label matchers ({label: value}) selecting the series of an application."""
+    return APP_SELECTORS.get(appid, {APP_LABEL: appid})
+
+def fetch_all_metric_data(metrics, matchers=None):
+    """Fetch the latest (labels, value) sample of every series of the given metrics (that match `matchers`)."""
+    result = collector.fetch_metrics(metrics, batch=BATCH_FETCH, matchers=matchers)
+    if result.skipped:
+        print(f"Skipped {len(result.skipped)} metrics after the {CYCLE_DEADLINE}s cycle deadline")
+    if result.failed:
+        print(f"Failed to fetch {len(result.failed)} metrics")
+    return result.samples
+
+def fetch_all_aggregates(metrics, matchers=None):
+    """Fetch (labels, (value, mean, std, low, high)) for every series of the given metrics from Prometheus."""
+    result = aggregates.fetch(metrics, matchers)
+    if result.skipped:
+        print(f"Skipped {len(result.skipped)} metrics after the {CYCLE_DEADLINE}s cycle deadline")
+    if result.failed:
+        print(f"Failed to fetch window statistics of {len(result.failed)} metrics")
+    return result.series
+
+def detect_anomalies(series_ids):
+    """Check the latest value of each full window with the detector its metric is configured for.
+
+    Returns {series_id: is_anomaly} for series that have a detector.
+    """
+    groups = {}
+    for series_id in series_ids:
+        detector = detector_policy.for_metric(series_index.metric_name(series_id))
+        if detector is not None:
+            groups.setdefault(detector, []).append(series_id)
+
+    results = {}
+    if scoring_executor is not None:
+        scoring_executor.last_batch_timings = []
+    for detector, group in groups.items():
+        matrix = metric_windows.matrix(group)
+        with DETECTION_SECONDS.labels(detector.name).time():
+            results.update(zip(group, detector.detect(group, matrix).tolist()))
+    if scoring_executor is not None:
+        for worker, series, seconds in scoring_executor.last_batch_timings:
+            print(f"Scoring worker {worker}: {series} series in {seconds:.3f}s")
+    return results
 
 def send_to_agent(metric_name, metric_value):
-    """Send anomaly details to the agent."""
-    try:
-        message = f"Anomaly detected for metric: {metric_name}, value: {metric_value}"
-        print(f"Sending to agent: {message}")
-        code_executor_agent.handle_message(message)
-    except Exception as e:
-        print(f"Exception while sending data to agent: {e}")
+    """Queue anomaly details for the agent without waiting for delivery."""
+    if DETECTION_ONLY:
+        return
+    dispatcher.dispatch(metric_name, (metric_name, metric_value))
+
+def send_simulated_to_agent(metric_name, metric_value):
+    """Queue a simulated anomaly for the agent on the simulation dispatcher."""
+    if DETECTION_ONLY:
+        return
+    simulation_dispatcher.dispatch(metric_name, (metric_name, metric_value))
 
 def log_anomaly(metric_name, metric_value):
     """Log the anomaly details."""
@@ -83,112 +329,529 @@ def trigger_alert(metric_name, metric_value):
     print(f"Triggering alert: Metric: {metric_name}, Value: {metric_value}")
     # Example: Integrate with an alerting system (e.g., email, Slack, etc.)
 
-def prefill_metric_data(metrics):
-    """Pre-fill metric_values_dict with dummy data for testing."""
-    for metric_name in metrics:
-        if metric_name not in metric_values_dict:
-            metric_values_dict[metric_name] = [1.0] * WINDOW_SIZE  # Pre-fill with dummy values
+def prefill_metric_data(windows, keys):
+    """Pre-fill windows with dummy data for testing."""
+    for key in keys:
+        if key not in windows:
+            for _ in range(WINDOW_SIZE):
+                windows.append(key, 1.0)  # Pre-fill with dummy values
+
+def report_activity(selected, detected):
+    """Tell the poll scheduler how active each polled metric was, going by its most active series."""
+    scored = [series_id for series_id, _ in selected if series_id in detected]
+    levels = activity_levels(metric_windows.matrix(scored), [detected[series_id] for series_id in scored], VOLATILE_SCORE)
+    series_ids = scored + [series_id for series_id, _ in selected if series_id not in detected]
+    # Series still filling their window count as volatile so they fill at the fastest rate.
+    levels = levels.tolist() + [
+        STABLE if metric_windows.is_full(series_id) else VOLATILE for series_id in series_ids[len(scored):]
+    ]
+    poll_scheduler.report_many([series_index.metric_name(series_id) for series_id in series_ids], levels)
+
+def score_samples(samples):
+    """Add fetched samples to their series windows, score them and publish a new snapshot.
+
+    Runs on the detection engine thread, the only writer of the detection state.
+    Series that were not polled keep their previous result in the snapshot.
+    """
+    update_results(samples)
+    return publish_results()
+
+def publish_results():
+    record_windows(metric_windows)
+    snapshot = snapshots.publish(list(series_results.values()))
+    if SERVE_ROLE == "detector":
+        snapshot_writer.dispatch("snapshot", snapshot)
+    return snapshot
+
+def write_snapshot_file(snapshots):
+    """Share the newest snapshot with the worker processes."""
+    try:
+        write_snapshot(SNAPSHOT_FILE, snapshots[-1])
+    except OSError as e:
+        print(f"Exception while writing snapshot to {SNAPSHOT_FILE}: {e}")
+
+# Writes only the newest snapshot, in the background, so detection never waits on the file
+snapshot_writer = AnomalyDispatcher(
+    write_snapshot_file,
+    queue_size=1,
+    coalesce_window=0,
+    max_batch=1,
+    min_interval=0,
+    dedup_interval=0,
+    name="snapshot-file",
+)
+
+def update_results(samples):
+    """Add samples to their series windows and score them into series_results."""
+    selected = series_index.select(samples)
+    for series_id, metric_value in selected:
+        metric_windows.append(series_id, metric_value)
+    detected = detect_anomalies([series_id for series_id, _ in selected if metric_windows.is_full(series_id)])
+    report_activity(selected, detected)
+
+    for series_id, metric_value in selected:
+        if series_id in detected:
+            is_anomaly = detected[series_id]
+            health_status = "Unhealthy" if is_anomaly else "Healthy"
+        elif metric_windows.is_full(series_id):
+            is_anomaly = False  # Detection is disabled for this metric by DETECTOR_RULES
+            health_status = "Not monitored"
+        else:
+            is_anomaly = False  # Default to no anomaly if insufficient data
+            health_status = "Insufficient data"
+        store_result(series_id, metric_value, health_status, is_anomaly)
+
+def update_aggregate_results(series_statistics):
+    """Score (labels, (value, mean, std, low, high)) from Prometheus into series_results.
+
+    Server window mode: the statistics replace windows, so only the z-score
+    check applies; metrics DETECTOR_RULES disables are not monitored.
+    """
+    selected = series_index.select([(labels, statistics[0]) for labels, statistics in series_statistics])
+    statistics_by_id = {series_index.get(labels): statistics for labels, statistics in series_statistics}
+    monitored = [
+        series_id for series_id, _ in selected
+        if detector_policy.for_metric(series_index.metric_name(series_id)) is not None
+    ]
+    matrix = np.array([statistics_by_id[series_id] for series_id in monitored]).reshape(-1, len(WindowAggregates.STATISTICS))
+    values, means, stds, lows, highs = matrix.T
+    flags, scores = evaluate_aggregates(values, means, stds, STD_DEV_THRESHOLD, lows, highs)
+    levels = np.where(flags, ANOMALOUS, np.where(scores > VOLATILE_SCORE, VOLATILE, STABLE))
+    poll_scheduler.report_many([series_index.metric_name(series_id) for series_id in monitored], levels.tolist())
+
+    detected = dict(zip(monitored, flags.tolist()))
+    for series_id, metric_value in selected:
+        if series_id in detected:
+            is_anomaly = detected[series_id]
+            store_result(series_id, metric_value, "Unhealthy" if is_anomaly else "Healthy", is_anomaly)
+        else:
+            store_result(series_id, metric_value, "Not monitored", False)
+
+def score_aggregates(series_statistics):
+    """Score window statistics fetched from Prometheus and publish a new snapshot, on the detection engine thread."""
+    update_aggregate_results(series_statistics)
+    return publish_results()
+
+def store_result(series_id, metric_value, health_status, is_anomaly):
+    """Record the latest health result of a series, reporting it first if it is anomalous."""
+    if is_anomaly:
+        series_name = series_index.describe(series_id)
+        print(f"Anomaly detected for {series_name}: {metric_value}")
+        log_anomaly(series_name, metric_value)
+        send_to_agent(series_name, metric_value)
+        trigger_alert(series_name, metric_value)
+    series_results[series_id] = {
+        "metric_name": series_index.metric_name(series_id),
+        "labels": series_index.labels(series_id),
+        "metric_value": metric_value,
+        "health_status": health_status,
+        "anomaly_detected": is_anomaly,
+        "refreshed_at": time.time(),
+    }
+
+def ingest_series(series_values):
+    """Add pushed (labels, values) to the windows and score each series' newest value.
+
+    Runs on the detection engine thread. All but the newest value only fill
+    the window; the newest is scored like a polled sample.
+    """
+    # Admit new series under the cardinality limits before filling their windows.
+    series_index.select([(labels, values[-1]) for labels, values in series_values])
+    latest = []
+    for labels, values in series_values:
+        series_id = series_index.get(labels)
+        if series_id is None:
+            continue
+        for value in values[:-1]:
+            metric_windows.append(series_id, value)
+        latest.append((labels, values[-1]))
+    update_results(latest)
+
+def forget_metrics(metric_names):
+    """Drop the series of the given metrics with their windows, models and results."""
+    for metric_name in metric_names:
+        for series_id in series_index.series_ids(metric_name):
+            series_index.remove(series_id)
+            metric_windows.remove(series_id)
+            model_registry.remove(series_id)
+            series_results.pop(series_id, None)
+    publish_results()
+
+def run_monitoring_cycle(metrics=None, matchers=None):
+    """Fetch the given metrics (all available ones by default) and have the detection engine score them.
+
+    With `matchers`, only the series carrying those labels are fetched and scored.
+    When WINDOW_MODE is "server", Prometheus computes the window statistics.
+    """
+    with cycle_lock, cycle_profiler.profile(), CYCLE_SECONDS.time():
+        if metrics is None:
+            metrics = get_all_metrics()
+        if WINDOW_MODE == "server":
+            return engine.submit(score_aggregates, fetch_all_aggregates(metrics, matchers)).result()
+        samples = fetch_all_metric_data(metrics, matchers)
+        return engine.submit(score_samples, samples).result()
+
+def get_snapshot(max_staleness=None, matchers=None):
+    """Return the latest snapshot, running a cycle first if there is none or it is too old.
+
+    Staleness is that of the series matching `matchers`, and the cycle only
+    refreshes those series, so other series keep their own (older) age.
+    Workers never poll: they return None instead, and the request is
+    forwarded to the detector.
+    """
+    snapshot = snapshots.current()
+    if snapshot is not None and (max_staleness is None or snapshot.age(matchers) <= max_staleness):
+        return snapshot
+    if SERVE_ROLE == "worker":
+        return None
+    with cycle_lock:
+        # Another request may have refreshed the snapshot while we waited for the lock.
+        snapshot = snapshots.current()
+        if snapshot is not None and (max_staleness is None or snapshot.age(matchers) <= max_staleness):
+            return snapshot
+        return run_monitoring_cycle(matchers=matchers)
+
+def checkpoint_models():
+    # Models fitted in scoring workers are not checkpointed; they refit from the restored windows.
+    return model_registry if CHECKPOINT_MODELS and scoring_executor is None else None
+
+def write_checkpoint():
+    """Checkpoint windows and models to CHECKPOINT_DIR on the detection engine thread."""
+    path = engine.submit(
+        save_checkpoint, CHECKPOINT_DIR, metric_windows, checkpoint_models(), series_index
+    ).result()
+    print(f"Checkpoint written to {path}")
+
+def warm_start():
+    """Restore the last checkpoint; the first discovery then backfills the metrics it lacks."""
+    if CHECKPOINT_INTERVAL:
+        saved_at = engine.submit(
+            load_checkpoint, CHECKPOINT_DIR, metric_windows, checkpoint_models(), series_index
+        ).result()
+        if saved_at is not None:
+            print(f"Restored checkpoint saved at {time.ctime(saved_at)}")
+
+def backfill_metrics(metrics):
+    """Fill the windows of metrics without tracked series from Prometheus history."""
+    missing = engine.submit(lambda: [m for m in metrics if not series_index.series_ids(m)]).result()
+    if missing:
+        series_values = fetch_backfill(collector, missing, WINDOW_SIZE, FETCH_INTERVAL)
+        filled = engine.submit(fill_windows, metric_windows, series_index, series_values).result()
+        print(f"Backfilled windows for {filled} series of {len(missing)} metrics.")
 
 def monitoring_agent():
     """Background thread to monitor Prometheus metrics for anomalies."""
-    while True:
-        metrics = get_all_metrics()
-        for metric_name in metrics:
-            metric_value = fetch_metric_data(metric_name)
-            if metric_value is not None:
-                if metric_name not in metric_values_dict:
-                    metric_values_dict[metric_name] = []
-                metric_values_dict[metric_name].append(metric_value)
-                if len(metric_values_dict[metric_name]) > WINDOW_SIZE:
-                    metric_values_dict[metric_name].pop(0)
-                if len(metric_values_dict[metric_name]) == WINDOW_SIZE:
-                    is_anomaly = check_for_anomalies(metric_name, metric_values_dict[metric_name])
-                    if is_anomaly:
-                        print(f"Anomaly detected for {metric_name}: {metric_value}")
-                        log_anomaly(metric_name, metric_value)
-                        send_to_agent(metric_name, metric_value)
-                        trigger_alert(metric_name, metric_value)
-        time.sleep(FETCH_INTERVAL)
+    try:
+        warm_start()
+    except Exception as e:
+        print(f"Exception while warm starting windows: {e}")
+    last_checkpoint = time.monotonic()
+    while not stopping.is_set():
+        # With remote write, samples arrive through /api/v1/write and nothing is ever scheduled for polling.
+        if INGEST_MODE == "poll":
+            discovery.metrics()  # Refreshes once the cache expires, adding and removing scheduled metrics
+        due = poll_scheduler.due()
+        if due:
+            try:
+                run_monitoring_cycle(due)
+            except Exception as e:
+                print(f"Exception in monitoring cycle: {e}")
+        if CHECKPOINT_INTERVAL and time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+            try:
+                write_checkpoint()
+            except Exception as e:
+                print(f"Exception while writing checkpoint: {e}")
+            last_checkpoint = time.monotonic()
+        wait = poll_scheduler.wait_time()
+        if INGEST_MODE == "poll":
+            wait = min(FETCH_INTERVAL if wait is None else wait, discovery.expires_in())
+        time.sleep((FETCH_INTERVAL if wait is None else wait) + 0.01)
 
 def get_all_metrics():
-    """Fetch all available metric names from Prometheus."""
+    """Metric names to monitor, from the discovery cache."""
+    return discovery.metrics()
+
+# Set when the process is shutting down; the monitoring agent starts no further cycles
+stopping = threading.Event()
+
+def start_background():
+    """Start detection: the engine, anomaly delivery and the monitoring agent thread."""
+    if SERVE_ROLE == "detector":
+        # A snapshot left by an earlier detector would be served as current until the first cycle.
+        if os.path.exists(SNAPSHOT_FILE):
+            os.remove(SNAPSHOT_FILE)
+        snapshot_writer.start()
+    print("Starting the detection engine...")
+    engine.start()
+    dispatcher.start()
+    print("Starting the monitoring agent...")
+    monitoring_thread = threading.Thread(target=monitoring_agent, name="monitoring-agent", daemon=True)
+    monitoring_thread.start()
+    print("Monitoring agent started.")
+
+def shutdown(timeout=SHUTDOWN_TIMEOUT):
+    """Stop detection, flushing in-flight work.
+
+    Waits for the running cycle, checkpoints, lets the engine finish its
+    queued work (e.g. remote write batches) and delivers pending anomalies
+    and the last snapshot.
+    """
+    print("Shutting down the monitoring agent...")
+    stopping.set()
+    if cycle_lock.acquire(timeout=timeout):
+        cycle_lock.release()
+    else:
+        print(f"Monitoring cycle still running after {timeout}s")
+    if CHECKPOINT_INTERVAL:
+        try:
+            write_checkpoint()
+        except Exception as e:
+            print(f"Exception while writing checkpoint: {e}")
+    engine.stop(timeout)
+    dispatcher.close(timeout)
+    simulation_dispatcher.close(timeout)
+    snapshot_writer.close(timeout)
+    print("Shutdown complete.")
+
+# Endpoints workers serve from SNAPSHOT_FILE; everything else needs the detector's state
+WORKER_ENDPOINTS = {"check_health", "check_health_batch"}
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "host"}
+detector_session = requests.Session()
+
+def needs_detector():
+    """Whether a worker has to forward this request because it needs more than the shared snapshot."""
+    if request.endpoint not in WORKER_ENDPOINTS:
+        return True
+    snapshot = snapshots.current()
+    if snapshot is None:
+        return True  # The detector runs a cycle for the first request
+    if request.endpoint == "check_health":
+        if request.args.get('simulate_anomaly', 'false').lower() == 'true':
+            return True
+        max_staleness = request.args.get('max_staleness', type=float)
+        appid = request.args.get('appid')
+        return max_staleness is not None and bool(appid) and snapshot.age(app_selector(appid)) > max_staleness
+    return False
+
+@app.before_request
+def forward_to_detector():
+    """In worker processes, proxy requests that need detection state to the detector process."""
+    if SERVE_ROLE != "worker" or not needs_detector():
+        return None
+    return forward_request()
+
+def forward_request():
+    """Proxy the current request to the detector process and return its response."""
+    headers = {name: value for name, value in request.headers if name.lower() not in HOP_BY_HOP_HEADERS}
     try:
-        response = requests.get(f"{PROMETHEUS_URL}/api/v1/label/__name__/values")
-        if response.status_code == 200:
-            return response.json().get("data", [])
-        else:
-            print(f"Error fetching metrics: {response.text}")
-            return []
-    except Exception as e:
-        print(f"Exception while fetching metrics: {e}")
-        return []
+        response = detector_session.request(
+            request.method, f"{DETECTOR_URL}{request.full_path}", data=request.get_data(), headers=headers,
+            timeout=DETECTOR_TIMEOUT, stream=True,
+        )
+        # Pass the body through as sent, e.g. still gzipped.
+        body = response.raw.read(decode_content=False)
+    except requests.exceptions.RequestException as e:
+        print(f"Exception while forwarding {request.path} to the detector: {e}")
+        return jsonify({"error": "Detector unavailable"}), 503
+    headers = [(name, value) for name, value in response.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS]
+    return app.response_class(body, status=response.status_code, headers=headers)
 
-@app.route('/check_health', methods=['GET'])
-def check_health():
-    """Endpoint to check the health of all available metrics."""
-    appid = request.args.get('appid')
-    simulate_anomaly = request.args.get('simulate_anomaly', 'false').lower() == 'true'
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus metrics about the detection pipeline itself."""
+    body, content_type = render_metrics()
+    return app.response_class(body, content_type=content_type)
 
-    if not appid:
-        return jsonify({"error": "appid is required"}), 400
+@app.route('/model_stats', methods=['GET'])
+def model_stats():
+    """Endpoint reporting model ages and retrain counts for tuning the retrain policy."""
+    def collect_stats():
+        stats = scoring_executor.stats() if scoring_executor is not None else model_registry.stats()
+        cascade = detectors["cascade"]
+        stats["cascade_model_runs"] = cascade.model_runs
+        stats["cascade_skipped"] = cascade.skipped
+        return stats
+    return jsonify(engine.submit(collect_stats).result())
+
+def capture_payload(body):
+    """Save a raw remote write body so replay_remote_write.py can send it again later."""
+    os.makedirs(REMOTE_WRITE_CAPTURE_DIR, exist_ok=True)
+    with open(os.path.join(REMOTE_WRITE_CAPTURE_DIR, f"{time.time_ns()}.pb.snappy"), "wb") as f:
+        f.write(body)
 
-    # Fetch all available metrics
+@app.route('/api/v1/write', methods=['POST'])
+def remote_write():
+    """Prometheus remote_write receiver.
+
+    Decodes the snappy-compressed protobuf in batches that are fed to the
+    detection engine as they are decoded. Responds once everything is
+    ingested, so each Prometheus shard sends no faster than detection keeps
+    up, and with 429 while the engine queue is backed up.
+    """
+    if engine.queue_depth() >= REMOTE_WRITE_MAX_PENDING:
+        response = jsonify({"error": "Detection is behind, retry later"})
+        response.status_code = 429
+        response.headers["Retry-After"] = str(FETCH_INTERVAL)
+        return response
+
+    body = request.get_data()
+    if REMOTE_WRITE_CAPTURE_DIR:
+        try:
+            capture_payload(body)
+        except OSError as e:
+            print(f"Exception while capturing remote write payload: {e}")
+
+    futures = []
+    try:
+        for batch in iter_series(body, REMOTE_WRITE_BATCH_SIZE):
+            futures.append(engine.submit(ingest_series, batch, timeout=REMOTE_WRITE_TIMEOUT))
+        futures.append(engine.submit(publish_results, timeout=REMOTE_WRITE_TIMEOUT))
+    except RemoteWriteError as e:
+        # Prometheus does not retry 4xx responses, which is right for a payload that cannot be decoded.
+        return jsonify({"error": f"Invalid remote write payload: {e}"}), 400
+    except queue.Full:
+        return jsonify({"error": "Detection engine queue is full"}), 503
+    for future in futures:
+        future.result()
+    return "", 204
+
+@app.route('/shards/<int:shard_id>', methods=['POST'])
+def receive_shard_snapshot(shard_id):
+    """Store the latest health snapshot pushed by one replica of a sharded polling agent."""
+    snapshot = request.get_json(silent=True)
+    if not isinstance(snapshot, dict) or not isinstance(snapshot.get("metrics"), list):
+        return jsonify({"error": "Expected a JSON object with a metrics list"}), 400
+    shard_count = snapshot.get("shard_count")
+    if not isinstance(shard_count, int) or not 0 <= shard_id < shard_count:
+        return jsonify({"error": f"Shard {shard_id} is outside shard_count {shard_count}"}), 400
+    snapshot["received_at"] = time.time()
+    with shard_lock:
+        shard_snapshots[shard_id] = snapshot
+    return "", 204
+
+@app.route('/cluster_health', methods=['GET'])
+def cluster_health():
+    """Endpoint merging the latest snapshots of all shards, with missing and stale shards listed."""
+    with shard_lock:
+        snapshots = dict(shard_snapshots)
+    return jsonify(merge_snapshots(snapshots, time.time(), SHARD_STALE_AFTER))
+
+@app.route('/poll_stats', methods=['GET'])
+def poll_stats():
+    """Endpoint reporting how many metrics are polled at each interval."""
+    return jsonify(dict(poll_scheduler.stats(), discovery=discovery.stats()))
+
+@app.route('/dispatch_stats', methods=['GET'])
+def dispatch_stats():
+    """Endpoint reporting anomaly dispatch counters (sent, coalesced, deduplicated, dropped)."""
+    return jsonify(dict(dispatcher.stats(), simulated=simulation_dispatcher.stats()))
+
+def simulate_health(appid):
+    """Run a live check over all metrics, reporting every metric as anomalous for demos.
+
+    Uses a scratch window store so simulated data never reaches live detection,
+    and its own dispatcher so simulated anomalies never suppress or drop live ones.
+    """
     all_metrics = get_all_metrics()
     if not all_metrics:
         return jsonify({"error": "No metrics available in Prometheus"}), 404
+    matchers = app_selector(appid)
 
-    # Pre-fill data if simulate_anomaly is enabled
-    if simulate_anomaly:
-        print("Simulating anomalies: Pre-filling metric data for demo purposes.")
-        prefill_metric_data(all_metrics)
+    print("Simulating anomalies: Pre-filling metric data for demo purposes.")
+    scratch_index = SeriesIndex(max_series_per_metric=MAX_SERIES_PER_METRIC, max_series=MAX_SERIES)
+    scratch_windows = WindowStore(WINDOW_SIZE, capacity=len(all_metrics))
 
-    # Analyze each metric
     results = []
-    for metric_name in all_metrics:
-        metric_value = fetch_metric_data(metric_name)
-        if metric_value is not None:
-            if metric_name not in metric_values_dict:
-                metric_values_dict[metric_name] = []
-            metric_values_dict[metric_name].append(metric_value)
-            if len(metric_values_dict[metric_name]) > WINDOW_SIZE:
-                metric_values_dict[metric_name].pop(0)
-
-            # Simulate anomaly if the flag is set
-            if simulate_anomaly:
-                print(f"Simulating anomaly for metric: {metric_name}")
-                is_anomaly = True
-                health_status = "Unhealthy"
-                log_anomaly(metric_name, metric_value)
-                send_to_agent(metric_name, metric_value)
-            elif len(metric_values_dict[metric_name]) == WINDOW_SIZE:
-                is_anomaly = check_for_anomalies(metric_name, metric_values_dict[metric_name])
-                health_status = "Unhealthy" if is_anomaly else "Healthy"
-                if is_anomaly:
-                    log_anomaly(metric_name, metric_value)
-                    send_to_agent(metric_name, metric_value)
-            else:
-                is_anomaly = False  # Default to no anomaly if insufficient data
-                health_status = "Insufficient data"
-
-            results.append({
-                "metric_name": metric_name,
-                "metric_value": metric_value,
-                "health_status": health_status,
-                "anomaly_detected": is_anomaly
-            })
+    selected = scratch_index.select(fetch_all_metric_data(all_metrics, matchers))
+    prefill_metric_data(scratch_windows, [series_id for series_id, _ in selected])
+    for series_id, metric_value in selected:
+        scratch_windows.append(series_id, metric_value)
+        series_name = scratch_index.describe(series_id)
+        print(f"Simulating anomaly for metric: {series_name}")
+        log_anomaly(series_name, metric_value)
+        send_simulated_to_agent(series_name, metric_value)
+        results.append({
+            "metric_name": scratch_index.metric_name(series_id),
+            "labels": scratch_index.labels(series_id),
+            "metric_value": metric_value,
+            "health_status": "Unhealthy",
+            "anomaly_detected": True
+        })
 
     if not results:
-        return jsonify({"error": "No valid data found for metrics"}), 404
+        return jsonify({"error": f"No series found for appid {appid} ({matchers})"}), 404
 
     return jsonify({"appid": appid, "metrics": results})
 
+@app.route('/check_health', methods=['GET'])
+def check_health():
+    """Endpoint to check the health of one application's series.
+
+    Serves the series of the latest snapshot published by the monitoring
+    agent that match the appid's selector (see app_selector). `max_staleness`
+    (seconds) forces a fresh cycle of the application's series when the
+    snapshot is older than that. `limit` and `offset` page through the
+    series; follow `next_offset` until it is null.
+    """
+    appid = request.args.get('appid')
+    simulate_anomaly = request.args.get('simulate_anomaly', 'false').lower() == 'true'
+    max_staleness = request.args.get('max_staleness', type=float)
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', type=int)
+
+    if not appid:
+        return jsonify({"error": "appid is required"}), 400
+    if offset < 0 or (limit is not None and not 0 < limit <= MAX_PAGE_SIZE):
+        return jsonify({"error": f"offset must be >= 0 and limit between 1 and {MAX_PAGE_SIZE}"}), 400
+
+    if simulate_anomaly:
+        return simulate_health(appid)
+
+    matchers = app_selector(appid)
+    snapshot = get_snapshot(max_staleness, matchers)
+    if snapshot is None:
+        return forward_request()  # A worker whose snapshot went stale or missing since before_request
+    if not snapshot.select(matchers):
+        return jsonify({"error": f"No valid data found for appid {appid} ({matchers})"}), 404
+
+    if request.if_none_match.contains_weak(snapshot.etag):
+        response = app.response_class(status=304)
+    else:
+        compress = GZIP_RESPONSES and request.accept_encodings["gzip"] > 0
+        body = snapshot.render(appid, compress, matchers, offset, limit)
+        response = app.response_class(body, mimetype="application/json")
+        if compress:
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(snapshot.etag, weak=True)
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+@app.route('/check_health/batch', methods=['POST'])
+def check_health_batch():
+    """Endpoint returning the health of many applications, from one snapshot, for {"appids": [...]}."""
+    appids = (request.get_json(silent=True) or {}).get("appids")
+    if not isinstance(appids, list) or not appids or not all(isinstance(appid, str) and appid for appid in appids):
+        return jsonify({"error": "appids must be a non-empty list of strings"}), 400
+    if len(appids) > MAX_BATCH_APPIDS:
+        return jsonify({"error": f"At most {MAX_BATCH_APPIDS} appids per request"}), 400
+
+    snapshot = get_snapshot()
+    if snapshot is None:
+        return forward_request()  # A worker whose snapshot went missing since before_request
+    results = {}
+    for appid in appids:
+        selector = app_selector(appid)
+        metrics = snapshot.select(selector)
+        results[appid] = {"generated_at": snapshot.refreshed_at(selector), "total": len(metrics), "metrics": list(metrics)}
+    return jsonify({"version": snapshot.version, "generated_at": snapshot.refreshed_at(), "results": results})
+
 if __name__ == "__main__":
-    print("Starting the monitoring agent...")
-    # Start the monitoring agent in a background thread
-    monitoring_thread = threading.Thread(target=monitoring_agent, daemon=True)
-    monitoring_thread.start()
-    print("Monitoring agent started.")
+    # Development server; run serve.py in production
+    start_background()
 
     print("Starting the Flask app...")
-    # Start the Flask app
-    app.run(host='0.0.0.0', port=6075, debug=True)
\ No newline at end of file
+    try:
+        # The reloader would run this module twice, and with it a second monitoring agent.
+        app.run(host='0.0.0.0', port=API_PORT, debug=DEBUG, use_reloader=False)
+    finally:
+        shutdown()
\ No newline at end of file
@@ -0,0 +1,39 @@
+import threading
+
+
+class CodeExecutorAgent:
+    """The autogen code executor agent, imported and built on its first message.
+
+    Importing autogen takes seconds, so scripts create this at module level
+    and only pay for it once an anomaly is actually sent; processes that
+    never send one (detection-only runs, API workers) never import autogen.
+    """
+
+    def __init__(self, work_dir, timeout=10):
+        self.work_dir = work_dir
+        self.timeout = timeout
+        self._agent = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._agent is not None
+
+    def agent(self):
+        """The ConversableAgent, created on the first call."""
+        with self._lock:
+            if self._agent is None:
+                from autogen import ConversableAgent
+                from autogen.coding import LocalCommandLineCodeExecutor
+
+                executor = LocalCommandLineCodeExecutor(timeout=self.timeout, work_dir=self.work_dir)
+                self._agent = ConversableAgent(
+                    "code_executor_agent",
+                    llm_config=False,  # Turn off LLM for this agent.
+                    code_execution_config={"executor": executor},
+                    human_input_mode="NEVER",
+                )
+            return self._agent
+
+    def handle_message(self, message):
+        return self.agent().handle_message(message)
@@ -0,0 +1,143 @@
+import math
+import time
+
+from .prometheus import chunk_metric_names, label_matchers
+
+AGGREGATE_CHUNK_SIZE = 20  # Metric names per aggregate query; each name adds a term per statistic
+METADATA_TTL = 300  # Seconds before metric types are looked up again for names not seen yet
+COUNTER_SUFFIXES = ("_total",)  # Names taken for counters when Prometheus has no metadata for them
+HISTOGRAM_SUFFIXES = ("_bucket", "_count", "_sum")  # Counter series of histograms and summaries
+
+
+class AggregateResult:
+    """Outcome of one aggregate fetch."""
+
+    def __init__(self):
+        self.series = []  # (labels, (value, mean, std, low, high)) for every series with all statistics
+        self.skipped = []  # Metric names not fetched before the cycle deadline
+        self.failed = []  # Metric names whose queries failed after all retries
+
+
+class WindowAggregates:
+    """Window statistics per series computed by Prometheus instead of client-side windows.
+
+    For each series, Prometheus returns the latest value and the mean,
+    standard deviation and `quantiles` (low, high) over the last `window`
+    seconds, so a cycle transfers five numbers per series and nothing is
+    kept between cycles. Counters are detected from the metric metadata
+    (or a `_total` suffix when Prometheus has none) and replaced by their
+    per-second rate over `rate_window` seconds, with the statistics taken
+    over a subquery of that rate at `step` resolution; their raw values only
+    ever grow, so they would otherwise always look anomalous.
+    """
+
+    STATISTICS = ("value", "mean", "std", "low", "high")
+
+    def __init__(self, collector, window, step, rate_window, quantiles=(0.05, 0.95),
+                 chunk_size=AGGREGATE_CHUNK_SIZE, metadata_ttl=METADATA_TTL, clock=time.monotonic):
+        self.collector = collector
+        self.window = int(window)
+        self.step = int(step)
+        self.rate_window = int(rate_window)
+        self.quantiles = quantiles
+        self.chunk_size = chunk_size
+        self.metadata_ttl = metadata_ttl
+        self.clock = clock
+        self._types = {}  # Metric name -> type from /api/v1/metadata
+        self._looked_up = set()  # Names the last metadata lookups covered
+        self._types_expire_at = None
+
+    def _refresh_types(self, metric_names):
+        try:
+            body = self.collector.request("GET", "/api/v1/metadata")
+            self._types = {
+                metric_name: entries[0].get("type")
+                for metric_name, entries in body.get("data", {}).items() if entries
+            }
+        except Exception as e:
+            print(f"Exception while fetching metric metadata: {e}")
+        self._looked_up.update(metric_names)
+        self._types_expire_at = self.clock() + self.metadata_ttl
+
+    def metric_type(self, metric_name):
+        """Metadata type of a metric name, looking through the suffixes of histogram and summary series."""
+        metric_type = self._types.get(metric_name)
+        if metric_type is None:
+            for suffix in HISTOGRAM_SUFFIXES:
+                base = metric_name[:-len(suffix)]
+                if metric_name.endswith(suffix) and self._types.get(base) in ("histogram", "summary"):
+                    return "counter"
+        return metric_type
+
+    def is_counter(self, metric_name):
+        metric_type = self.metric_type(metric_name)
+        if metric_type is None or metric_type == "unknown":
+            return metric_name.endswith(COUNTER_SUFFIXES)
+        return metric_type == "counter"
+
+    def _expressions(self, metric_name, matchers):
+        """PromQL per statistic for one metric name."""
+        selector = f"{metric_name}{{{label_matchers(matchers)}}}" if matchers else metric_name
+        if self.is_counter(metric_name):
+            value = f"rate({selector}[{self.rate_window}s])"
+            samples = f"{value}[{self.window}s:{self.step}s]"
+        else:
+            value = selector
+            samples = f"{selector}[{self.window}s]"
+        low, high = self.quantiles
+        return {
+            "value": value,
+            "mean": f"avg_over_time({samples})",
+            "std": f"stddev_over_time({samples})",
+            "low": f"quantile_over_time({low}, {samples})",
+            "high": f"quantile_over_time({high}, {samples})",
+        }
+
+    def queries(self, metric_names, matchers=None):
+        """One query per statistic and chunk of metric names, as (chunk, statistic, query).
+
+        Functions drop the metric name, so each term puts it back with
+        label_replace; that keeps the series of all names in a chunk apart.
+        """
+        unknown = [metric_name for metric_name in metric_names if metric_name not in self._looked_up]
+        if unknown and (self._types_expire_at is None or self.clock() >= self._types_expire_at):
+            self._refresh_types(unknown)
+        queries = []
+        for chunk in chunk_metric_names(metric_names, self.chunk_size):
+            expressions = [self._expressions(metric_name, matchers) for metric_name in chunk]
+            for statistic in self.STATISTICS:
+                query = " or ".join(
+                    f'label_replace({terms[statistic]}, "__name__", "{metric_name}", "", "")'
+                    for metric_name, terms in zip(chunk, expressions)
+                )
+                queries.append((chunk, statistic, query))
+        return queries
+
+    def fetch(self, metric_names, matchers=None):
+        """Fetch the statistics of every series of the given metrics (that match `matchers`)."""
+        queries = self.queries(metric_names, matchers)
+        results = self.collector.query_all([query for _, _, query in queries])
+        result = AggregateResult()
+        statistics = {}  # Label key -> {statistic: value}
+        labels_by_key = {}
+        lost = {}  # Metric names of chunks with a failed or skipped query -> the list to report them in
+        for (chunk, statistic, _), (outcome, series) in zip(queries, results):
+            if outcome != "ok":
+                for metric_name in chunk:
+                    lost.setdefault(metric_name, result.skipped if outcome == "skipped" else result.failed)
+                continue
+            for item in series:
+                labels = item.get("metric", {})
+                key = tuple(sorted(labels.items()))
+                labels_by_key[key] = labels
+                statistics.setdefault(key, {})[statistic] = float(item["value"][1])
+        for metric_name, names in lost.items():
+            names.append(metric_name)
+        for key, values in statistics.items():
+            # A counter needs two samples for a rate and any series one for a std dev; skip those that lack one.
+            if len(values) < len(self.STATISTICS) or labels_by_key[key].get("__name__") in lost:
+                continue
+            values = tuple(values[statistic] for statistic in self.STATISTICS)
+            if all(math.isfinite(value) for value in values):
+                result.series.append((labels_by_key[key], values))
+        return result
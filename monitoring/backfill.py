@@ -0,0 +1,35 @@
+import math
+import time
+
+BACKFILL_CHUNK_SIZE = 50  # Metric names per range query; each returns a full window per series
+
+
+def fetch_backfill(collector, metric_names, window_size, step, chunk_size=BACKFILL_CHUNK_SIZE):
+    """Fetch the last window_size points of every metric at the poll step.
+
+    The range end is aligned to a multiple of step so the points line up with
+    the samples live polling would have taken.
+    """
+    end = math.floor(time.time() / step) * step
+    start = end - step * (window_size - 1)
+    return collector.fetch_ranges(metric_names, start, end, step, chunk_size)
+
+
+def fill_windows(windows, series_index, series_values):
+    """Append backfilled values to the windows, returning how many series were filled.
+
+    Series are admitted through the index by their latest value, so the
+    cardinality limits apply exactly as they do to live samples.
+    """
+    latest = [(labels, values[-1]) for labels, values in series_values if values]
+    series_ids = series_index.select(latest)
+    values_by_labels = {series_index.get(labels): values for labels, values in series_values if values}
+    filled = 0
+    for series_id, _ in series_ids:
+        values = values_by_labels.get(series_id)
+        if values is None:
+            continue
+        for value in values[-windows.window_size:]:
+            windows.append(series_id, value)
+        filled += 1
+    return filled
@@ -0,0 +1,256 @@
+import itertools
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .detectors import evaluate_batch
+from .export import series_key
+from .model_registry import ModelRegistry
+
+# Replays recorded series through the detection code as the agents run it:
+# each series' samples arrive in order, a window holds its last window_size
+# samples (gaps are skipped, as live polling never sees them), and the
+# newest sample of every full window is scored. Time only advances with the
+# samples, so a replay takes as long as the detection work itself.
+BLOCK_SAMPLES = 4_000_000  # Window values materialised at once by the z-score replay
+DETECTORS = ("zscore", "isolation_forest", "zscore+isolation_forest")  # The last is executeScript.py's check
+
+
+class Recording:
+    """Recorded series flattened to one array of their present samples, series after series.
+
+    `values` is a (series x step) matrix with NaN where a series has no
+    sample, and `anomalies` an optional matrix of the same shape that is True
+    for labelled anomalous samples.
+    """
+
+    def __init__(self, labels, timestamps, values, anomalies=None):
+        values = np.asarray(values, dtype=float)
+        present = ~np.isnan(values)
+        self.labels = labels
+        self.timestamps = np.asarray(timestamps, dtype=float)
+        self.values = values[present]  # Row-major, so each series' samples are contiguous and in time order
+        self.series, self.steps = np.nonzero(present)
+        counts = present.sum(axis=1)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])  # Series s is values[offsets[s]:offsets[s + 1]]
+        self.positions = np.arange(len(self.values)) - self.offsets[self.series]  # Sample number within its series
+        self.times = self.timestamps[self.steps]
+        self.anomalies = None if anomalies is None else np.asarray(anomalies, dtype=bool)[present]
+        self.span_seconds = float(self.timestamps[-1] - self.timestamps[0]) if len(self.timestamps) else 0.0
+
+    def __len__(self):
+        return len(self.values)
+
+    def scored(self, window_size):
+        """Indexes of the samples that are the newest of a full window."""
+        return np.flatnonzero(self.positions >= window_size - 1)
+
+
+def zscore_scores(recording, window_size, thresholds):
+    """Flags per threshold (thresholds x samples) of the z-score check, and the CPU seconds it took.
+
+    Runs evaluate_batch on blocks of the windows of all series at once; the
+    window moments are computed once and shared by every threshold.
+    """
+    started = time.process_time()
+    flags = np.zeros((len(thresholds), len(recording)), dtype=bool)
+    scored = recording.scored(window_size)
+    windows = sliding_window_view(recording.values, window_size)  # Row i ends at sample i + window_size - 1
+    block = max(1, BLOCK_SAMPLES // window_size)
+    for first in range(0, len(scored), block):
+        newest = scored[first:first + block]
+        matrix = windows[newest - (window_size - 1)]
+        means = matrix.mean(axis=1)
+        stds = matrix.std(axis=1)
+        for t, threshold in enumerate(thresholds):
+            flags[t, newest] = evaluate_batch(matrix, threshold, means, stds)[0]
+    return flags, time.process_time() - started
+
+
+def isolation_forest_flags(recording, window_size, contamination, registry_kwargs):
+    """Flags of the per-series IsolationForest check, and the CPU seconds it took.
+
+    Models come from a ModelRegistry with the live retrain policy, on a
+    clock that follows the sample timestamps. The newest values scored by
+    the same model are predicted in one call instead of one at a time.
+    """
+    started = time.process_time()
+    flags = np.zeros(len(recording), dtype=bool)
+    now = [0.0]
+    registry = ModelRegistry(
+        contamination=contamination,
+        max_models=len(recording.offsets),
+        seed_by_series=True,
+        clock=lambda: now[0],
+        **registry_kwargs,
+    )
+    windows = sliding_window_view(recording.values, window_size)
+    for series in range(len(recording.offsets) - 1):
+        first = recording.offsets[series] + window_size - 1
+        end = recording.offsets[series + 1]
+        if first >= end:
+            continue
+        matrix = windows[first - (window_size - 1):end - (window_size - 1)]
+        means = matrix.mean(axis=1)
+        stds = matrix.std(axis=1)
+        key = series_key(recording.labels[series])
+        model = None
+        run_start = 0  # First sample scored by `model`
+        for i in range(len(matrix) + 1):
+            if i < len(matrix):
+                now[0] = recording.times[first + i]
+                next_model = registry.get_model(key, matrix[i], means[i], stds[i])
+                if next_model is model:
+                    continue
+            else:
+                next_model = None
+            if model is not None:
+                newest = matrix[run_start:i, -1].reshape(-1, 1)
+                flags[first + run_start:first + i] = model.predict(newest) == -1
+            model = next_model
+            run_start = i
+    return flags, time.process_time() - started, registry.stats(include_series=False)
+
+
+class Scorer:
+    """Scores flags against labelled anomalies, counting each run of labelled samples of a series as one event.
+
+    A flag up to `tolerance` samples after an event still counts for it, as
+    a spike keeps its window's statistics raised. Detection latency is the
+    time from the first sample of an event to its first flag.
+    """
+
+    def __init__(self, recording, tolerance=0):
+        self.recording = recording
+        labelled = recording.anomalies
+        if labelled is None:
+            self.events = None
+            return
+        index = np.arange(len(labelled))
+        new_series = recording.positions == 0
+        previous = np.concatenate([[False], labelled[:-1]])
+        starts = labelled & (new_series | ~previous)
+        event_ids = np.cumsum(starts) - 1
+        self.events = int(starts.sum())
+        self.event_times = recording.times[starts]
+        # Each sample belongs to the event of the latest labelled sample of its series, if close enough.
+        last = np.maximum.accumulate(np.where(labelled, index, -1))
+        near = (last >= 0) & (index - np.maximum(last, 0) <= tolerance)
+        near &= recording.series[np.maximum(last, 0)] == recording.series
+        self.event_of = np.where(near, event_ids[np.maximum(last, 0)], -1)
+
+    def score(self, flags):
+        flagged = np.flatnonzero(flags)
+        result = {"alerts": len(flagged)}
+        if self.events is None:
+            return result
+        events = self.event_of[flagged]
+        hits = events >= 0
+        detected, first = np.unique(events[hits], return_index=True)
+        latencies = self.recording.times[flagged[hits][first]] - self.event_times[detected]
+        result.update({
+            "events": self.events,
+            "detected": len(detected),
+            "precision": float(hits.mean()) if len(flagged) else None,
+            "recall": len(detected) / self.events if self.events else None,
+            "latency_seconds": {
+                "mean": float(latencies.mean()),
+                "p50": float(np.percentile(latencies, 50)),
+                "p95": float(np.percentile(latencies, 95)),
+                "max": float(latencies.max()),
+            } if len(latencies) else None,
+        })
+        return result
+
+
+def _isolation_forest_job(recording, window_size, contamination, registry_kwargs):
+    flags, cpu_seconds, stats = isolation_forest_flags(recording, window_size, contamination, registry_kwargs)
+    return window_size, contamination, flags, cpu_seconds, stats
+
+
+def run_backtest(recording, window_sizes, thresholds, contaminations, detectors=DETECTORS, tolerance=0,
+                 registry_kwargs=None, workers=None):
+    """Replay the recording once per window size and report every detector and parameter combination.
+
+    The z-score check runs for all thresholds in one pass per window size.
+    IsolationForest replays, the slow part, run in `workers` processes, one
+    per (window size, contamination), and their flags are combined with
+    every threshold for the "zscore+isolation_forest" detector. Each config
+    reports the CPU seconds of the replays it needed, and the speedup over
+    real time that works out to.
+    """
+    registry_kwargs = dict(registry_kwargs or {})
+    scorer = Scorer(recording, tolerance)
+    models = [detector for detector in detectors if "isolation_forest" in detector]
+    forests = {}
+    if models:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [
+                pool.submit(_isolation_forest_job, recording, window_size, contamination,
+                            dict(registry_kwargs, retrain_every=registry_kwargs.get("retrain_every") or window_size))
+                for window_size, contamination in itertools.product(window_sizes, contaminations)
+            ]
+            for future in futures:
+                window_size, contamination, flags, cpu_seconds, stats = future.result()
+                forests[window_size, contamination] = (flags, cpu_seconds, stats)
+
+    results = []
+    for window_size in window_sizes:
+        samples = len(recording.scored(window_size))
+        zscores, zscore_seconds = zscore_scores(recording, window_size, thresholds)
+        configs = []
+        if "zscore" in detectors:
+            configs += [
+                ("zscore", threshold, None, zscores[t], zscore_seconds, None)
+                for t, threshold in enumerate(thresholds)
+            ]
+        for contamination in contaminations if models else []:
+            flags, forest_seconds, stats = forests[window_size, contamination]
+            if "isolation_forest" in detectors:
+                configs.append(("isolation_forest", None, contamination, flags, forest_seconds, stats))
+            if "zscore+isolation_forest" in detectors:
+                configs += [
+                    ("zscore+isolation_forest", threshold, contamination, flags | zscores[t],
+                     forest_seconds + zscore_seconds, stats)
+                    for t, threshold in enumerate(thresholds)
+                ]
+        for detector, threshold, contamination, flags, cpu_seconds, stats in configs:
+            result = {
+                "detector": detector,
+                "window_size": window_size,
+                "threshold": threshold,
+                "contamination": contamination,
+                "samples": samples,
+                "cpu_seconds": cpu_seconds,
+                "speedup": recording.span_seconds / cpu_seconds if cpu_seconds else None,
+            }
+            if stats is not None:
+                result["model_fits"] = stats["models"] + stats["total_retrains"]
+            result.update(scorer.score(flags))
+            results.append(result)
+    return results
+
+
+def load_anomalies(path, labels, timestamps):
+    """Labelled anomalies as a (series x step) mask, from a .npy mask or a JSON list of intervals.
+
+    Intervals are {"match": {label: value}, "start": unix time, "end": unix
+    time} and mark the steps between start and end of every series carrying
+    the matched labels.
+    """
+    if path.endswith(".npy"):
+        return np.load(path).astype(bool)
+    with open(path) as f:
+        intervals = json.load(f)
+    mask = np.zeros((len(labels), len(timestamps)), dtype=bool)
+    for interval in intervals:
+        rows = [
+            row for row, series_labels in enumerate(labels)
+            if all(series_labels.get(name) == value for name, value in interval.get("match", {}).items())
+        ]
+        steps = (timestamps >= interval["start"]) & (timestamps <= interval["end"])
+        mask[np.ix_(rows, np.flatnonzero(steps))] = True
+    return mask
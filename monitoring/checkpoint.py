@@ -0,0 +1,113 @@
+import json
+import os
+import pickle
+import shutil
+import time
+import numpy as np
+
+CHECKPOINT_FORMAT_VERSION = 2  # 2: windows keyed by series id, with the series index saved
+CURRENT_FILE = "CURRENT"  # Names the directory of the latest complete checkpoint
+WINDOW_ARRAYS = ("values", "heads", "counts", "means", "m2s")
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _model_header():
+    import sklearn
+    return {"format": CHECKPOINT_FORMAT_VERSION, "sklearn": sklearn.__version__}
+
+
+def save_checkpoint(directory, windows, model_registry=None, series_index=None):
+    """Write windows (and optionally fitted models and series labels) as a new checkpoint.
+
+    Everything is written to a fresh subdirectory and fsynced before the
+    CURRENT pointer is atomically replaced, so a crash at any point leaves
+    the previous checkpoint intact.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f"checkpoint-{time.time_ns()}"
+    path = os.path.join(directory, name)
+    os.makedirs(path)
+
+    arrays, rows = windows.state()
+    for array_name in WINDOW_ARRAYS:
+        with open(os.path.join(path, f"{array_name}.npy"), "wb") as f:
+            np.save(f, np.ascontiguousarray(arrays[array_name]))
+            f.flush()
+            os.fsync(f.fileno())
+    meta = {
+        "format": CHECKPOINT_FORMAT_VERSION,
+        "saved_at": time.time(),
+        "window_size": windows.window_size,
+        "rows": [[key, row] for key, row in rows.items()],
+        "series": series_index.state() if series_index is not None else None,
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if model_registry is not None:
+        with open(os.path.join(path, "models.pkl"), "wb") as f:
+            f.write(json.dumps(_model_header()).encode() + b"\n")
+            pickle.dump(model_registry.state(), f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+    _fsync_path(path)
+
+    pointer_tmp = os.path.join(directory, f"{CURRENT_FILE}.tmp")
+    with open(pointer_tmp, "w") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer_tmp, os.path.join(directory, CURRENT_FILE))
+    _fsync_path(directory)
+
+    # Older checkpoints are only removed once the new one is current.
+    for entry in os.listdir(directory):
+        if entry.startswith("checkpoint-") and entry != name:
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+    return path
+
+
+def load_checkpoint(directory, windows, model_registry=None, series_index=None):
+    """Restore the latest checkpoint into windows (and model_registry and series_index).
+
+    Window arrays are memory-mapped copy-on-write, so loading does not copy
+    them and later appends never modify the checkpoint on disk. Returns the
+    checkpoint's save time, or None if nothing was restored.
+    """
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            path = os.path.join(directory, f.read().strip())
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta.get("format") != CHECKPOINT_FORMAT_VERSION or meta.get("window_size") != windows.window_size:
+        print(f"Ignoring incompatible checkpoint at {path}")
+        return None
+
+    arrays = {
+        array_name: np.load(os.path.join(path, f"{array_name}.npy"), mmap_mode="c")
+        for array_name in WINDOW_ARRAYS
+    }
+    windows.restore(arrays, {key: row for key, row in meta["rows"]})
+    if series_index is not None and meta.get("series") is not None:
+        series_index.restore(meta["series"])
+
+    models_path = os.path.join(path, "models.pkl")
+    if model_registry is not None and os.path.exists(models_path):
+        with open(models_path, "rb") as f:
+            header = json.loads(f.readline())
+            if header == _model_header():
+                model_registry.restore(pickle.load(f))
+            else:
+                print(f"Ignoring models saved with {header}, running {_model_header()}")
+    return meta["saved_at"]
@@ -0,0 +1,204 @@
+import math
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import requests
+from requests.adapters import HTTPAdapter
+
+from .instrumentation import PROMETHEUS_REQUEST_ERRORS, PROMETHEUS_REQUEST_SECONDS
+from .prometheus import BATCH_CHUNK_SIZE, build_metric_selector, build_name_selector, chunk_metric_names
+from .series import parse_samples
+
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+class CycleResult:
+    """Outcome of one collection cycle."""
+
+    def __init__(self):
+        self.samples = []  # (labels, latest value) for every series returned
+        self.skipped = []  # Metric names not fetched before the cycle deadline
+        self.failed = []  # Metric names whose requests failed after all retries
+        self.elapsed = 0.0
+
+
+class Collector:
+    """Fetches metrics concurrently over a shared keep-alive connection pool.
+
+    Requests run on a bounded thread pool, each with its own timeout and
+    retried with jittered exponential backoff. A cycle deadline caps the
+    total time spent per cycle; work still pending at the deadline is
+    abandoned and reported in CycleResult.skipped.
+    """
+
+    def __init__(self, prometheus_url, max_workers=8, timeout=5, retries=2, backoff=0.5,
+                 cycle_deadline=None, chunk_size=BATCH_CHUNK_SIZE):
+        self.prometheus_url = prometheus_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cycle_deadline = cycle_deadline
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="collector")
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def request(self, method, path, deadline=None, **kwargs):
+        """Send a request with timeout and retries, returning the decoded JSON body."""
+        attempt = 0
+        while True:
+            timeout = self.timeout
+            if deadline is not None:
+                timeout = min(timeout, max(deadline - time.monotonic(), 0.001))
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, f"{self.prometheus_url}{path}", timeout=timeout, **kwargs)
+                PROMETHEUS_REQUEST_SECONDS.labels(path).observe(time.perf_counter() - started)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    if response.status_code >= 400:
+                        PROMETHEUS_REQUEST_ERRORS.labels(path).inc()
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.exceptions.HTTPError(f"{response.status_code}: {response.text[:200]}")
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                PROMETHEUS_REQUEST_SECONDS.labels(path).observe(time.perf_counter() - started)
+                error = e
+            PROMETHEUS_REQUEST_ERRORS.labels(path).inc()
+            if attempt >= self.retries:
+                raise error
+            # Full jitter keeps retries from many workers from synchronising.
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise error
+            time.sleep(delay)
+            attempt += 1
+
+    def get_all_metrics(self):
+        """Fetch all available metric names from Prometheus."""
+        try:
+            return self.request("GET", "/api/v1/label/__name__/values").get("data", [])
+        except Exception as e:
+            print(f"Exception while fetching metrics: {e}")
+            return []
+
+    def query(self, query, deadline=None):
+        """Run an instant query and return the result list."""
+        body = self.request("POST", "/api/v1/query", deadline=deadline, data={"query": query})
+        return body.get("data", {}).get("result", [])
+
+    def query_range(self, query, start, end, step, deadline=None):
+        """Run a range query and return the result list."""
+        body = self.request(
+            "POST", "/api/v1/query_range", deadline=deadline,
+            data={"query": query, "start": start, "end": end, "step": step},
+        )
+        return body.get("data", {}).get("result", [])
+
+    def fetch_ranges(self, metric_names, start, end, step, chunk_size=None):
+        """Fetch the values of every metric between start and end with chunked range queries.
+
+        Returns (labels, values) for every series, values oldest first with NaN and Inf dropped.
+        """
+        chunks = list(chunk_metric_names(metric_names, chunk_size or self.chunk_size))
+        futures = {
+            self._executor.submit(self.query_range, build_name_selector(chunk), start, end, step): chunk
+            for chunk in chunks
+        }
+        series_values = []
+        for future, chunk in futures.items():
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Exception while fetching range data for {len(chunk)} metrics: {e}")
+                continue
+            for item in result:
+                values = [float(value) for _, value in item.get("values", [])]
+                series_values.append((item.get("metric", {}), [value for value in values if math.isfinite(value)]))
+        return series_values
+
+    def stream_ranges(self, query, spans, step):
+        """Run a range query over each (start, end) span, yielding (outcome, result list) per span in order.
+
+        Outcome is "ok" or "failed" (after all retries, with an empty list).
+        Only as many spans as there are workers are in flight at once, so
+        memory stays bounded however many spans there are.
+        """
+        spans = iter(spans)
+        pending = deque()
+        for start, end in spans:
+            pending.append(self._executor.submit(self.query_range, query, start, end, step))
+            if len(pending) >= self.max_workers:
+                break
+        while pending:
+            future = pending.popleft()
+            for start, end in spans:
+                pending.append(self._executor.submit(self.query_range, query, start, end, step))
+                break
+            try:
+                yield "ok", future.result()
+            except Exception as e:
+                print(f"Exception while running range query: {e}")
+                yield "failed", []
+
+    def query_all(self, queries):
+        """Run instant queries concurrently within the cycle deadline.
+
+        Returns (outcome, result list) per query, in order; outcome is "ok",
+        "failed" or "skipped" (not done by the deadline), with an empty list
+        for the latter two.
+        """
+        deadline = time.monotonic() + self.cycle_deadline if self.cycle_deadline else None
+        futures = [self._executor.submit(self.query, query, deadline) for query in queries]
+        done, _ = wait(futures, timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+        results = []
+        for future in futures:
+            if future not in done:
+                future.cancel()
+                results.append(("skipped", []))
+                continue
+            try:
+                results.append(("ok", future.result()))
+            except Exception as e:
+                print(f"Exception while running query: {e}")
+                results.append(("failed", []))
+        return results
+
+    def fetch_metrics(self, metric_names, batch=True, matchers=None):
+        """Fetch the latest value of every metric, concurrently and within the cycle deadline.
+
+        With `matchers` ({label: value}), only series carrying those labels are fetched.
+        """
+        start = time.monotonic()
+        deadline = start + self.cycle_deadline if self.cycle_deadline else None
+        if batch:
+            chunks = list(chunk_metric_names(metric_names, self.chunk_size))
+            queries = [build_name_selector(chunk, matchers) for chunk in chunks]
+        else:
+            chunks = [[metric_name] for metric_name in metric_names]
+            queries = [build_metric_selector(metric_name, matchers) for metric_name in metric_names]
+        futures = {
+            self._executor.submit(self.query, query, deadline): chunk
+            for query, chunk in zip(queries, chunks)
+        }
+        done, pending = wait(futures, timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+
+        result = CycleResult()
+        for future in pending:
+            future.cancel()
+            result.skipped.extend(futures[future])
+        for future in done:
+            try:
+                result.samples.extend(parse_samples(future.result()))
+            except Exception as e:
+                print(f"Exception while fetching metric data: {e}")
+                result.failed.extend(futures[future])
+        result.elapsed = time.monotonic() - start
+        return result
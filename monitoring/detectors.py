@@ -0,0 +1,230 @@
+import re
+import numpy as np
+
+# Every detector takes the series keys and a (series x window) matrix of full
+# windows in time order, newest value last, and returns a boolean array that
+# is True where the newest value is anomalous.
+
+
+def evaluate_batch(matrix, threshold, means=None, stds=None):
+    """Z-score check of the newest value of every row of a (series x window) matrix in one pass.
+
+    Means and standard deviations cover the whole window, newest value
+    included; pass them in when they are already known (see
+    WindowStore.moments). Returns (flags, scores): flags is True where the
+    newest value is more than `threshold` standard deviations from the mean,
+    and scores is that distance in standard deviations (inf for a deviation
+    from a constant window).
+    """
+    if means is None:
+        means = matrix.mean(axis=1)
+    if stds is None:
+        stds = matrix.std(axis=1)
+    deviations = np.abs(matrix[:, -1] - means)
+    flags = deviations > threshold * stds
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.where(stds > 0, deviations / stds, np.where(flags, np.inf, 0.0))
+    return flags, scores
+
+
+def evaluate_aggregates(values, means, stds, threshold, lows=None, highs=None):
+    """Z-score check of latest values against window statistics computed elsewhere (e.g. by Prometheus).
+
+    Like evaluate_batch, returns (flags, scores). With quantile bounds, a
+    value must also fall outside [low, high] to be flagged, which keeps
+    skewed series from alerting on their usual tail.
+    """
+    values, means, stds = np.asarray(values), np.asarray(means), np.asarray(stds)
+    deviations = np.abs(values - means)
+    flags = deviations > threshold * stds
+    if lows is not None and highs is not None:
+        flags &= (values < np.asarray(lows)) | (values > np.asarray(highs))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.where(stds > 0, deviations / stds, np.where(deviations > 0, np.inf, 0.0))
+    return flags, scores
+
+
+class ZScoreDetector:
+    """Flags the newest value when it is more than `threshold` standard deviations from the window mean.
+
+    Mean and standard deviation cover the whole window, newest value included.
+    """
+
+    name = "zscore"
+
+    def __init__(self, threshold=2.0):
+        self.threshold = threshold
+
+    def detect(self, keys, matrix):
+        return evaluate_batch(matrix, self.threshold)[0]
+
+
+class EWMADetector:
+    """Flags the newest value when it strays from an exponentially weighted mean of the history.
+
+    The deviation is measured in exponentially weighted standard deviations,
+    so recent values count more than old ones.
+    """
+
+    name = "ewma"
+
+    def __init__(self, alpha=0.3, threshold=3.0):
+        self.alpha = alpha
+        self.threshold = threshold
+
+    def detect(self, keys, matrix):
+        mean = matrix[:, 0].copy()
+        var = np.zeros(len(matrix))
+        for column in range(1, matrix.shape[1] - 1):
+            diff = matrix[:, column] - mean
+            mean += self.alpha * diff
+            var = (1 - self.alpha) * (var + self.alpha * diff * diff)
+        return np.abs(matrix[:, -1] - mean) > self.threshold * np.sqrt(var)
+
+
+class MADDetector:
+    """Flags the newest value by its distance from the history median, in median absolute deviations.
+
+    Robust to earlier spikes in the window, which inflate the standard
+    deviation the z-score relies on.
+    """
+
+    name = "mad"
+
+    def __init__(self, threshold=3.5):
+        self.threshold = threshold
+
+    def detect(self, keys, matrix):
+        history = matrix[:, :-1]
+        median = np.median(history, axis=1)
+        mad = np.median(np.abs(history - median[:, None]), axis=1)
+        # 1.4826 scales the MAD to a standard deviation for normally distributed data.
+        return np.abs(matrix[:, -1] - median) > self.threshold * 1.4826 * mad
+
+
+class SeasonalDetector:
+    """Compares the newest value with the values one or more `period` samples earlier.
+
+    The baseline is the mean of those same-phase values and the spread is
+    the standard deviation of period-over-period differences in the window.
+    Windows shorter than two periods are never flagged.
+    """
+
+    name = "seasonal"
+
+    def __init__(self, period, threshold=3.0):
+        self.period = period
+        self.threshold = threshold
+
+    def detect(self, keys, matrix):
+        window_size = matrix.shape[1]
+        if window_size <= 2 * self.period:
+            return np.zeros(len(matrix), dtype=bool)
+        same_phase = matrix[:, window_size - 1 - self.period::-self.period]
+        baseline = same_phase.mean(axis=1)
+        history = matrix[:, :-1]
+        spread = (history[:, self.period:] - history[:, :-self.period]).std(axis=1)
+        return np.abs(matrix[:, -1] - baseline) > self.threshold * spread
+
+
+class IsolationForestDetector:
+    """Scores the newest value with a cached IsolationForest per series.
+
+    Models come from a ModelRegistry, or from a ScoringExecutor's worker
+    processes when one is given.
+    """
+
+    name = "isolation_forest"
+
+    def __init__(self, model_registry=None, executor=None):
+        self.model_registry = model_registry
+        self.executor = executor
+
+    def detect(self, keys, matrix):
+        if self.executor is not None:
+            predictions = self.executor.score_rows(keys, matrix)
+        else:
+            means = matrix.mean(axis=1)
+            stds = matrix.std(axis=1)
+            predictions = [
+                self.model_registry.predict(key, matrix[i], matrix[i, -1:], means[i], stds[i])[0]
+                for i, key in enumerate(keys)
+            ]
+        return np.asarray(predictions) == -1
+
+
+class DetectorCascade:
+    """Runs cheap detectors on every series and the model detector only where it is worth it.
+
+    The model detector runs for series whose standard deviation over the
+    last `recent` values exceeds `variance_ratio` times that of the older
+    values before them. Against the whole window the gate could never open
+    once variance_ratio reached sqrt(window_size / recent), since the recent
+    values are part of it. With confirm=False, a flag from any cheap detector is an anomaly
+    on its own and the model only looks at the remaining volatile series;
+    with confirm=True, cheap flags are candidates that the model must
+    confirm, and it scores them alongside the volatile series.
+    """
+
+    name = "cascade"
+
+    def __init__(self, detectors, model_detector, variance_ratio=2.0, recent=5, confirm=False, window_size=None):
+        if recent < 2:
+            raise ValueError(f"Cascade needs at least 2 recent values for a std dev, got {recent}")
+        if window_size is not None and window_size - recent < 2:
+            raise ValueError(f"Cascade needs at least 2 values older than the {recent} recent ones, "
+                             f"window size is {window_size}")
+        self.detectors = detectors
+        self.model_detector = model_detector
+        self.variance_ratio = variance_ratio
+        self.recent = recent
+        self.confirm = confirm
+        self.model_runs = 0  # Series scored by the model detector
+        self.skipped = 0  # Series decided by the cheap detectors alone
+
+    def detect(self, keys, matrix):
+        flagged = np.zeros(len(matrix), dtype=bool)
+        for detector in self.detectors:
+            flagged |= detector.detect(keys, matrix)
+        volatile = matrix[:, -self.recent:].std(axis=1) > self.variance_ratio * matrix[:, :-self.recent].std(axis=1)
+
+        if self.confirm:
+            anomalies = np.zeros(len(matrix), dtype=bool)
+            run = flagged | volatile
+        else:
+            anomalies = flagged
+            run = volatile & ~flagged
+        rows = np.flatnonzero(run)
+        if len(rows):
+            anomalies[rows] = self.model_detector.detect([keys[i] for i in rows], matrix[rows])
+        self.model_runs += len(rows)
+        self.skipped += len(matrix) - len(rows)
+        return anomalies
+
+
+class DetectorPolicy:
+    """Chooses a detector per metric name from (regex, detector name) rules.
+
+    Rules are tried in order with re.search and the first match wins; a
+    detector name of None disables detection for matching metrics.
+    """
+
+    def __init__(self, rules, detectors, default=None):
+        self.rules = [(re.compile(pattern), detector_name) for pattern, detector_name in rules]
+        self.detectors = detectors
+        self.default = default
+        self._cache = {}  # Metric name -> detector, since rules only depend on the name
+
+    def for_metric(self, metric_name):
+        try:
+            return self._cache[metric_name]
+        except KeyError:
+            pass
+        detector_name = self.default
+        for pattern, rule_detector in self.rules:
+            if pattern.search(metric_name):
+                detector_name = rule_detector
+                break
+        detector = self.detectors[detector_name] if detector_name is not None else None
+        self._cache[metric_name] = detector
+        return detector
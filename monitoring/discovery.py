@@ -0,0 +1,98 @@
+import re
+import threading
+import time
+
+
+class MetricDiscovery:
+    """Cached list of the metric names to monitor, refreshed from Prometheus once it is `ttl` seconds old.
+
+    Names are kept when they match any `include` regex (all names when
+    there are none) and no `exclude` regex, both tried with re.search.
+    `match` selectors are passed to Prometheus as match[], so only names of
+    matching series are returned; `lookback` limits them to series with
+    samples in that many recent seconds, so metrics that stopped reporting
+    drop out. Each refresh that changes the list calls on_change(added,
+    removed). A failed refresh keeps the previous list and is retried after
+    `retry_interval` seconds.
+
+    Safe to use from several threads; only one refresh runs at a time.
+    """
+
+    def __init__(self, collector, ttl=300, include=None, exclude=None, match=None, lookback=None,
+                 retry_interval=30, on_change=None, clock=time.monotonic):
+        self.collector = collector
+        self.ttl = ttl
+        self.include = [re.compile(pattern) for pattern in include or ()]
+        self.exclude = [re.compile(pattern) for pattern in exclude or ()]
+        self.match = list(match or ())
+        self.lookback = lookback
+        self.retry_interval = retry_interval
+        self.on_change = on_change
+        self.clock = clock
+        self._metrics = []
+        self._expires_at = None  # None until the first successful refresh
+        self._lock = threading.Lock()
+        self.refreshes = 0
+        self.failures = 0
+        self.excluded = 0  # Names filtered out by the last refresh
+
+    def wanted(self, metric_name):
+        if self.include and not any(pattern.search(metric_name) for pattern in self.include):
+            return False
+        return not any(pattern.search(metric_name) for pattern in self.exclude)
+
+    def _fetch(self):
+        params = [("match[]", selector) for selector in self.match]
+        if self.lookback:
+            params.append(("start", time.time() - self.lookback))
+        body = self.collector.request("GET", "/api/v1/label/__name__/values", params=params)
+        return body.get("data", [])
+
+    def expires_in(self):
+        """Seconds until the cached list is due for a refresh; 0 when it is due now."""
+        if self._expires_at is None:
+            return 0.0
+        return max(self._expires_at - self.clock(), 0.0)
+
+    def _refresh(self):
+        try:
+            names = self._fetch()
+        except Exception as e:
+            print(f"Exception while fetching metrics: {e}")
+            self.failures += 1
+            self._expires_at = self.clock() + self.retry_interval
+            return [], []
+        metrics = [metric_name for metric_name in names if self.wanted(metric_name)]
+        self.excluded = len(names) - len(metrics)
+        previous = set(self._metrics)
+        current = set(metrics)
+        added = [metric_name for metric_name in metrics if metric_name not in previous]
+        removed = [metric_name for metric_name in self._metrics if metric_name not in current]
+        self._metrics = metrics
+        self._expires_at = self.clock() + self.ttl
+        self.refreshes += 1
+        if (added or removed) and self.on_change is not None:
+            self.on_change(added, removed)
+        return added, removed
+
+    def refresh(self, if_expired=False):
+        """Fetch the metric names now (or only once the TTL expired), returning (added, removed)."""
+        with self._lock:
+            if if_expired and self.expires_in() > 0:
+                return [], []
+            return self._refresh()
+
+    def metrics(self):
+        """The cached metric names, refreshed first if the TTL has expired."""
+        if self.expires_in() <= 0:
+            self.refresh(if_expired=True)
+        return list(self._metrics)
+
+    def stats(self):
+        return {
+            "metrics": len(self._metrics),
+            "excluded": self.excluded,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "expires_in": self.expires_in(),
+        }
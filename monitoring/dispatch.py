@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class AnomalyDispatcher:
+    """Delivers anomaly notifications from a background thread.
+
+    dispatch() never blocks the detector: it records the latest anomaly per
+    series in a bounded pending set and returns. The sender thread waits
+    `coalesce_window` seconds after the first pending anomaly so a burst goes
+    out as one batch of at most `max_batch`, sends no more often than every
+    `min_interval` seconds, and suppresses repeats of a series already sent
+    within `dedup_interval`. Overflow and suppression are counted, not raised.
+    """
+
+    def __init__(self, send_batch, queue_size=1000, coalesce_window=1.0, max_batch=100,
+                 min_interval=1.0, dedup_interval=60, name="anomaly-dispatch"):
+        self.send_batch = send_batch
+        self.queue_size = queue_size
+        self.coalesce_window = coalesce_window
+        self.max_batch = max_batch
+        self.min_interval = min_interval
+        self.dedup_interval = dedup_interval
+        self.name = name
+        self._pending = OrderedDict()  # Series key -> latest payload, oldest first
+        self._last_sent = {}  # Series key -> monotonic time of its last delivery
+        self._last_batch = 0.0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closing = False
+        self._counters = {
+            "enqueued": 0, "coalesced": 0, "deduplicated": 0, "dropped": 0,
+            "sent": 0, "batches": 0, "failed": 0,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._closing = False
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def dispatch(self, key, payload):
+        """Queue payload for series key without blocking; returns False if it was not queued."""
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            sent_at = self._last_sent.get(key)
+            if sent_at is not None and time.monotonic() - sent_at < self.dedup_interval:
+                self._counters["deduplicated"] += 1
+                return False
+            if key in self._pending:
+                self._pending[key] = payload
+                self._counters["coalesced"] += 1
+                return True
+            if len(self._pending) >= self.queue_size:
+                self._counters["dropped"] += 1
+                return False
+            self._pending[key] = payload
+            self._counters["enqueued"] += 1
+            self._cond.notify()
+            return True
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self):
+        with self._cond:
+            return dict(self._counters, pending=len(self._pending))
+
+    def close(self, timeout=None):
+        """Send what is pending, then stop the sender thread."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._closing:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            if not self._closing:
+                # Let the rest of a burst arrive (unless a full batch is ready), then respect the rate limit.
+                coalesced_at = time.monotonic() + self.coalesce_window
+                allowed_at = self._last_batch + self.min_interval
+                while not self._closing:
+                    ready_at = allowed_at if len(self._pending) >= self.max_batch else max(coalesced_at, allowed_at)
+                    remaining = ready_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            batch = []
+            while self._pending and len(batch) < self.max_batch:
+                batch.append(self._pending.popitem(last=False))
+            now = time.monotonic()
+            self._last_batch = now
+            for key, _ in batch:
+                self._last_sent[key] = now
+            if len(self._last_sent) > self.queue_size:
+                # Forget series whose suppression has expired so the map stays bounded by activity.
+                self._last_sent = {
+                    key: sent_at for key, sent_at in self._last_sent.items() if now - sent_at < self.dedup_interval
+                }
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self.send_batch([payload for _, payload in batch])
+                with self._cond:
+                    self._counters["sent"] += len(batch)
+                    self._counters["batches"] += 1
+            except Exception as e:
+                print(f"Exception while dispatching {len(batch)} anomalies: {e}")
+                with self._cond:
+                    self._counters["failed"] += len(batch)
+                    # Undelivered series may be reported again on their next anomaly.
+                    for key, _ in batch:
+                        self._last_sent.pop(key, None)
@@ -0,0 +1,72 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class DetectionEngine:
+    """Runs every mutation of the detection state on one owning worker thread.
+
+    Other threads hand work to the engine through a bounded ingest queue with
+    submit() and read results from the returned Future or from immutable
+    snapshots the work publishes, so window and model state is never shared.
+    """
+
+    def __init__(self, queue_size=64, name="detection-engine"):
+        self.name = name
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def is_owner(self):
+        """True when called from the engine's worker thread."""
+        return threading.current_thread() is self._thread
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, fn, *args, block=True, timeout=None):
+        """Queue fn(*args) to run on the engine thread and return its Future.
+
+        With block=False (or once timeout expires) a full queue raises
+        queue.Full, letting producers shed load instead of piling up.
+        """
+        if self.is_owner():
+            # Already on the engine thread; queueing would deadlock a caller waiting on it.
+            future = Future()
+            self._call(future, fn, args)
+            return future
+        self.start()
+        future = Future()
+        self._queue.put((future, fn, args), block=block, timeout=timeout)
+        return future
+
+    def stop(self, timeout=None):
+        """Process everything already queued, then stop the worker."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    @staticmethod
+    def _call(future, fn, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            self._call(*item)
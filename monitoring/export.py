@@ -0,0 +1,192 @@
+import json
+import os
+import re
+import time
+from datetime import datetime
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+EXPORT_FILE = "export.json"  # Export metadata, written last so its presence marks a complete export
+VALUES_FILE = "values.npy"  # "npy" format: series x step matrix
+SAMPLES_FILE = "samples.parquet"  # "parquet" format: one (series, timestamp, value) row per sample
+FORMATS = ("npy", "parquet")
+MAX_POINTS_PER_SERIES = 11000  # Prometheus refuses range queries returning more points per series
+CHUNK_SAMPLES = 1_000_000  # Samples per range query, which bounds the memory each response takes
+PARQUET_COMPRESSION = "zstd"
+
+OFFSET_RE = re.compile(r"^-(\d+(?:\.\d+)?)([smhdw])$")
+UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_time(value, now):
+    """Unix seconds from "now", an offset like -6h, unix seconds, or an ISO 8601 time."""
+    if value == "now":
+        return now
+    match = OFFSET_RE.match(value)
+    if match:
+        return now - float(match.group(1)) * UNIT_SECONDS[match.group(2)]
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def series_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def find_series(collector, selectors, start, end):
+    """Label sets of every series the selectors match between start and end, in a stable order."""
+    body = collector.request("POST", "/api/v1/series", data={"match[]": selectors, "start": start, "end": end})
+    labels = {series_key(series): series for series in body.get("data", [])}
+    return [labels[key] for key in sorted(labels)]
+
+
+def time_chunks(steps, series_count, chunk_samples=CHUNK_SAMPLES):
+    """(first, end) step ranges of at most chunk_samples samples across all series."""
+    size = max(1, min(MAX_POINTS_PER_SERIES, chunk_samples // max(series_count, 1)))
+    return [(first, min(first + size, steps)) for first in range(0, steps, size)]
+
+
+class NpyWriter:
+    """Writes a series x step matrix to a memory-mappable .npy file; NaN where a series has no sample."""
+
+    def __init__(self, directory, series_count, steps, dtype):
+        self.values = np.lib.format.open_memmap(
+            os.path.join(directory, VALUES_FILE), mode="w+", dtype=dtype, shape=(series_count, steps)
+        )
+
+    def write(self, first, block, timestamps):
+        self.values[:, first:first + block.shape[1]] = block
+
+    def close(self):
+        self.values.flush()
+        del self.values
+
+
+class ParquetWriter:
+    """Writes the samples present as compressed Parquet rows, one row group per chunk."""
+
+    SCHEMA = None if pa is None else pa.schema([
+        ("series", pa.int32()), ("timestamp", pa.float64()), ("value", pa.float64()),
+    ])
+
+    def __init__(self, directory, series_count, steps, dtype):
+        if pa is None:
+            raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+        self.writer = pq.ParquetWriter(
+            os.path.join(directory, SAMPLES_FILE), self.SCHEMA, compression=PARQUET_COMPRESSION
+        )
+
+    def write(self, first, block, timestamps):
+        rows, columns = np.nonzero(~np.isnan(block))
+        self.writer.write_table(pa.table({
+            "series": rows.astype(np.int32),
+            "timestamp": timestamps[columns],
+            "value": block[rows, columns].astype(np.float64),
+        }, schema=self.SCHEMA))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {"npy": NpyWriter, "parquet": ParquetWriter}
+
+
+def export_range(collector, selectors, start, end, step, directory, export_format="npy", dtype="float64",
+                 chunk_samples=CHUNK_SAMPLES):
+    """Export every series the selectors match between start and end, at step resolution, to a directory.
+
+    Range queries over consecutive time chunks run concurrently on the
+    collector, and each chunk is written as soon as it arrives, so memory
+    holds a few chunks at a time whatever the size of the export. Returns
+    the metadata written to export.json.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(os.path.join(directory, EXPORT_FILE)):
+        os.remove(os.path.join(directory, EXPORT_FILE))
+    series = find_series(collector, selectors, start, end)
+    rows = {series_key(labels): row for row, labels in enumerate(series)}
+    steps = int((end - start) // step) + 1
+    timestamps = start + step * np.arange(steps)
+    chunks = time_chunks(steps, len(series), chunk_samples)
+    print(f"Exporting {len(series)} series over {steps} steps in {len(chunks)} range queries")
+
+    writer = WRITERS[export_format](directory, len(series), steps, dtype)
+    samples = 0
+    failed = []
+    unknown = set()  # Series that appeared after the series lookup
+    started = time.monotonic()
+    try:
+        spans = [(timestamps[first], timestamps[end_step - 1]) for first, end_step in chunks]
+        query = " or ".join(selectors)
+        for n, ((first, end_step), (outcome, result)) in enumerate(
+            zip(chunks, collector.stream_ranges(query, spans, step)), start=1
+        ):
+            block = np.full((len(series), end_step - first), np.nan, dtype=dtype)
+            if outcome != "ok":
+                failed.append([float(timestamps[first]), float(timestamps[end_step - 1])])
+            for item in result:
+                key = series_key(item.get("metric", {}))
+                row = rows.get(key)
+                points = item.get("values", [])
+                if row is None:
+                    unknown.add(key)
+                    continue
+                if not points:
+                    continue
+                columns = np.rint((np.array([t for t, _ in points], dtype=float) - start) / step).astype(np.int64)
+                block[row, columns - first] = np.array([value for _, value in points], dtype=float)
+            samples += int(np.count_nonzero(~np.isnan(block)))
+            writer.write(first, block, timestamps[first:end_step])
+            if n % 10 == 0 or n == len(chunks):
+                print(f"Exported {n}/{len(chunks)} chunks, {samples} samples, {time.monotonic() - started:.1f}s")
+    finally:
+        writer.close()
+
+    if failed:
+        print(f"{len(failed)} range queries failed; their steps are missing from the export")
+    if unknown:
+        print(f"Skipped {len(unknown)} series that appeared after the export started")
+    metadata = {
+        "format": export_format,
+        "dtype": str(np.dtype(dtype)),
+        "selectors": list(selectors),
+        "start": start,
+        "end": end,
+        "step": step,
+        "steps": steps,
+        "samples": samples,
+        "failed": failed,  # (start, end) of chunks whose range query failed
+        "created_at": time.time(),
+        "series": series,
+    }
+    with open(os.path.join(directory, EXPORT_FILE), "w") as f:
+        json.dump(metadata, f)
+    return metadata
+
+
+def load_export(directory, mmap=True):
+    """(series labels, timestamps, series x step values) of an export; NaN where a series has no sample.
+
+    "npy" exports are memory-mapped unless mmap is false; "parquet" exports
+    are read into memory.
+    """
+    with open(os.path.join(directory, EXPORT_FILE)) as f:
+        metadata = json.load(f)
+    timestamps = metadata["start"] + metadata["step"] * np.arange(metadata["steps"])
+    if metadata["format"] == "npy":
+        values = np.load(os.path.join(directory, VALUES_FILE), mmap_mode="r" if mmap else None)
+    else:
+        if pa is None:
+            raise RuntimeError("Reading a Parquet export needs pyarrow (pip install pyarrow)")
+        table = pq.read_table(os.path.join(directory, SAMPLES_FILE))
+        values = np.full((len(metadata["series"]), metadata["steps"]), np.nan, dtype=metadata["dtype"])
+        columns = np.rint((table.column("timestamp").to_numpy() - metadata["start"]) / metadata["step"])
+        values[table.column("series").to_numpy(), columns.astype(np.int64)] = table.column("value").to_numpy()
+    return metadata["series"], timestamps, values
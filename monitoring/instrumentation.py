@@ -0,0 +1,78 @@
+import threading
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Metrics about the detection pipeline itself, in the default registry so any
+# process can serve them with generate_latest() or start_http_server().
+# Work done in ScoringExecutor worker processes is only seen through the
+# detection time of the process that submitted it.
+
+CYCLE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+PROMETHEUS_REQUEST_SECONDS = Histogram(
+    "anomaly_prometheus_request_seconds", "Latency of requests to the Prometheus HTTP API, per attempt", ["path"]
+)
+PROMETHEUS_REQUEST_ERRORS = Counter(
+    "anomaly_prometheus_request_errors_total", "Failed requests to the Prometheus HTTP API, per attempt", ["path"]
+)
+CYCLE_SECONDS = Histogram(
+    "anomaly_cycle_seconds", "Duration of a monitoring cycle, from fetching samples to publishing results",
+    buckets=CYCLE_BUCKETS,
+)
+MODEL_FIT_SECONDS = Histogram("anomaly_model_fit_seconds", "Time to fit one Isolation Forest model")
+DETECTION_SECONDS = Histogram(
+    "anomaly_detection_seconds", "Time to score a batch of series, per detector", ["detector"], buckets=CYCLE_BUCKETS
+)
+SERIES = Gauge("anomaly_series", "Series tracked for detection")
+WINDOW_FILL_RATIO = Gauge("anomaly_window_fill_ratio", "Fraction of window slots filled across tracked series")
+
+
+class DispatcherCollector:
+    """Exports the counters and queue depth of AnomalyDispatchers at scrape time."""
+
+    def __init__(self):
+        self._dispatchers = []
+        self._lock = threading.Lock()
+
+    def add(self, dispatcher):
+        with self._lock:
+            self._dispatchers.append(dispatcher)
+
+    def collect(self):
+        pending = GaugeMetricFamily(
+            "anomaly_dispatch_pending", "Notifications waiting to be sent", labels=["dispatcher"]
+        )
+        outcomes = CounterMetricFamily(
+            "anomaly_dispatch", "Notifications by outcome (enqueued, coalesced, deduplicated, dropped, sent, failed)",
+            labels=["dispatcher", "outcome"],
+        )
+        with self._lock:
+            dispatchers = list(self._dispatchers)
+        for dispatcher in dispatchers:
+            stats = dispatcher.stats()
+            pending.add_metric([dispatcher.name], stats.pop("pending"))
+            stats.pop("batches")
+            for outcome, count in stats.items():
+                outcomes.add_metric([dispatcher.name, outcome], count)
+        yield pending
+        yield outcomes
+
+
+_dispatchers = DispatcherCollector()
+REGISTRY.register(_dispatchers)
+
+
+def register_dispatcher(dispatcher):
+    """Export a dispatcher's queue depth and counters on /metrics."""
+    _dispatchers.add(dispatcher)
+
+
+def record_windows(windows):
+    """Update the series gauges; call from the thread that owns the windows."""
+    SERIES.set(len(windows))
+    WINDOW_FILL_RATIO.set(windows.fill_ratio())
+
+
+def render_metrics():
+    """Body and content type of a /metrics response."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,145 @@
+import time
+import zlib
+from collections import OrderedDict
+
+from .instrumentation import MODEL_FIT_SECONDS
+
+
+class ModelEntry:
+    """A fitted model plus the bookkeeping used by the retrain policy."""
+
+    __slots__ = ("model", "fitted_at", "fit_mean", "fit_std", "samples_since_fit", "retrain_count")
+
+    def __init__(self):
+        self.model = None
+        self.fitted_at = 0.0
+        self.fit_mean = 0.0
+        self.fit_std = 0.0
+        self.samples_since_fit = 0
+        self.retrain_count = 0
+
+
+class ModelRegistry:
+    """Keeps one fitted IsolationForest per series and decides when to refit.
+
+    A model is refitted when it has scored `retrain_every` new samples, when
+    the rolling mean has drifted more than `drift_threshold` fit-time standard
+    deviations, or when it is older than `max_model_age` seconds. Once more
+    than `max_models` series have models, the least recently used is evicted.
+
+    With seed_by_series each model is seeded from its series key, so a series
+    gets the same model no matter which process or registry fits it. Model
+    ages are measured with `clock`, which replays set to the sample time.
+    """
+
+    def __init__(self, contamination=0.1, retrain_every=50, drift_threshold=3.0,
+                 max_model_age=600, max_models=5000, random_state=None, seed_by_series=False, clock=time.time):
+        self.contamination = contamination
+        self.retrain_every = retrain_every
+        self.drift_threshold = drift_threshold
+        self.max_model_age = max_model_age
+        self.max_models = max_models
+        self.random_state = random_state
+        self.seed_by_series = seed_by_series
+        self.clock = clock
+        self._entries = OrderedDict()
+        self.total_retrains = 0
+        self.total_evictions = 0
+        self.total_fit_seconds = 0.0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _retrain_reason(self, entry, mean, now):
+        if entry.model is None:
+            return "new"
+        if entry.samples_since_fit >= self.retrain_every:
+            return "samples"
+        if abs(mean - entry.fit_mean) > self.drift_threshold * entry.fit_std:
+            return "drift"
+        if self.max_model_age is not None and now - entry.fitted_at > self.max_model_age:
+            return "age"
+        return None
+
+    def get_model(self, key, training_values, mean, std):
+        """Return the model for `key`, fitting it first if the policy says so."""
+        now = self.clock()
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = ModelEntry()
+            self._entries[key] = entry
+            while len(self._entries) > self.max_models:
+                self._entries.popitem(last=False)
+                self.total_evictions += 1
+        else:
+            self._entries.move_to_end(key)
+
+        reason = self._retrain_reason(entry, mean, now)
+        if reason is not None:
+            from sklearn.ensemble import IsolationForest  # Seconds to import; only series that need a model pay for it
+            start = time.perf_counter()
+            random_state = zlib.crc32(str(key).encode()) if self.seed_by_series else self.random_state
+            model = IsolationForest(contamination=self.contamination, random_state=random_state)
+            model.fit(training_values.reshape(-1, 1))
+            elapsed = time.perf_counter() - start
+            self.total_fit_seconds += elapsed
+            MODEL_FIT_SECONDS.observe(elapsed)
+            entry.model = model
+            entry.fitted_at = now
+            entry.fit_mean = mean
+            entry.fit_std = std
+            entry.samples_since_fit = 0
+            if reason != "new":
+                entry.retrain_count += 1
+                self.total_retrains += 1
+        entry.samples_since_fit += 1
+        return entry.model
+
+    def predict(self, key, training_values, points, mean, std):
+        """Predict points (-1 anomaly, 1 normal) with the cached model for `key`."""
+        model = self.get_model(key, training_values, mean, std)
+        return model.predict(points.reshape(-1, 1))
+
+    def remove(self, key):
+        self._entries.pop(key, None)
+
+    def state(self):
+        """Fitted models and counters, for checkpointing."""
+        return {
+            "entries": self._entries,
+            "total_retrains": self.total_retrains,
+            "total_evictions": self.total_evictions,
+            "total_fit_seconds": self.total_fit_seconds,
+        }
+
+    def restore(self, state):
+        """Load models saved by state()."""
+        self._entries = OrderedDict(state["entries"])
+        self.total_retrains = state["total_retrains"]
+        self.total_evictions = state["total_evictions"]
+        self.total_fit_seconds = state["total_fit_seconds"]
+        while len(self._entries) > self.max_models:
+            self._entries.popitem(last=False)
+
+    def stats(self, include_series=True):
+        """Summary of model ages and retrain counts for tuning the policy."""
+        now = self.clock()
+        stats = {
+            "models": len(self._entries),
+            "total_retrains": self.total_retrains,
+            "total_evictions": self.total_evictions,
+            "total_fit_seconds": round(self.total_fit_seconds, 3),
+        }
+        if include_series:
+            stats["series"] = {
+                str(key): {
+                    "model_age": round(now - entry.fitted_at, 1),
+                    "retrain_count": entry.retrain_count,
+                    "samples_since_fit": entry.samples_since_fit,
+                }
+                for key, entry in self._entries.items()
+            }
+        return stats
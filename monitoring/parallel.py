@@ -0,0 +1,138 @@
+import multiprocessing
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+from .model_registry import ModelRegistry
+
+# State of a scoring worker process: its partition's models and attached blocks.
+_worker_registry = None
+_worker_blocks = {}
+
+
+def _init_worker(registry_kwargs):
+    global _worker_registry
+    _worker_registry = ModelRegistry(**registry_kwargs)
+
+
+def _attach(name):
+    block = _worker_blocks.get(name)
+    if block is None:
+        for old in _worker_blocks.values():
+            old.close()
+        _worker_blocks.clear()
+        # Spawned workers share the parent's resource tracker, which unlinks the block.
+        block = SharedMemory(name=name)
+        _worker_blocks[name] = block
+    return block
+
+
+def _score_partition(block_name, shape, keys, means, stds, latest):
+    """Predict the latest value of each series in a partition with cached models."""
+    start = time.perf_counter()
+    values = np.ndarray(shape, dtype=np.float64, buffer=_attach(block_name).buf)
+    predictions = [
+        int(_worker_registry.predict(key, values[i], np.array([latest[i]]), means[i], stds[i])[0])
+        for i, key in enumerate(keys)
+    ]
+    return predictions, time.perf_counter() - start
+
+
+def _worker_stats():
+    return _worker_registry.stats(include_series=False)
+
+
+def partition_for(key, workers):
+    """Stable partition of a series key, identical across processes and restarts."""
+    return zlib.crc32(str(key).encode()) % workers
+
+
+class ScoringExecutor:
+    """Scores series on a pool of worker processes, one partition per process.
+
+    Each series always goes to the same worker, which keeps its fitted model
+    between batches. Window rows are copied into a per-partition shared memory
+    block instead of being pickled, and models are seeded per series so
+    results do not depend on the number of workers.
+    """
+
+    def __init__(self, workers, window_size, **registry_kwargs):
+        self.workers = workers
+        self.window_size = window_size
+        registry_kwargs["seed_by_series"] = True
+        context = multiprocessing.get_context("spawn")
+        self._pools = [
+            ProcessPoolExecutor(1, mp_context=context, initializer=_init_worker, initargs=(registry_kwargs,))
+            for _ in range(workers)
+        ]
+        self._blocks = [None] * workers
+        self.last_batch_timings = []  # (worker, series, seconds) for the latest score() call
+
+    def _block(self, worker, rows):
+        """Shared memory block for a partition, large enough for `rows` windows."""
+        size = max(rows, 1) * self.window_size * 8
+        block = self._blocks[worker]
+        if block is None or block.size < size:
+            if block is not None:
+                block.close()
+                block.unlink()
+            block = SharedMemory(create=True, size=size * 2)
+            self._blocks[worker] = block
+        return block
+
+    def score(self, windows, keys):
+        """Return {key: prediction} (-1 anomaly, 1 normal) for the latest value of each key.
+
+        Every key must have a full window.
+        """
+        keys = list(keys)
+        matrix = np.array([windows.window(key) for key in keys]).reshape(len(keys), self.window_size)
+        return dict(zip(keys, self.score_rows(keys, matrix)))
+
+    def score_rows(self, keys, matrix):
+        """Predictions (-1 anomaly, 1 normal) for the last value of each row of a (series x window) matrix."""
+        partitions = [[] for _ in range(self.workers)]
+        for i, key in enumerate(keys):
+            partitions[partition_for(key, self.workers)].append(i)
+
+        futures = []
+        for worker, rows in enumerate(partitions):
+            if not rows:
+                continue
+            block = self._block(worker, len(rows))
+            shape = (len(rows), self.window_size)
+            shared = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+            np.take(matrix, rows, axis=0, out=shared)
+            partition = [keys[i] for i in rows]
+            means = shared.mean(axis=1).tolist()
+            stds = shared.std(axis=1).tolist()
+            latest = shared[:, -1].tolist()
+            future = self._pools[worker].submit(_score_partition, block.name, shape, partition, means, stds, latest)
+            futures.append((worker, rows, future))
+
+        predictions = [1] * len(keys)
+        self.last_batch_timings = []
+        for worker, rows, future in futures:
+            partition_predictions, seconds = future.result()
+            for i, prediction in zip(rows, partition_predictions):
+                predictions[i] = prediction
+            self.last_batch_timings.append((worker, len(rows), seconds))
+        return predictions
+
+    def stats(self):
+        """Model counters summed over all workers."""
+        totals = {}
+        for pool in self._pools:
+            for name, value in pool.submit(_worker_stats).result().items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def close(self):
+        for pool in self._pools:
+            pool.shutdown()
+        for block in self._blocks:
+            if block is not None:
+                block.close()
+                block.unlink()
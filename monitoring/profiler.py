@@ -0,0 +1,77 @@
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+
+IDLE_FUNCTIONS = {"wait", "select", "poll", "accept", "_wait_for_tstate_lock"}  # Leaf frames of blocked threads
+
+
+class SlowCycleProfiler:
+    """Samples thread stacks during a cycle and prints the hottest ones if it was slow.
+
+    While a profile() block runs, a background thread records the stack of
+    every other thread each `interval` seconds. If the block took longer
+    than `threshold` seconds, the `top` most frequently seen stacks are
+    printed with the share of samples they appeared in; otherwise the
+    samples are dropped. Sampling only happens inside profile() blocks, so
+    an idle profiler costs nothing, and one without a threshold never samples.
+    """
+
+    def __init__(self, threshold, interval=0.01, top=10, depth=12):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self.depth = depth
+
+    def _stack(self, frame):
+        lines = []
+        while frame is not None and len(lines) < self.depth:
+            code = frame.f_code
+            lines.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}")
+            frame = frame.f_back
+        return tuple(reversed(lines))
+
+    def _sample(self, stop, samples, ticks):
+        own = threading.get_ident()
+        while not stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    samples[(names.get(ident, str(ident)), self._stack(frame))] += 1
+            ticks[0] += 1
+
+    @contextlib.contextmanager
+    def profile(self, label="cycle"):
+        if not self.threshold:
+            yield
+            return
+        samples = collections.Counter()
+        ticks = [0]
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample, args=(stop, samples, ticks), name="cycle-profiler", daemon=True
+        )
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            sampler.join()
+            elapsed = time.perf_counter() - start
+            if elapsed > self.threshold:
+                self.report(label, elapsed, samples, ticks[0])
+
+    def report(self, label, elapsed, samples, ticks):
+        # Idle threads are sampled too; leave out stacks that are only waiting.
+        busy = [
+            (key, count) for key, count in samples.most_common()
+            if key[1] and key[1][-1].split(" ")[-1] not in IDLE_FUNCTIONS
+        ]
+        print(f"Slow {label}: {elapsed:.2f}s (threshold {self.threshold}s), {ticks} samples")
+        for (thread_name, stack), count in busy[:self.top]:
+            print(f"  {100 * count / max(ticks, 1):5.1f}% [{thread_name}]")
+            for line in stack:
+                print(f"      {line}")
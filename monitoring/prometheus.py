@@ -0,0 +1,44 @@
+import re
+
+BATCH_CHUNK_SIZE = 200  # Number of metric names selected by a single vector query
+
+# Valid Prometheus metric names never contain regex metacharacters, so they can
+# be joined into a `{__name__=~"..."}` selector without escaping.
+METRIC_NAME_RE = re.compile(r"^[a-zA-Z_:][a-zA-Z0-9_:]*$")
+
+
+def chunk_metric_names(metric_names, chunk_size=BATCH_CHUNK_SIZE):
+    """Split metric names into lists of at most chunk_size valid names."""
+    chunk = []
+    for metric_name in metric_names:
+        if not METRIC_NAME_RE.match(metric_name):
+            print(f"Skipping invalid metric name: {metric_name}")
+            continue
+        chunk.append(metric_name)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def label_matchers(matchers):
+    """PromQL equality matchers for a {label: value} dict, e.g. `job="api",instance="a:80"`."""
+    return ",".join(
+        f'{name}="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for name, value in sorted(matchers.items())
+    )
+
+
+def build_name_selector(metric_names, matchers=None):
+    """Build a PromQL vector selector matching all of the given metric names (and label matchers)."""
+    selector = '{__name__=~"' + "|".join(metric_names) + '"'
+    if matchers:
+        selector += "," + label_matchers(matchers)
+    return selector + "}"
+
+
+def build_metric_selector(metric_name, matchers=None):
+    """Build a PromQL vector selector for one metric name (and label matchers)."""
+    return f"{metric_name}{{{label_matchers(matchers)}}}" if matchers else metric_name
+
@@ -0,0 +1,231 @@
+import math
+import struct
+
+try:
+    import snappy  # python-snappy, much faster than the pure Python decoder below
+except ImportError:
+    snappy = None
+
+# Prometheus remote write 1.0: a snappy (block format) compressed protobuf
+# WriteRequest { repeated TimeSeries timeseries = 1; }, where
+# TimeSeries { repeated Label labels = 1; repeated Sample samples = 2; },
+# Label { string name = 1; string value = 2; } and
+# Sample { double value = 1; int64 timestamp = 2; }.
+# Only these fields are decoded; metadata, exemplars and histograms are skipped.
+
+_DOUBLE = struct.Struct("<d")
+
+
+class RemoteWriteError(ValueError):
+    """A remote write payload that cannot be decoded; retrying it will not help."""
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise RemoteWriteError("truncated varint")
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise RemoteWriteError("varint too long")
+
+
+def _write_varint(out, value):
+    value &= 0xFFFFFFFFFFFFFFFF
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def snappy_decompress(data):
+    """Decompress a snappy block (not the framed stream format)."""
+    if snappy is not None:
+        try:
+            return snappy.uncompress(data)
+        except Exception as e:
+            raise RemoteWriteError(f"invalid snappy block: {e}") from e
+    length, pos = _read_varint(data, 0)
+    out = bytearray()
+    end = len(data)
+    while pos < end:
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                if pos + extra > end:
+                    raise RemoteWriteError("truncated snappy literal")
+                size = int.from_bytes(data[pos:pos + extra], "little")
+                pos += extra
+            size += 1
+            if pos + size > end:
+                raise RemoteWriteError("truncated snappy literal")
+            out += data[pos:pos + size]
+            pos += size
+            continue
+        width = 1 if kind == 1 else 2 if kind == 2 else 4  # Offset bytes after the tag
+        if pos + width > end:
+            raise RemoteWriteError("truncated snappy copy")
+        if kind == 1:
+            size = 4 + ((tag >> 2) & 7)
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif kind == 2:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 2], "little")
+            pos += 2
+        else:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 4], "little")
+            pos += 4
+        if offset == 0 or offset > len(out):
+            raise RemoteWriteError("invalid snappy copy offset")
+        start = len(out) - offset
+        if offset >= size:
+            out += out[start:start + size]
+        else:
+            # Overlapping copy: the copied bytes repeat the last `offset` bytes.
+            pattern = out[start:]
+            out += (pattern * (size // offset + 1))[:size]
+    if len(out) != length:
+        raise RemoteWriteError("snappy length mismatch")
+    return bytes(out)
+
+
+def snappy_compress(data):
+    """Snappy block made only of literals; valid for any decoder, used to build test payloads."""
+    if snappy is not None:
+        return snappy.compress(data)
+    out = bytearray()
+    _write_varint(out, len(data))
+    for start in range(0, len(data), 65536):
+        chunk = data[start:start + 65536]
+        size = len(chunk) - 1
+        if size < 60:
+            out.append(size << 2)
+        else:
+            extra = (size.bit_length() + 7) // 8
+            out.append((59 + extra) << 2)
+            out += size.to_bytes(extra, "little")
+        out += chunk
+    return bytes(out)
+
+
+def _skip(buf, pos, wire_type):
+    if wire_type == 0:
+        return _read_varint(buf, pos)[1]
+    if wire_type == 1:
+        return pos + 8
+    if wire_type == 2:
+        size, pos = _read_varint(buf, pos)
+        return pos + size
+    if wire_type == 5:
+        return pos + 4
+    raise RemoteWriteError(f"unsupported wire type {wire_type}")
+
+
+def _fields(buf, start, end):
+    """Yield (field number, wire type, value start, value end) for each field in buf[start:end]."""
+    pos = start
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 2:
+            size, pos = _read_varint(buf, pos)
+            value_start, pos = pos, pos + size
+        else:
+            value_start, pos = pos, _skip(buf, pos, wire_type)
+        if pos > end:
+            raise RemoteWriteError("truncated protobuf field")
+        yield field, wire_type, value_start, pos
+
+
+def _decode_timeseries(buf, start, end):
+    labels = {}
+    samples = []
+    for field, wire_type, value_start, value_end in _fields(buf, start, end):
+        if field == 1 and wire_type == 2:
+            name = value = ""
+            for label_field, _, label_start, label_end in _fields(buf, value_start, value_end):
+                if label_field == 1:
+                    name = bytes(buf[label_start:label_end]).decode()
+                elif label_field == 2:
+                    value = bytes(buf[label_start:label_end]).decode()
+            labels[name] = value
+        elif field == 2 and wire_type == 2:
+            value = 0.0
+            timestamp = 0
+            for sample_field, sample_type, sample_start, _ in _fields(buf, value_start, value_end):
+                if sample_field == 1 and sample_type == 1:
+                    value = _DOUBLE.unpack_from(buf, sample_start)[0]
+                elif sample_field == 2 and sample_type == 0:
+                    timestamp = _read_varint(buf, sample_start)[0]
+                    if timestamp >= 1 << 63:
+                        timestamp -= 1 << 64
+            samples.append((timestamp, value))
+    return labels, samples
+
+
+def iter_series(body, batch_size=500):
+    """Decode a compressed remote write body into batches of (labels, values).
+
+    Values are in timestamp order with NaN (including Prometheus staleness
+    markers) and Inf dropped; series left without values are skipped.
+    Batches are yielded as the protobuf is walked, so ingestion of the first
+    batch can start before the rest is decoded.
+    """
+    buf = memoryview(snappy_decompress(body))
+    batch = []
+    for field, wire_type, start, end in _fields(buf, 0, len(buf)):
+        if field != 1 or wire_type != 2:
+            continue
+        try:
+            labels, samples = _decode_timeseries(buf, start, end)
+        except (UnicodeDecodeError, struct.error) as e:
+            raise RemoteWriteError(f"invalid time series: {e}") from e
+        samples.sort(key=lambda sample: sample[0])
+        values = [value for _, value in samples if math.isfinite(value)]
+        if values:
+            batch.append((labels, values))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def encode_write_request(series):
+    """Encode [(labels, [(timestamp_ms, value), ...]), ...] as a compressed remote write body."""
+    request = bytearray()
+    for labels, samples in series:
+        timeseries = bytearray()
+        for name, value in sorted(labels.items()):
+            label = bytearray()
+            for field, text in ((1, name), (2, value)):
+                encoded = text.encode()
+                label.append(field << 3 | 2)
+                _write_varint(label, len(encoded))
+                label += encoded
+            timeseries.append(1 << 3 | 2)
+            _write_varint(timeseries, len(label))
+            timeseries += label
+        for timestamp, value in samples:
+            sample = bytearray([1 << 3 | 1]) + _DOUBLE.pack(value)
+            sample.append(2 << 3 | 0)
+            _write_varint(sample, timestamp)
+            timeseries.append(2 << 3 | 2)
+            _write_varint(timeseries, len(sample))
+            timeseries += sample
+        request.append(1 << 3 | 2)
+        _write_varint(request, len(timeseries))
+        request += timeseries
+    return snappy_compress(bytes(request))
@@ -0,0 +1,198 @@
+import heapq
+import math
+import threading
+import time
+import numpy as np
+
+from .detectors import evaluate_batch
+
+# Activity levels reported back to the scheduler after a poll.
+STABLE = 0  # Unchanged or within normal variation; back off
+VOLATILE = 1  # Moving noticeably, or the window is still filling; poll faster
+ANOMALOUS = 2  # Flagged by detection; poll at the shortest interval
+
+
+def activity_levels(matrix, anomalies, volatile_score=1.0):
+    """Activity level of each row of a (series x window) matrix of full windows.
+
+    A row is volatile when its newest value is at least `volatile_score`
+    standard deviations from the window mean and differs from the previous
+    value, and anomalous wherever `anomalies` is True.
+    """
+    _, scores = evaluate_batch(matrix, volatile_score)
+    levels = np.where(scores >= volatile_score, VOLATILE, STABLE)
+    if matrix.shape[1] > 1:
+        levels[matrix[:, -1] == matrix[:, -2]] = STABLE
+    levels[np.asarray(anomalies, dtype=bool)] = ANOMALOUS
+    return levels
+
+
+class PollScheduler:
+    """Decides when each key (a metric name) is polled next.
+
+    Keys sit in a priority queue ordered by next-due time. Poll intervals
+    are whole multiples of `scrape_interval`, so a key is never read twice
+    within one Prometheus scrape. After each poll, report() multiplies the
+    interval of stable keys by `backoff` up to `max_interval`, halves it for
+    volatile keys and resets anomalous keys to `min_interval`. A
+    token bucket caps queries per second across all keys at `qps`, with
+    `keys_per_query` keys sharing one batch when polls are batched, and
+    each batch costing `queries_per_batch` queries (one per window
+    statistic in server window mode). A batch costs its whole price
+    even when it holds a single key, so while
+    the budget is short wait_time() holds off until a full batch is due
+    or the bucket would overflow.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, scrape_interval, min_interval=None, max_interval=None, backoff=2.0, qps=None,
+                 keys_per_query=1, queries_per_batch=1, clock=time.monotonic):
+        self.scrape_interval = scrape_interval
+        self.min_steps = max(1, math.ceil((min_interval or scrape_interval) / scrape_interval))
+        self.max_steps = max(self.min_steps, int((max_interval or scrape_interval) // scrape_interval))
+        self.backoff = backoff
+        self.qps = qps
+        self.keys_per_query = keys_per_query
+        self.queries_per_batch = queries_per_batch
+        self.clock = clock
+        self._steps = {}  # Key -> current interval in scrape intervals
+        self._due = {}  # Key -> next due time; heap entries that disagree are stale
+        self._heap = []
+        self._burst = max(float(qps or 0), float(queries_per_batch))  # A full second of budget, and at least one batch
+        self._tokens = self._burst
+        self._refilled_at = clock()
+        self._lock = threading.Lock()
+        self.polls = 0
+        self.deferred = 0  # Times a due key waited for query budget
+
+    def __len__(self):
+        return len(self._steps)
+
+    def __contains__(self, key):
+        return key in self._steps
+
+    def _schedule(self, key, due):
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+
+    def add(self, key):
+        """Start polling key; new keys are due immediately."""
+        with self._lock:
+            if key not in self._steps:
+                self._steps[key] = self.min_steps
+                self._schedule(key, self.clock())
+
+    def remove(self, key):
+        with self._lock:
+            self._steps.pop(key, None)
+            self._due.pop(key, None)
+
+    def sync(self, keys):
+        """Poll exactly `keys`: add new ones and drop the ones no longer present."""
+        keys = set(keys)
+        with self._lock:
+            for key in [key for key in self._steps if key not in keys]:
+                del self._steps[key]
+                del self._due[key]
+        for key in keys:
+            self.add(key)
+
+    def interval(self, key):
+        return self._steps[key] * self.scrape_interval
+
+    def _refill(self, now):
+        if self.qps:
+            self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self.qps)
+        self._refilled_at = now
+
+    def due(self):
+        """Pop the keys that are due now, as many as the query budget allows.
+
+        Each returned key is rescheduled one interval ahead, so it is retried
+        even if its poll fails and report() is never called.
+        """
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            keys = []
+            while self._heap and self._heap[0][0] <= now:
+                due, key = self._heap[0]
+                if self._due.get(key) != due:
+                    heapq.heappop(self._heap)  # Stale entry of a rescheduled or removed key
+                    continue
+                if self.qps and len(keys) % self.keys_per_query == 0:
+                    # This key starts a new batch
+                    if self._tokens < self.queries_per_batch:
+                        self.deferred += 1
+                        break
+                    self._tokens -= self.queries_per_batch
+                heapq.heappop(self._heap)
+                self._schedule(key, now + self._steps[key] * self.scrape_interval)
+                keys.append(key)
+            self.polls += len(keys)
+            return keys
+
+    def report(self, key, level):
+        """Adjust the interval of a just-polled key from its activity level."""
+        with self._lock:
+            steps = self._steps.get(key)
+            if steps is None:
+                return
+            if level >= ANOMALOUS:
+                new_steps = self.min_steps
+            elif level >= VOLATILE:
+                new_steps = max(self.min_steps, steps // 2)
+            else:
+                new_steps = min(self.max_steps, max(steps + 1, math.ceil(steps * self.backoff)))
+            if new_steps != steps:
+                self._steps[key] = new_steps
+                # The key was rescheduled one old interval after this poll; move it to the new one.
+                polled_at = self._due[key] - steps * self.scrape_interval
+                self._schedule(key, polled_at + new_steps * self.scrape_interval)
+
+    def report_many(self, keys, levels):
+        """Report per-series levels, each key taking the level of its most active series."""
+        activity = {}
+        for key, level in zip(keys, levels):
+            activity[key] = max(activity.get(key, STABLE), level)
+        for key, level in activity.items():
+            self.report(key, level)
+
+    def wait_time(self):
+        """Seconds until due() is worth calling, or None with no keys.
+
+        That is when the next key is due and a batch is affordable. While
+        the bucket is below its burst, it waits longer for a full batch of
+        due keys, but never past the time the bucket fills up.
+        """
+        with self._lock:
+            while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return None
+            now = self.clock()
+            ready = self._heap[0][0]
+            if self.qps:
+                self._refill(now)
+                batch = math.ceil(self.keys_per_query)
+                valid = (due for due, key in self._heap if self._due.get(key) == due)
+                dues = heapq.nsmallest(batch, valid)
+                full_at = dues[-1] if len(dues) == batch else math.inf
+                full_bucket_at = now + (self._burst - self._tokens) / self.qps
+                affordable_at = now + (self.queries_per_batch - self._tokens) / self.qps
+                ready = max(ready, min(full_at, full_bucket_at), affordable_at)
+            return max(ready - now, 0.0)
+
+    def stats(self):
+        with self._lock:
+            intervals = {}
+            for steps in self._steps.values():
+                interval = steps * self.scrape_interval
+                intervals[interval] = intervals.get(interval, 0) + 1
+            return {
+                "keys": len(self._steps),
+                "polls": self.polls,
+                "deferred": self.deferred,
+                "keys_by_interval": {str(interval): count for interval, count in sorted(intervals.items())},
+            }
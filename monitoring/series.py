@@ -0,0 +1,129 @@
+import math
+import sys
+
+
+def parse_samples(result):
+    """Turn an instant query result into (labels, value) pairs, skipping NaN and Inf."""
+    samples = []
+    for item in result:
+        value = float(item["value"][1])
+        if math.isfinite(value):
+            samples.append((item.get("metric", {}), value))
+    return samples
+
+
+def _metric_name(key):
+    for name, value in key:
+        if name == "__name__":
+            return value
+    return ""
+
+
+class SeriesIndex:
+    """Interns series label sets to compact integer ids.
+
+    Each distinct label set (including `__name__`) gets an id used to key
+    windows and models. Once a metric name has `max_series_per_metric`
+    series, or the index holds `max_series`, new series are only admitted
+    while there is room, largest absolute value first (top-k), and series
+    already tracked keep their slots so windows do not churn between cycles.
+    """
+
+    def __init__(self, max_series_per_metric=None, max_series=None):
+        self.max_series_per_metric = max_series_per_metric
+        self.max_series = max_series
+        self._ids = {}  # Label key -> series id
+        self._keys = []  # Series id -> label key, None once removed
+        self._by_metric = {}  # Metric name -> set of series ids
+        self._count = 0
+        self.rejected = 0  # Samples dropped by the cardinality limits
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, series_id):
+        return 0 <= series_id < len(self._keys) and self._keys[series_id] is not None
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((sys.intern(name), sys.intern(value)) for name, value in labels.items()))
+
+    def _add(self, key):
+        series_id = len(self._keys)
+        self._keys.append(key)
+        self._ids[key] = series_id
+        self._by_metric.setdefault(_metric_name(key), set()).add(series_id)
+        self._count += 1
+        return series_id
+
+    def get(self, labels):
+        """Id of an already tracked label set, or None."""
+        return self._ids.get(self._key(labels))
+
+    def select(self, samples):
+        """Map (labels, value) samples to (series_id, value), applying the cardinality limits."""
+        selected = []
+        candidates = {}
+        for labels, value in samples:
+            key = self._key(labels)
+            series_id = self._ids.get(key)
+            if series_id is not None:
+                selected.append((series_id, value))
+            else:
+                candidates.setdefault(labels.get("__name__", ""), []).append((key, value))
+
+        for metric_name, new_series in candidates.items():
+            room = len(new_series)
+            if self.max_series_per_metric is not None:
+                room = self.max_series_per_metric - len(self._by_metric.get(metric_name, ()))
+            if self.max_series is not None:
+                room = min(room, self.max_series - self._count)
+            if room < len(new_series):
+                new_series.sort(key=lambda candidate: abs(candidate[1]), reverse=True)
+            room = max(room, 0)
+            for key, value in new_series[:room]:
+                selected.append((self._add(key), value))
+            self.rejected += len(new_series) - min(room, len(new_series))
+        return selected
+
+    def remove(self, series_id):
+        key = self._keys[series_id]
+        if key is None:
+            return
+        self._keys[series_id] = None
+        del self._ids[key]
+        self._by_metric[_metric_name(key)].discard(series_id)
+        self._count -= 1
+
+    def metric_name(self, series_id):
+        return _metric_name(self._keys[series_id])
+
+    def labels(self, series_id):
+        """Labels of a series, without `__name__`."""
+        return {name: value for name, value in self._keys[series_id] if name != "__name__"}
+
+    def series_ids(self, metric_name):
+        return list(self._by_metric.get(metric_name, ()))
+
+    def describe(self, series_id):
+        """Series in PromQL notation, e.g. `up{job="api"}`."""
+        labels = ",".join(f'{name}="{value}"' for name, value in self.labels(series_id).items())
+        return f"{self.metric_name(series_id)}{{{labels}}}" if labels else self.metric_name(series_id)
+
+    def state(self):
+        """Label sets by series id, for checkpointing."""
+        return [[series_id, list(key)] for series_id, key in enumerate(self._keys) if key is not None]
+
+    def restore(self, state):
+        """Load label sets saved by state(), keeping their series ids."""
+        self._ids.clear()
+        self._by_metric.clear()
+        self._keys = []
+        self._count = 0
+        for series_id, key in state:
+            key = tuple((sys.intern(name), sys.intern(value)) for name, value in key)
+            self._keys.extend([None] * (series_id + 1 - len(self._keys)))
+            self._keys[series_id] = key
+            self._ids[key] = series_id
+            self._by_metric.setdefault(_metric_name(key), set()).add(series_id)
+            self._count += 1
@@ -0,0 +1,117 @@
+import hashlib
+import re
+
+MAX_CACHED_KEYS = 100000  # Ownership decisions remembered per shard map before the cache is reset
+
+
+def series_key(labels):
+    """Canonical string for a label set, identical on every replica."""
+    return ",".join(f"{name}={value}" for name, value in sorted(labels.items()))
+
+
+def shard_index(value):
+    """Parse a shard id such as "2" or a hostname with an ordinal suffix such as "ai-agent-2"."""
+    match = re.search(r"(\d+)$", str(value))
+    if match is None:
+        raise ValueError(f"No shard number in {value!r}")
+    return int(match.group(1))
+
+
+def _weight(key, shard):
+    digest = hashlib.blake2b(f"{shard}:{key}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def owner(key, shard_count):
+    """Shard that owns key under rendezvous (highest random weight) hashing.
+
+    Every shard scores the key and the highest score wins. Going from N to
+    N+1 shards only moves the keys the new shard wins, about 1/(N+1) of
+    them, and removing a shard only moves the keys it owned.
+    """
+    if shard_count <= 1:
+        return 0
+    return max(range(shard_count), key=lambda shard: _weight(key, shard))
+
+
+class ShardMap:
+    """Which series this replica owns out of `shard_count` replicas.
+
+    Series are assigned by label set, or by metric name with by_metric=True
+    so each replica can also restrict its Prometheus queries to the metrics
+    it owns.
+    """
+
+    def __init__(self, shard_id, shard_count, by_metric=False):
+        if not 0 <= shard_id < shard_count:
+            raise ValueError(f"Shard id {shard_id} is outside 0..{shard_count - 1}")
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.by_metric = by_metric
+        self._owned = {}  # Key -> whether this shard owns it
+
+    def owns(self, key):
+        if self.shard_count == 1:
+            return True
+        owned = self._owned.get(key)
+        if owned is None:
+            if len(self._owned) >= MAX_CACHED_KEYS:
+                self._owned.clear()
+            owned = self._owned[key] = owner(key, self.shard_count) == self.shard_id
+        return owned
+
+    def owns_series(self, labels):
+        return self.owns(labels.get("__name__", "") if self.by_metric else series_key(labels))
+
+    def metrics(self, metric_names):
+        """Metric names this shard has to poll."""
+        if not self.by_metric:
+            return list(metric_names)
+        return [metric_name for metric_name in metric_names if self.owns(metric_name)]
+
+    def samples(self, samples):
+        """The (labels, ...) pairs of series this shard owns."""
+        if self.shard_count == 1:
+            return samples
+        return [sample for sample in samples if self.owns_series(sample[0])]
+
+    def disowned(self, series_index):
+        """Ids of tracked series that belong to another shard, e.g. after the shard count changed."""
+        return [
+            series_id for series_id, key in series_index.state()
+            if not self.owns_series({name: value for name, value in key})
+        ]
+
+
+def merge_snapshots(snapshots, now, stale_after):
+    """Merge the latest health snapshot of every shard into one cluster view.
+
+    `snapshots` maps shard id to a dict with shard_count, received_at and
+    metrics. The shard count of the most recent report wins, so reports from
+    shards beyond it are ignored after a scale-down. A series reported by
+    two shards while they rebalance is taken from the fresher report.
+    """
+    if not snapshots:
+        return {"shard_count": 0, "shards": {}, "missing": [], "metrics": []}
+    shard_count = max(snapshots.values(), key=lambda snapshot: snapshot["received_at"])["shard_count"]
+    shards = {}
+    merged = {}
+    for shard_id, snapshot in sorted(snapshots.items(), key=lambda item: item[1]["received_at"]):
+        if shard_id >= shard_count:
+            continue
+        age = now - snapshot["received_at"]
+        shards[shard_id] = {
+            "version": snapshot.get("version"),
+            "age": age,
+            "stale": age > stale_after,
+            "series": len(snapshot["metrics"]),
+        }
+        for metric in snapshot["metrics"]:
+            key = (metric.get("metric_name"), series_key(metric.get("labels") or {}))
+            merged[key] = metric
+    return {
+        "shard_count": shard_count,
+        "shards": {str(shard_id): shards[shard_id] for shard_id in sorted(shards)},
+        "missing": [shard_id for shard_id in range(shard_count) if shard_id not in shards],
+        "metrics": list(merged.values()),
+    }
@@ -0,0 +1,147 @@
+import gzip
+import json
+import os
+import threading
+import time
+
+MAX_RENDERED_BODIES = 64  # Cached response bodies kept per snapshot
+MAX_SELECTIONS = 64  # Cached per-selector subsets of the metrics kept per snapshot
+
+
+class HealthSnapshot:
+    """Immutable set of health results produced by one monitoring cycle.
+
+    The metrics matching a label selector (e.g. an appid's) and response
+    bodies are computed once per distinct key and cached on the snapshot,
+    so serving it is a dictionary lookup. A cycle may refresh only some
+    series, so freshness is tracked per metric (`refreshed_at`) and the age
+    of a selection is that of its least recently refreshed metric.
+    """
+
+    def __init__(self, version, metrics, created_at=None):
+        self.version = version
+        self.created_at = time.time() if created_at is None else created_at
+        self.metrics = tuple(metrics)
+        self.etag = str(version)  # Weak ETag of every response rendered from this snapshot
+        self._selections = {}
+        self._refreshed = {}
+        self._bodies = {}
+
+    def refreshed_at(self, selector=None):
+        """When the least recently refreshed metric matching `selector` was scored; created_at if none match."""
+        key = tuple(sorted((selector or {}).items()))
+        refreshed_at = self._refreshed.get(key)
+        if refreshed_at is None:
+            refreshed_at = min(
+                (metric.get("refreshed_at", self.created_at) for metric in self.select(selector)),
+                default=self.created_at,
+            )
+            if len(self._refreshed) < MAX_SELECTIONS:
+                self._refreshed[key] = refreshed_at
+        return refreshed_at
+
+    def age(self, selector=None):
+        """Seconds since the least recently refreshed metric matching `selector` was scored."""
+        return time.time() - self.refreshed_at(selector)
+
+    def select(self, selector=None):
+        """Metrics whose labels equal every value in `selector` ({label: value}; `__name__` is the metric name)."""
+        if not selector:
+            return self.metrics
+        key = tuple(sorted(selector.items()))
+        selected = self._selections.get(key)
+        if selected is None:
+            selected = tuple(
+                metric for metric in self.metrics
+                if all(
+                    (metric["metric_name"] if name == "__name__" else metric["labels"].get(name)) == value
+                    for name, value in key
+                )
+            )
+            if len(self._selections) < MAX_SELECTIONS:
+                self._selections[key] = selected
+        return selected
+
+    def render(self, appid, compress=False, selector=None, offset=0, limit=None):
+        """Return the JSON (optionally gzipped) response body for `appid`.
+
+        The body holds the metrics matching `selector`, or the page of them
+        starting at `offset` when a `limit` is given; `next_offset` is null
+        on the last page.
+        """
+        key = (appid, compress, tuple(sorted((selector or {}).items())), offset, limit)
+        body = self._bodies.get(key)
+        if body is None:
+            selected = self.select(selector)
+            end = len(selected) if limit is None else min(offset + limit, len(selected))
+            body = (
+                f'{{"appid": {json.dumps(appid)}, "version": {self.version}, '
+                f'"generated_at": {self.refreshed_at(selector)}, "total": {len(selected)}, "offset": {offset}, '
+                f'"next_offset": {json.dumps(end if end < len(selected) else None)}, '
+                f'"metrics": {json.dumps(selected[offset:end])}}}'
+            ).encode()
+            if compress:
+                body = gzip.compress(body, compresslevel=5)
+            if len(self._bodies) < MAX_RENDERED_BODIES:
+                self._bodies[key] = body
+        return body
+
+
+class SnapshotPublisher:
+    """Holds the latest HealthSnapshot; publishing swaps the reference atomically."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        self._snapshot = None
+
+    def publish(self, metrics):
+        with self._lock:
+            self._version += 1
+            snapshot = HealthSnapshot(self._version, metrics)
+            self._snapshot = snapshot
+        return snapshot
+
+    def current(self):
+        return self._snapshot
+
+
+def write_snapshot(path, snapshot):
+    """Atomically replace the file at `path` with the snapshot, for SnapshotReaders in other processes."""
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+        json.dump({"version": snapshot.version, "created_at": snapshot.created_at, "metrics": snapshot.metrics}, f)
+    os.replace(temporary, path)
+
+
+class SnapshotReader:
+    """Serves the latest HealthSnapshot written to a file by write_snapshot in another process.
+
+    current() stats the file and only loads it again once it was replaced,
+    so readers share a snapshot (and its cached bodies) until the next one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._snapshot = None
+
+    def current(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    try:
+                        with open(self.path) as f:
+                            data = json.load(f)
+                    except (OSError, ValueError) as e:
+                        print(f"Exception while reading snapshot {self.path}: {e}")
+                        return self._snapshot
+                    self._snapshot = HealthSnapshot(data["version"], data["metrics"], data["created_at"])
+                    self._stamp = stamp
+        return self._snapshot
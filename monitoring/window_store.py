@@ -0,0 +1,171 @@
+import numpy as np
+
+
+class WindowStore:
+    """Sliding windows for many series backed by one preallocated 2D ring buffer.
+
+    Each series owns a row of `window_size` slots. Appending overwrites the
+    oldest slot in place and updates the running mean and variance of the
+    row in O(1), so no per-sample allocation happens once a series exists.
+    """
+
+    def __init__(self, window_size, capacity=256):
+        self.window_size = window_size
+        self._values = np.zeros((capacity, window_size))
+        self._heads = np.zeros(capacity, dtype=np.int64)  # Next slot to write
+        self._counts = np.zeros(capacity, dtype=np.int64)
+        self._means = np.zeros(capacity)
+        self._m2s = np.zeros(capacity)  # Sum of squared deviations from the mean
+        self._rows = {}
+        self._free_rows = list(range(capacity - 1, -1, -1))
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def keys(self):
+        return list(self._rows)
+
+    def _grow(self):
+        """Double the number of rows, keeping existing windows."""
+        capacity = self._values.shape[0]
+        self._values = np.concatenate([self._values, np.zeros_like(self._values)])
+        for name in ("_heads", "_counts", "_means", "_m2s"):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self._free_rows.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def _row(self, key):
+        row = self._rows.get(key)
+        if row is None:
+            if not self._free_rows:
+                self._grow()
+            row = self._free_rows.pop()
+            self._rows[key] = row
+        return row
+
+    def append(self, key, value):
+        """Add a value to the window of `key`, evicting the oldest if full."""
+        row = self._row(key)
+        head = self._heads[row]
+        count = self._counts[row]
+        mean = self._means[row]
+        if count < self.window_size:
+            # Welford update while the window is still filling up.
+            count += 1
+            delta = value - mean
+            new_mean = mean + delta / count
+            self._m2s[row] += delta * (value - new_mean)
+            self._counts[row] = count
+        else:
+            # Replace the oldest value: adjust mean and M2 without a rescan.
+            old_value = self._values[row, head]
+            new_mean = mean + (value - old_value) / count
+            self._m2s[row] += (value - old_value) * (value - new_mean + old_value - mean)
+        self._means[row] = new_mean
+        self._values[row, head] = value
+        head = (head + 1) % self.window_size
+        self._heads[row] = head
+        if head == 0:
+            # Recompute exactly once per lap so float rounding cannot accumulate.
+            self._means[row] = self._values[row].mean()
+            self._m2s[row] = ((self._values[row] - self._means[row]) ** 2).sum()
+        return row
+
+    def remove(self, key):
+        """Drop the window of `key` and recycle its row."""
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        self._heads[row] = 0
+        self._counts[row] = 0
+        self._means[row] = 0.0
+        self._m2s[row] = 0.0
+        self._free_rows.append(row)
+
+    def state(self):
+        """The backing arrays and key-to-row mapping, for checkpointing."""
+        arrays = {
+            "values": self._values,
+            "heads": self._heads,
+            "counts": self._counts,
+            "means": self._means,
+            "m2s": self._m2s,
+        }
+        return arrays, dict(self._rows)
+
+    def restore(self, arrays, rows):
+        """Adopt arrays saved by state() without copying them.
+
+        The arrays may be copy-on-write memory maps of a checkpoint file.
+        """
+        if arrays["values"].shape[1] != self.window_size:
+            raise ValueError(f"Checkpoint window size {arrays['values'].shape[1]} != {self.window_size}")
+        self._values = arrays["values"]
+        self._heads = arrays["heads"]
+        self._counts = arrays["counts"]
+        self._means = arrays["means"]
+        self._m2s = arrays["m2s"]
+        self._rows = dict(rows)
+        used = set(self._rows.values())
+        self._free_rows = [row for row in range(self._values.shape[0] - 1, -1, -1) if row not in used]
+
+    def count(self, key):
+        row = self._rows.get(key)
+        return 0 if row is None else int(self._counts[row])
+
+    def is_full(self, key):
+        return self.count(key) == self.window_size
+
+    def mean(self, key):
+        return float(self._means[self._rows[key]])
+
+    def std(self, key):
+        """Population standard deviation of the window, matching np.std."""
+        row = self._rows[key]
+        return float(np.sqrt(max(self._m2s[row], 0.0) / self._counts[row]))
+
+    def fill_ratio(self):
+        """Fraction of window slots holding values across all tracked series; 0.0 with none."""
+        if not self._rows:
+            return 0.0
+        rows = np.fromiter(self._rows.values(), dtype=np.int64, count=len(self._rows))
+        return float(self._counts[rows].sum()) / (len(rows) * self.window_size)
+
+    def latest(self, key):
+        row = self._rows[key]
+        return float(self._values[row, self._heads[row] - 1])
+
+    def values(self, key):
+        """Zero-copy view of the stored values in slot order, not time order.
+
+        Suitable for order-independent work such as fitting a model.
+        """
+        row = self._rows[key]
+        return self._values[row, :self._counts[row]]
+
+    def window(self, key):
+        """Values of the window in time order, oldest first."""
+        row = self._rows[key]
+        count = self._counts[row]
+        head = self._heads[row]
+        if count < self.window_size or head == 0:
+            return self._values[row, :count]
+        return np.concatenate([self._values[row, head:], self._values[row, :head]])
+
+    def matrix(self, keys):
+        """(series x window) matrix of the windows of `keys` in time order, gathered in one pass.
+
+        Every key must have a full window.
+        """
+        rows = np.fromiter((self._rows[key] for key in keys), dtype=np.int64, count=len(keys))
+        slots = (self._heads[rows, None] + np.arange(self.window_size)) % self.window_size
+        return self._values[rows[:, None], slots]
+
+    def moments(self, keys):
+        """Running means and population standard deviations of the windows of `keys`, as arrays."""
+        rows = np.fromiter((self._rows[key] for key in keys), dtype=np.int64, count=len(keys))
+        counts = np.maximum(self._counts[rows], 1)
+        return self._means[rows], np.sqrt(np.maximum(self._m2s[rows], 0.0) / counts)
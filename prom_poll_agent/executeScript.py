@@ -1,136 +1,347 @@
 import os
+import sys
 import time
-import requests
 import numpy as np
-from sklearn.ensemble import IsolationForest
-from autogen import ConversableAgent
-from autogen.coding import LocalCommandLineCodeExecutor
+import requests
+from prometheus_client import start_http_server
+
+# Make the shared monitoring package importable when run from a source checkout.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from monitoring.agent import CodeExecutorAgent
+from monitoring.backfill import fetch_backfill, fill_windows
+from monitoring.checkpoint import load_checkpoint, save_checkpoint
+from monitoring.collector import Collector
+from monitoring.detectors import IsolationForestDetector, evaluate_batch
+from monitoring.discovery import MetricDiscovery
+from monitoring.dispatch import AnomalyDispatcher
+from monitoring.instrumentation import CYCLE_SECONDS, DETECTION_SECONDS, record_windows, register_dispatcher
+from monitoring.model_registry import ModelRegistry
+from monitoring.profiler import SlowCycleProfiler
+from monitoring.scheduler import PollScheduler, VOLATILE, activity_levels
+from monitoring.series import SeriesIndex
+from monitoring.sharding import ShardMap, shard_index
+from monitoring.window_store import WindowStore
 
 PROMETHEUS_URL = "http://prometheus:9090"
 WINDOW_SIZE = 100  # Number of data points to train the model
 STD_DEV_THRESHOLD = 2  # Number of standard deviations to flag an anomaly
-FETCH_INTERVAL = 60  # Interval in seconds to fetch metrics
+SCRAPE_INTERVAL = 30  # Prometheus global scrape_interval (prometheus.yml); polling faster re-reads samples
+FETCH_INTERVAL = 60  # Shortest interval in seconds between polls of a metric
+MAX_FETCH_INTERVAL = 600  # Stable metrics back off up to this many seconds between polls
+FETCH_BACKOFF = 2  # Interval multiplier after a poll where all of a metric's series were stable
+VOLATILE_SCORE = 1  # Std devs the newest value must move for a series to count as volatile
+QUERY_BUDGET = 5  # Prometheus queries per second across all scheduled polls
+BATCH_FETCH = True  # Fetch all metrics with a few vector queries instead of one query per metric
+BATCH_CHUNK_SIZE = 200  # Metric names per vector query, keeps responses under Prometheus limits
+COLLECTOR_MAX_WORKERS = 8  # Concurrent requests to Prometheus over the shared connection pool
+REQUEST_TIMEOUT = 5  # Seconds before a single Prometheus request times out
+REQUEST_RETRIES = 2  # Retries with jittered backoff for failed requests
+CYCLE_DEADLINE = FETCH_INTERVAL  # Seconds after which unfinished fetches in a cycle are skipped
+BACKFILL_ON_START = True  # Fill windows from Prometheus range queries before live polling starts
+METRICS_REFRESH_INTERVAL = 300  # Seconds the discovered list of metric names is cached
+METRIC_INCLUDE = []  # Regexes of metric names to monitor; empty monitors every name that is not excluded
+METRIC_EXCLUDE = [r"^go_", r"^python_gc_", r"^scrape_", r"^promhttp_", r"^prometheus_"]  # Runtime and scrape internals
+METRIC_MATCH = []  # Series selectors sent as match[] (e.g. '{job="flask-app"}') to discover only their metric names
+METRICS_LOOKBACK = 3600  # Seconds a metric may go without samples before it is no longer discovered
+CHECKPOINT_DIR = os.environ.get("CHECKPOINT_DIR", "checkpoints")  # Where windows and models are checkpointed
+CHECKPOINT_INTERVAL = 300  # Seconds between checkpoints; 0 disables checkpointing
+CHECKPOINT_MODELS = True  # Also checkpoint fitted models, not just windows
+MODEL_RETRAIN_EVERY = WINDOW_SIZE  # Refit a series model once its window has fully turned over
+MODEL_DRIFT_THRESHOLD = 3  # Refit when the rolling mean drifts this many fit-time std devs
+MODEL_MAX_AGE = 3600  # Refit models older than this many seconds
+MAX_MODELS = 5000  # Least recently used models are evicted beyond this many series
+MAX_SERIES_PER_METRIC = 50  # Label sets tracked per metric name; the largest values win beyond this
+MAX_SERIES = 20000  # Total series tracked across all metrics
+DISPATCH_QUEUE_SIZE = 1000  # Series with undelivered anomalies; further anomalies are dropped and counted
+DISPATCH_COALESCE_WINDOW = 2  # Seconds to gather a burst of anomalies into one agent message
+DISPATCH_MAX_BATCH = 50  # Anomalies per agent message
+DISPATCH_MIN_INTERVAL = 5  # Minimum seconds between agent messages
+ALERT_DEDUP_INTERVAL = 600  # Seconds before the same series is reported to the agent again
+SHARD_ID = shard_index(os.environ.get("SHARD_ID", "0"))  # This replica's shard: a number, or a hostname ending in one
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "1"))  # Replicas splitting the series between them
+SHARD_BY_METRIC = False  # Shard by metric name instead of series, so each replica also queries only its own metrics
+SHARD_CHECKPOINT_DIR = os.path.join(CHECKPOINT_DIR, f"shard-{SHARD_ID}-of-{SHARD_COUNT}")  # This replica's checkpoints; a new shard count starts without one
+HEALTH_API_URL = os.environ.get("HEALTH_API_URL")  # health_api merging the shards' snapshots; unset disables pushing
+SNAPSHOT_PUSH_INTERVAL = SCRAPE_INTERVAL  # Minimum seconds between snapshot pushes to health_api
+SNAPSHOT_PUSH_TIMEOUT = 10  # Seconds before a snapshot push times out
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "8000"))  # Port serving this agent's own /metrics; 0 disables it
+PROFILE_SLOW_CYCLES = float(os.environ.get("PROFILE_SLOW_CYCLES", "0"))  # Print the hottest stacks of cycles slower than this many seconds; 0 disables
+DETECTION_ONLY = os.environ.get("DETECTION_ONLY") == "1"  # Only print anomalies; autogen is then never imported
+
+# Samples stacks during cycles and prints where slow ones spent their time
+cycle_profiler = SlowCycleProfiler(PROFILE_SLOW_CYCLES)
+
+# The series this replica owns; the others are detected by the other replicas
+shard_map = ShardMap(SHARD_ID, SHARD_COUNT, by_metric=SHARD_BY_METRIC)
+
+# Concurrent Prometheus client
+collector = Collector(
+    PROMETHEUS_URL,
+    max_workers=COLLECTOR_MAX_WORKERS,
+    timeout=REQUEST_TIMEOUT,
+    retries=REQUEST_RETRIES,
+    cycle_deadline=CYCLE_DEADLINE,
+    chunk_size=BATCH_CHUNK_SIZE,
+)
+
+# Fitted Isolation Forest models, one per series
+model_registry = ModelRegistry(
+    contamination=0.1,
+    retrain_every=MODEL_RETRAIN_EVERY,
+    drift_threshold=MODEL_DRIFT_THRESHOLD,
+    max_model_age=MODEL_MAX_AGE,
+    max_models=MAX_MODELS,
+)
+isolation_forest = IsolationForestDetector(model_registry)
+
+# Metric names to monitor, cached and filtered; main() applies the changes of each refresh
+discovery = MetricDiscovery(
+    collector,
+    ttl=METRICS_REFRESH_INTERVAL,
+    include=METRIC_INCLUDE,
+    exclude=METRIC_EXCLUDE,
+    match=METRIC_MATCH,
+    lookback=METRICS_LOOKBACK,
+)
 
 # Create a temporary directory to store the code files.
 temp_dir = os.getcwd()
 
-# Create a local command line code executor.
-executor = LocalCommandLineCodeExecutor(
-    timeout=10,  # Timeout for each code execution in seconds.
+# Create an agent with a local command line code executor; autogen is only imported for its first message.
+code_executor_agent = CodeExecutorAgent(
     work_dir=temp_dir,  # Use the temporary directory to store the code files.
-)
-
-# Create an agent with code executor configuration.
-code_executor_agent = ConversableAgent(
-    "code_executor_agent",
-    llm_config=False,  # Turn off LLM for this agent.
-    code_execution_config={"executor": executor},  # Use the local command line code executor.
-    human_input_mode="NEVER",  # Always take human input for this agent for safety.
+    timeout=10,  # Timeout for each code execution in seconds.
 )
 
 def get_all_metrics():
-    """Fetch all available metric names from Prometheus."""
-    try:
-        response = requests.get(f"{PROMETHEUS_URL}/api/v1/label/__name__/values")
-        if response.status_code == 200:
-            return response.json().get("data", [])
-        else:
-            print(f"Error fetching metrics: {response.text}")
-            return []
-    except Exception as e:
-        print(f"Exception while fetching metrics: {e}")
-        return []
+    """Metric names to monitor, from the discovery cache."""
+    return discovery.metrics()
 
-def fetch_metric_data(metric_name):
-    """Fetch the latest data for the selected metric."""
-    try:
-        response = requests.get(f"{PROMETHEUS_URL}/api/v1/query", params={"query": metric_name})
-        if response.status_code == 200:
-            data = response.json().get("data", {}).get("result", [])
-            if data:
-                return float(data[0]['value'][1])
-            else:
-                print(f"No data available for metric: {metric_name}")
-                return None
-        else:
-            print(f"Error fetching metric data for {metric_name}: {response.text}")
-            return None
-    except Exception as e:
-        print(f"Exception while fetching metric data for {metric_name}: {e}")
-        return None
+def fetch_all_metric_data(metrics):
+    """Fetch the latest (labels, value) sample of every series of the given metrics."""
+    result = collector.fetch_metrics(metrics, batch=BATCH_FETCH)
+    if result.skipped:
+        print(f"Skipped {len(result.skipped)} metrics after the {CYCLE_DEADLINE}s cycle deadline")
+    if result.failed:
+        print(f"Failed to fetch {len(result.failed)} metrics")
+    return result.samples
+
+def check_for_anomalies(metric_windows, series_ids):
+    """Check the newest value of every full window using Isolation Forest and Standard Deviation methods.
 
-def check_for_anomalies(metric_values):
-    """Check for anomalies using Isolation Forest and Standard Deviation methods."""
+    All series are evaluated in one batch; earlier points in each window
+    were already checked when they arrived. Returns a boolean array.
+    """
     try:
-        model = IsolationForest(contamination=0.1)
-        model.fit(np.array(metric_values).reshape(-1, 1))
-        predictions = model.predict(np.array(metric_values).reshape(-1, 1))
-        mean = np.mean(metric_values)
-        std_dev = np.std(metric_values)
-        anomalies = []
-
-        for i, value in enumerate(metric_values):
-            is_anomaly = False
-            if predictions[i] == -1:
-                is_anomaly = True
-            if abs(value - mean) > STD_DEV_THRESHOLD * std_dev:
-                is_anomaly = True
-            anomalies.append(is_anomaly)
-        
-        return anomalies
+        matrix = metric_windows.matrix(series_ids)
+        means, std_devs = metric_windows.moments(series_ids)
+        with DETECTION_SECONDS.labels("zscore").time():
+            std_flags, _ = evaluate_batch(matrix, STD_DEV_THRESHOLD, means, std_devs)
+        with DETECTION_SECONDS.labels(isolation_forest.name).time():
+            return isolation_forest.detect(series_ids, matrix) | std_flags
     except Exception as e:
         print(f"Exception while checking for anomalies: {e}")
-        return []
+        return np.zeros(len(series_ids), dtype=bool)
+
+def backfill_windows(series_index, metric_windows, metric_names):
+    """Fill the windows of owned series that have none yet from Prometheus history."""
+    series_values = fetch_backfill(collector, metric_names, WINDOW_SIZE, FETCH_INTERVAL)
+    series_values = [
+        (labels, values) for labels, values in shard_map.samples(series_values)
+        if series_index.get(labels) is None
+    ]
+    filled = fill_windows(metric_windows, series_index, series_values)
+    print(f"Backfilled windows for {filled} series of {len(metric_names)} metrics.")
+
+def forget_series(series_index, metric_windows, series_ids):
+    """Stop tracking the given series, dropping their windows and models."""
+    for series_id in series_ids:
+        series_index.remove(series_id)
+        metric_windows.remove(series_id)
+        model_registry.remove(series_id)
 
 def main():
-    metrics = get_all_metrics()
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+    metrics = shard_map.metrics(get_all_metrics())
     if not metrics:
         print("No metrics found. Retrying...")
         time.sleep(FETCH_INTERVAL)
         return
 
-    metric_values_dict = {}
+    series_index = SeriesIndex(max_series_per_metric=MAX_SERIES_PER_METRIC, max_series=MAX_SERIES)
+    metric_windows = WindowStore(WINDOW_SIZE, capacity=len(metrics))
+    checkpoint_models = model_registry if CHECKPOINT_MODELS else None
+    if CHECKPOINT_INTERVAL:
+        saved_at = load_checkpoint(SHARD_CHECKPOINT_DIR, metric_windows, checkpoint_models, series_index)
+        if saved_at is not None:
+            print(f"Restored checkpoint saved at {time.ctime(saved_at)}")
+    # Hand off series another replica now owns, e.g. after SHARD_BY_METRIC changed.
+    disowned = shard_map.disowned(series_index)
+    forget_series(series_index, metric_windows, disowned)
+    if disowned:
+        print(f"Dropped {len(disowned)} series owned by other shards")
+    # Ownership only changes with the shard count, which starts without a checkpoint and backfills every metric.
+    missing = [metric_name for metric_name in metrics if not series_index.series_ids(metric_name)]
+    if BACKFILL_ON_START and missing:
+        backfill_windows(series_index, metric_windows, missing)
+    poll_scheduler = PollScheduler(
+        SCRAPE_INTERVAL,
+        min_interval=FETCH_INTERVAL,
+        max_interval=MAX_FETCH_INTERVAL,
+        backoff=FETCH_BACKOFF,
+        qps=QUERY_BUDGET,
+        keys_per_query=BATCH_CHUNK_SIZE if BATCH_FETCH else 1,
+    )
+    poll_scheduler.sync(metrics)
+    last_checkpoint = time.monotonic()
+    series_results = {}  # Latest health result per series id, pushed to health_api
+    snapshot_version = 0
     while True:  # Continuous loop to keep the script running
-        for metric_name in metrics:
-            metric_value = fetch_metric_data(metric_name)
-            if metric_value is not None:
-                if metric_name not in metric_values_dict:
-                    metric_values_dict[metric_name] = []
-                metric_values_dict[metric_name].append(metric_value)
-                if len(metric_values_dict[metric_name]) > WINDOW_SIZE:
-                    metric_values_dict[metric_name].pop(0)
-                if len(metric_values_dict[metric_name]) == WINDOW_SIZE:
-                    anomalies = check_for_anomalies(metric_values_dict[metric_name])
-                    for i, is_anomaly in enumerate(anomalies):
-                        if is_anomaly:
-                            result = {
-                                "metric_name": metric_name,
-                                "metric_value": metric_values_dict[metric_name][i],
-                                "anomaly_detected": is_anomaly
-                            }
-                            print(f"Anomaly detected: {result}")
-                            send_to_autogen_agent(result)
-        print("Waiting for the next fetch interval...")
-        time.sleep(FETCH_INTERVAL)  # Wait before fetching metrics again
+        added, removed = discovery.refresh(if_expired=True)
+        removed = shard_map.metrics(removed)
+        if removed:
+            print(f"Forgetting {len(removed)} metrics no longer in Prometheus")
+            for metric_name in removed:
+                poll_scheduler.remove(metric_name)
+                series_ids = series_index.series_ids(metric_name)
+                forget_series(series_index, metric_windows, series_ids)
+                for series_id in series_ids:
+                    series_results.pop(series_id, None)
+        added = shard_map.metrics(added)
+        if added:
+            print(f"Discovered {len(added)} new metrics")
+            for metric_name in added:
+                poll_scheduler.add(metric_name)
+            if BACKFILL_ON_START:
+                backfill_windows(series_index, metric_windows, added)
+        due = poll_scheduler.due()
+        if not due:
+            # Wait until the next metric is due or the metric list needs refreshing
+            wait = poll_scheduler.wait_time()
+            time.sleep(min(FETCH_INTERVAL if wait is None else wait, discovery.expires_in()) + 0.01)
+            continue
+        with cycle_profiler.profile(), CYCLE_SECONDS.time():
+            full = []
+            filling = []
+            for series_id, metric_value in series_index.select(shard_map.samples(fetch_all_metric_data(due))):
+                metric_windows.append(series_id, metric_value)
+                if metric_windows.is_full(series_id):
+                    full.append(series_id)
+                else:
+                    filling.append(series_id)
+            anomalies = check_for_anomalies(metric_windows, full)
+            # Poll active metrics sooner and stable ones less often; filling windows count as volatile.
+            levels = activity_levels(metric_windows.matrix(full), anomalies, VOLATILE_SCORE).tolist()
+            poll_scheduler.report_many(
+                [series_index.metric_name(series_id) for series_id in full + filling],
+                levels + [VOLATILE] * len(filling),
+            )
+        record_windows(metric_windows)
+        for i in np.flatnonzero(anomalies):
+            result = {
+                "metric_name": series_index.describe(full[i]),
+                "metric_value": metric_windows.latest(full[i]),
+                "anomaly_detected": True
+            }
+            print(f"Anomaly detected: {result}")
+            send_to_autogen_agent(result)
+        if HEALTH_API_URL:
+            for series_id in filling:
+                series_results[series_id] = series_result(series_index, metric_windows, series_id, None)
+            for series_id, is_anomaly in zip(full, anomalies.tolist()):
+                series_results[series_id] = series_result(series_index, metric_windows, series_id, is_anomaly)
+            snapshot_version += 1
+            snapshot_pusher.dispatch("snapshot", {
+                "shard_count": SHARD_COUNT,
+                "version": snapshot_version,
+                "generated_at": time.time(),
+                "metrics": list(series_results.values()),
+            })
+        stats = model_registry.stats(include_series=False)
+        print(f"Models: {stats['models']}, retrains: {stats['total_retrains']}, "
+              f"evictions: {stats['total_evictions']}, fit time: {stats['total_fit_seconds']}s")
+        stats = dispatcher.stats()
+        print(f"Anomalies sent: {stats['sent']} in {stats['batches']} messages, pending: {stats['pending']}, "
+              f"deduplicated: {stats['deduplicated']}, dropped: {stats['dropped']}, failed: {stats['failed']}")
+        if CHECKPOINT_INTERVAL and time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+            try:
+                path = save_checkpoint(SHARD_CHECKPOINT_DIR, metric_windows, checkpoint_models, series_index)
+                print(f"Checkpoint written to {path}")
+            except Exception as e:
+                print(f"Exception while writing checkpoint: {e}")
+            last_checkpoint = time.monotonic()
 
-def send_to_autogen_agent(result):
-    """Send the anomaly result to the autogen agent."""
+def series_result(series_index, metric_windows, series_id, is_anomaly):
+    """Health result of a series in the format health_api serves; is_anomaly is None while the window fills."""
+    if is_anomaly is None:
+        health_status = "Insufficient data"
+    else:
+        health_status = "Unhealthy" if is_anomaly else "Healthy"
+    return {
+        "metric_name": series_index.metric_name(series_id),
+        "labels": series_index.labels(series_id),
+        "metric_value": metric_windows.latest(series_id),
+        "health_status": health_status,
+        "anomaly_detected": bool(is_anomaly),
+    }
+
+def push_snapshot(snapshots):
+    """Send this shard's latest health results to health_api, which merges all shards."""
     try:
-        message_with_code_block = f"""This is a message with code block.
+        response = requests.post(
+            f"{HEALTH_API_URL}/shards/{SHARD_ID}", json=snapshots[-1], timeout=SNAPSHOT_PUSH_TIMEOUT
+        )
+        response.raise_for_status()
+    except Exception as e:
+        print(f"Exception while pushing snapshot to {HEALTH_API_URL}: {e}")
+
+# Pushes only the newest snapshot, in the background, at most every SNAPSHOT_PUSH_INTERVAL
+snapshot_pusher = AnomalyDispatcher(
+    push_snapshot,
+    queue_size=1,
+    coalesce_window=0,
+    max_batch=1,
+    min_interval=SNAPSHOT_PUSH_INTERVAL,
+    dedup_interval=0,
+    name="snapshot-push",
+)
+register_dispatcher(snapshot_pusher)
+
+def send_results_batch(results):
+    """Send a batch of anomaly results to the autogen agent as one message."""
+    results_block = "\n".join(str(result) for result in results)
+    message_with_code_block = f"""This is a message with code block.
 The code block is below:
 ```python
-{result}
+{results_block}
 ```
 """
-        code_executor_agent.handle_message(message_with_code_block)
-    except Exception as e:
-        print(f"Exception while sending data to autogen agent: {e}")        
+    code_executor_agent.handle_message(message_with_code_block)
+
+# Delivers anomalies to the autogen agent in the background so a slow agent never stalls detection
+dispatcher = AnomalyDispatcher(
+    send_results_batch,
+    queue_size=DISPATCH_QUEUE_SIZE,
+    coalesce_window=DISPATCH_COALESCE_WINDOW,
+    max_batch=DISPATCH_MAX_BATCH,
+    min_interval=DISPATCH_MIN_INTERVAL,
+    dedup_interval=ALERT_DEDUP_INTERVAL,
+)
+register_dispatcher(dispatcher)
+
+def send_to_autogen_agent(result):
+    """Queue the anomaly result for the autogen agent without waiting for delivery."""
+    if DETECTION_ONLY:
+        return
+    dispatcher.dispatch(result["metric_name"], result)
 
 if __name__ == "__main__":
     print("Starting Prometheus polling agent...");  # Start the agent               
     main()              
-# Execute the script
-code_executor_agent.handle_message("executeScript.py")  # Execute the script
+    # Execute the script
+    if not DETECTION_ONLY:
+        code_executor_agent.handle_message("executeScript.py")  # Execute the script
 # Output:               
 # Starting Prometheus polling agent...
 # No metrics found. Retrying...
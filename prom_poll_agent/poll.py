@@ -1,72 +1,154 @@
+import os
+import sys
 import time
 import requests
 import numpy as np
-from sklearn.ensemble import IsolationForest
+from prometheus_client import start_http_server
 
-PROMETHEUS_URL = "http://prometheus:9090/api/v1/query?query=process_cpu_seconds_total"
+# Make the shared monitoring package importable when run from a source checkout.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from monitoring.collector import Collector
+from monitoring.dispatch import AnomalyDispatcher
+from monitoring.instrumentation import CYCLE_SECONDS, record_windows, register_dispatcher
+from monitoring.model_registry import ModelRegistry
+from monitoring.scheduler import ANOMALOUS, PollScheduler, VOLATILE, activity_levels
+from monitoring.series import SeriesIndex, parse_samples
+from monitoring.window_store import WindowStore
+
+METRIC_NAMES = ["process_cpu_seconds_total"]  # Metrics to poll, each scheduled on its own
+PROMETHEUS_URL = "http://prometheus:9090"
 MASTER_AGENT_URL = "http://master-agent:port/endpoint"  # Replace with actual URL and endpoint
+MASTER_AGENT_TIMEOUT = 5  # Seconds before a request to the master agent times out
 WINDOW_SIZE = 100  # Number of data points to train the model
 STD_DEV_THRESHOLD = 2  # Number of standard deviations to flag an anomaly
+SCRAPE_INTERVAL = 30  # Prometheus global scrape_interval (prometheus.yml); polling faster re-reads samples
+MAX_FETCH_INTERVAL = 300  # Stable metrics back off up to this many seconds between polls
+FETCH_BACKOFF = 2  # Interval multiplier after a poll where the metric was stable
+VOLATILE_SCORE = 1  # Std devs the newest value must move for the metric to count as volatile
+QUERY_BUDGET = 2  # Prometheus queries per second across all metrics
+REQUEST_TIMEOUT = 5  # Seconds before a single Prometheus request times out
+REQUEST_RETRIES = 2  # Retries with jittered backoff for failed requests
+MODEL_RETRAIN_EVERY = WINDOW_SIZE  # Refit a series model once its window has fully turned over
+MODEL_DRIFT_THRESHOLD = 3  # Refit when the rolling mean drifts this many fit-time std devs
+MODEL_MAX_AGE = 3600  # Refit models older than this many seconds
+MAX_SERIES_PER_METRIC = 50  # Label sets tracked per metric name; the largest values win beyond this
+DISPATCH_QUEUE_SIZE = 1000  # Series with undelivered anomalies; further anomalies are dropped and counted
+DISPATCH_COALESCE_WINDOW = 2  # Seconds to gather a burst of anomalies into one master agent request
+DISPATCH_MAX_BATCH = 100  # Anomalies per master agent request
+DISPATCH_MIN_INTERVAL = 1  # Minimum seconds between master agent requests
+ALERT_DEDUP_INTERVAL = 600  # Seconds before the same series is reported to the master agent again
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "8000"))  # Port serving this agent's own /metrics; 0 disables it
+
+# Series ids for every label set the metrics return
+series_index = SeriesIndex(max_series_per_metric=MAX_SERIES_PER_METRIC)
+
+# Sliding windows of values per series id for training the models
+metric_windows = WindowStore(WINDOW_SIZE)
+
+# Prometheus client with timeouts and retries
+collector = Collector(PROMETHEUS_URL, max_workers=1, timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES)
 
-# List to store the metric values for training the model
-metric_values = []
+# When each metric is polled next, adapted to how active it is
+poll_scheduler = PollScheduler(
+    SCRAPE_INTERVAL,
+    max_interval=MAX_FETCH_INTERVAL,
+    backoff=FETCH_BACKOFF,
+    qps=QUERY_BUDGET,
+)
+
+# Fitted Isolation Forest models, one per series
+model_registry = ModelRegistry(
+    contamination=0.1,
+    retrain_every=MODEL_RETRAIN_EVERY,
+    drift_threshold=MODEL_DRIFT_THRESHOLD,
+    max_model_age=MODEL_MAX_AGE,
+    max_models=len(METRIC_NAMES) * MAX_SERIES_PER_METRIC,
+)
 
 def fetch_metrics():
+    poll_scheduler.sync(METRIC_NAMES)
     while True:
-        try:
-            print(f"Fetching metrics from {PROMETHEUS_URL}")
-            response = requests.get(PROMETHEUS_URL)
-            response.raise_for_status()
-            data = response.json()
-            # Extract and print the metric value
-            if data['status'] == 'success' and data['data']['result']:
-                metric_value = float(data['data']['result'][0]['value'][1])
-                print("Fetched Metric Value:", metric_value)
-                # Add the metric value to the list
-                metric_values.append(metric_value)
-                # Keep only the last WINDOW_SIZE values
-                if len(metric_values) > WINDOW_SIZE:
-                    metric_values.pop(0)
-                # Check for anomalies if we have enough data points
-                if len(metric_values) == WINDOW_SIZE:
-                    check_for_anomalies(metric_value)
-            else:
-                print("No data found for the metric.")
-        except requests.exceptions.RequestException as e:
-            print(f"Exception occurred: {e}")
-            print("Retrying in 5 seconds...")
-        time.sleep(5)
-
-def check_for_anomalies(metric_value):
-    # Train the Isolation Forest model
-    model = IsolationForest(contamination=0.1)
-    model.fit(np.array(metric_values).reshape(-1, 1))
-    # Predict anomalies
-    prediction = model.predict([[metric_value]])
-    mean = np.mean(metric_values)
-    std_dev = np.std(metric_values)
+        with CYCLE_SECONDS.time():
+            for metric_name in poll_scheduler.due():
+                try:
+                    print(f"Fetching {metric_name} from {PROMETHEUS_URL}")
+                    result = collector.query(metric_name)
+                except Exception as e:
+                    print(f"Exception occurred: {e}")
+                    print(f"Retrying in {poll_scheduler.interval(metric_name)} seconds...")
+                    continue
+                # Extract and print the metric value
+                if not result:
+                    print(f"No data found for the metric {metric_name}.")
+                    continue
+                levels = []
+                for series_id, metric_value in series_index.select(parse_samples(result)):
+                    print(f"Fetched Metric Value for {series_index.describe(series_id)}:", metric_value)
+                    # Add the metric value to its series window, evicting the oldest value
+                    metric_windows.append(series_id, metric_value)
+                    # Check for anomalies if we have enough data points
+                    if not metric_windows.is_full(series_id):
+                        levels.append(VOLATILE)  # Fill the window at the fastest rate
+                    elif check_for_anomalies(series_id, metric_value):
+                        levels.append(ANOMALOUS)
+                    else:
+                        matrix = metric_windows.matrix([series_id])
+                        levels.append(int(activity_levels(matrix, [False], VOLATILE_SCORE)[0]))
+                # The metric is polled as often as its most active series needs
+                poll_scheduler.report_many([metric_name] * len(levels), levels)
+        record_windows(metric_windows)
+        time.sleep(poll_scheduler.wait_time())  # Wait until the next metric is due
+
+def check_for_anomalies(series_id, metric_value):
+    metric_name = series_index.describe(series_id)
+    mean = metric_windows.mean(series_id)
+    std_dev = metric_windows.std(series_id)
+    # Predict anomalies with the cached Isolation Forest model, refitting it if due
+    prediction = model_registry.predict(
+        series_id, metric_windows.values(series_id), np.array([metric_value]), mean, std_dev
+    )
     is_anomaly = False
 
     if prediction[0] == -1:
-        print(f"Isolation Forest detected anomaly! Metric Value: {metric_value}")
+        print(f"Isolation Forest detected anomaly for {metric_name}! Metric Value: {metric_value}")
         is_anomaly = True
 
     if abs(metric_value - mean) > STD_DEV_THRESHOLD * std_dev:
-        print(f"Standard Deviation detected anomaly! Metric Value: {metric_value}, Mean: {mean}, Std Dev: {std_dev}")
+        print(f"Standard Deviation detected anomaly for {metric_name}! Metric Value: {metric_value}, Mean: {mean}, Std Dev: {std_dev}")
         is_anomaly = True
 
     if is_anomaly:
-        print("Anomaly detected")
-        send_to_master_agent(metric_value)
+        print(f"Anomaly detected for {metric_name}")
+        send_to_master_agent(series_id, metric_value)
+    return is_anomaly
+
+def post_anomalies(anomalies):
+    """Send a batch of anomalies to the master agent in one request."""
+    response = requests.post(MASTER_AGENT_URL, json={"anomalies": anomalies}, timeout=MASTER_AGENT_TIMEOUT)
+    response.raise_for_status()
+    print(f"Successfully sent {len(anomalies)} anomalies to master agent.")
+
+# Delivers anomalies to the master agent in the background so an unreachable agent never stalls polling
+dispatcher = AnomalyDispatcher(
+    post_anomalies,
+    queue_size=DISPATCH_QUEUE_SIZE,
+    coalesce_window=DISPATCH_COALESCE_WINDOW,
+    max_batch=DISPATCH_MAX_BATCH,
+    min_interval=DISPATCH_MIN_INTERVAL,
+    dedup_interval=ALERT_DEDUP_INTERVAL,
+)
+register_dispatcher(dispatcher)
 
-def send_to_master_agent(metric_value):
-    try:
-        response = requests.post(MASTER_AGENT_URL, json={"metric_value": metric_value})
-        response.raise_for_status()
-        print("Successfully sent data to master agent.")
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to send data to master agent: {e}")
+def send_to_master_agent(series_id, metric_value):
+    """Queue the anomaly for the master agent without waiting for delivery."""
+    dispatcher.dispatch(series_id, {
+        "metric_name": series_index.metric_name(series_id),
+        "labels": series_index.labels(series_id),
+        "metric_value": metric_value,
+    })
 
 if __name__ == "__main__":
     print("Starting Prometheus polling agent...")
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
     fetch_metrics()
\ No newline at end of file
@@ -1,104 +1,240 @@
 import time
 import requests
 import numpy as np
-from sklearn.ensemble import IsolationForest
 import json
+import os
+import sys
+from prometheus_client import start_http_server
+
+# Make the shared monitoring package importable when run from a source checkout.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from monitoring.backfill import fetch_backfill, fill_windows
+from monitoring.collector import Collector
+from monitoring.detectors import IsolationForestDetector, evaluate_batch
+from monitoring.discovery import MetricDiscovery
+from monitoring.dispatch import AnomalyDispatcher
+from monitoring.instrumentation import CYCLE_SECONDS, DETECTION_SECONDS, record_windows, register_dispatcher
+from monitoring.model_registry import ModelRegistry
+from monitoring.profiler import SlowCycleProfiler
+from monitoring.scheduler import PollScheduler, VOLATILE, activity_levels
+from monitoring.series import SeriesIndex
+from monitoring.window_store import WindowStore
 
 PROMETHEUS_URL = "http://prometheus:9090"
 MASTER_AGENT_URL = "http://master-agent:port/endpoint"  # Replace with actual URL and endpoint
+MASTER_AGENT_TIMEOUT = 5  # Seconds before a request to the master agent times out
 WINDOW_SIZE = 100  # Number of data points to train the model
 STD_DEV_THRESHOLD = 2  # Number of standard deviations to flag an anomaly
+SCRAPE_INTERVAL = 30  # Prometheus global scrape_interval (prometheus.yml); polling faster re-reads samples
+FETCH_INTERVAL = 60  # Shortest interval in seconds between polls of a metric
+MAX_FETCH_INTERVAL = 600  # Stable metrics back off up to this many seconds between polls
+FETCH_BACKOFF = 2  # Interval multiplier after a poll where all of a metric's series were stable
+VOLATILE_SCORE = 1  # Std devs the newest value must move for a series to count as volatile
+QUERY_BUDGET = 5  # Prometheus queries per second across all scheduled polls
+BATCH_FETCH = True  # Fetch all metrics with a few vector queries instead of one query per metric
+BATCH_CHUNK_SIZE = 200  # Metric names per vector query, keeps responses under Prometheus limits
+COLLECTOR_MAX_WORKERS = 8  # Concurrent requests to Prometheus over the shared connection pool
+REQUEST_TIMEOUT = 5  # Seconds before a single Prometheus request times out
+REQUEST_RETRIES = 2  # Retries with jittered backoff for failed requests
+CYCLE_DEADLINE = FETCH_INTERVAL  # Seconds after which unfinished fetches in a cycle are skipped
+BACKFILL_ON_START = True  # Fill windows from Prometheus range queries before live polling starts
+METRICS_REFRESH_INTERVAL = 300  # Seconds the discovered list of metric names is cached
+METRIC_INCLUDE = []  # Regexes of metric names to monitor; empty monitors every name that is not excluded
+METRIC_EXCLUDE = [r"^go_", r"^python_gc_", r"^scrape_", r"^promhttp_", r"^prometheus_"]  # Runtime and scrape internals
+METRIC_MATCH = []  # Series selectors sent as match[] (e.g. '{job="flask-app"}') to discover only their metric names
+METRICS_LOOKBACK = 3600  # Seconds a metric may go without samples before it is no longer discovered
+MODEL_RETRAIN_EVERY = WINDOW_SIZE  # Refit a series model once its window has fully turned over
+MODEL_DRIFT_THRESHOLD = 3  # Refit when the rolling mean drifts this many fit-time std devs
+MODEL_MAX_AGE = 3600  # Refit models older than this many seconds
+MAX_MODELS = 5000  # Least recently used models are evicted beyond this many series
+MAX_SERIES_PER_METRIC = 50  # Label sets tracked per metric name; the largest values win beyond this
+MAX_SERIES = 20000  # Total series tracked across all metrics
+DISPATCH_QUEUE_SIZE = 1000  # Series with undelivered anomalies; further anomalies are dropped and counted
+DISPATCH_COALESCE_WINDOW = 2  # Seconds to gather a burst of anomalies into one master agent request
+DISPATCH_MAX_BATCH = 100  # Anomalies per master agent request
+DISPATCH_MIN_INTERVAL = 1  # Minimum seconds between master agent requests
+ALERT_DEDUP_INTERVAL = 600  # Seconds before the same series is reported to the master agent again
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "8000"))  # Port serving this agent's own /metrics; 0 disables it
+PROFILE_SLOW_CYCLES = float(os.environ.get("PROFILE_SLOW_CYCLES", "0"))  # Print the hottest stacks of cycles slower than this many seconds; 0 disables
+
+# Series ids for every tracked label set
+series_index = SeriesIndex(max_series_per_metric=MAX_SERIES_PER_METRIC, max_series=MAX_SERIES)
+
+# Sliding windows of values per series id for training the model
+metric_windows = WindowStore(WINDOW_SIZE)
+
+# When each metric is polled next, adapted to how active its series are
+poll_scheduler = PollScheduler(
+    SCRAPE_INTERVAL,
+    min_interval=FETCH_INTERVAL,
+    max_interval=MAX_FETCH_INTERVAL,
+    backoff=FETCH_BACKOFF,
+    qps=QUERY_BUDGET,
+    keys_per_query=BATCH_CHUNK_SIZE if BATCH_FETCH else 1,
+)
+
+# Concurrent Prometheus client
+collector = Collector(
+    PROMETHEUS_URL,
+    max_workers=COLLECTOR_MAX_WORKERS,
+    timeout=REQUEST_TIMEOUT,
+    retries=REQUEST_RETRIES,
+    cycle_deadline=CYCLE_DEADLINE,
+    chunk_size=BATCH_CHUNK_SIZE,
+)
+
+# Fitted Isolation Forest models, one per series
+model_registry = ModelRegistry(
+    contamination=0.1,
+    retrain_every=MODEL_RETRAIN_EVERY,
+    drift_threshold=MODEL_DRIFT_THRESHOLD,
+    max_model_age=MODEL_MAX_AGE,
+    max_models=MAX_MODELS,
+)
+isolation_forest = IsolationForestDetector(model_registry)
+
+# Samples stacks during cycles and prints where slow ones spent their time
+cycle_profiler = SlowCycleProfiler(PROFILE_SLOW_CYCLES)
+
+def apply_metric_changes(added, removed):
+    """Start polling (and backfill) newly discovered metrics and forget the ones Prometheus no longer has."""
+    for metric_name in removed:
+        poll_scheduler.remove(metric_name)
+        for series_id in series_index.series_ids(metric_name):
+            series_index.remove(series_id)
+            metric_windows.remove(series_id)
+            model_registry.remove(series_id)
+    if removed:
+        print(f"Forgot {len(removed)} metrics no longer in Prometheus")
+    for metric_name in added:
+        poll_scheduler.add(metric_name)
+    if BACKFILL_ON_START and added:
+        series_values = fetch_backfill(collector, added, WINDOW_SIZE, FETCH_INTERVAL)
+        filled = fill_windows(metric_windows, series_index, series_values)
+        print(f"Backfilled windows for {filled} series of {len(added)} metrics.")
 
-# Dictionary to store the metric values for training the model
-metric_values_dict = {}
+# Metric names to monitor, cached and filtered; changes reach the scheduler and windows through apply_metric_changes
+discovery = MetricDiscovery(
+    collector,
+    ttl=METRICS_REFRESH_INTERVAL,
+    include=METRIC_INCLUDE,
+    exclude=METRIC_EXCLUDE,
+    match=METRIC_MATCH,
+    lookback=METRICS_LOOKBACK,
+    on_change=apply_metric_changes,
+)
 
 def get_all_metrics():
-    """Fetch all available metric names from Prometheus."""
-    response = requests.get(f"{PROMETHEUS_URL}/api/v1/label/__name__/values")
-    if response.status_code == 200:
-        return response.json().get("data", [])
-    else:
-        print("Error fetching metrics:", response.text)
-        return []
+    """Metric names to monitor, from the discovery cache."""
+    return discovery.metrics()
 
 def fetch_metrics():
     """Fetch data for all available metrics and evaluate anomalies."""
-    metrics = get_all_metrics()
-    if not metrics:
+    # The first discovery schedules (and backfills) every metric
+    if not get_all_metrics():
         print("No metrics found.")
         return
 
     while True:
         results = []
-        for metric_name in metrics:
-            try:
-                print(f"Fetching metrics for {metric_name} from {PROMETHEUS_URL}")
-                response = requests.get(f"{PROMETHEUS_URL}/api/v1/query", params={"query": metric_name})
-                response.raise_for_status()
-                data = response.json()
-                # Extract and print the metric value
-                if data['status'] == 'success' and data['data']['result']:
-                    metric_value = float(data['data']['result'][0]['value'][1])
-                    print(f"Fetched Metric Value for {metric_name}: {metric_value}")
-                    # Add the metric value to the list
-                    if metric_name not in metric_values_dict:
-                        metric_values_dict[metric_name] = []
-                    metric_values_dict[metric_name].append(metric_value)
-                    # Keep only the last WINDOW_SIZE values
-                    if len(metric_values_dict[metric_name]) > WINDOW_SIZE:
-                        metric_values_dict[metric_name].pop(0)
-                    # Check for anomalies if we have enough data points
-                    if len(metric_values_dict[metric_name]) == WINDOW_SIZE:
-                        is_anomaly = check_for_anomalies(metric_name, metric_value)
-                        result = {
-                            "metric_name": metric_name,
-                            "metric_value": metric_value,
-                            "anomaly_detected": is_anomaly
-                        }
-                        results.append(result)
+        get_all_metrics()  # Refreshes once the cache expires, adding and removing scheduled metrics
+        due = poll_scheduler.due()
+        if not due:
+            # Wait until the next metric is due or the metric list needs refreshing
+            wait = poll_scheduler.wait_time()
+            time.sleep(min(FETCH_INTERVAL if wait is None else wait, discovery.expires_in()) + 0.01)
+            continue
+        print(f"Fetching {len(due)} of {len(poll_scheduler)} metrics from {PROMETHEUS_URL}")
+        with cycle_profiler.profile(), CYCLE_SECONDS.time():
+            cycle = collector.fetch_metrics(due, batch=BATCH_FETCH)
+            if cycle.skipped:
+                print(f"Skipped {len(cycle.skipped)} metrics after the {CYCLE_DEADLINE}s cycle deadline: {cycle.skipped}")
+            if cycle.failed:
+                print(f"No data found for {len(cycle.failed)} metrics: {cycle.failed}")
+            full = []
+            filling = []
+            for series_id, metric_value in series_index.select(cycle.samples):
+                print(f"Fetched Metric Value for {series_index.describe(series_id)}: {metric_value}")
+                # Add the metric value to its series window, evicting the oldest value
+                metric_windows.append(series_id, metric_value)
+                # Check for anomalies once we have enough data points
+                if metric_windows.is_full(series_id):
+                    full.append(series_id)
                 else:
-                    print(f"No data found for the metric {metric_name}.")
-            except requests.exceptions.RequestException as e:
-                print(f"Exception occurred while fetching {metric_name}: {e}")
-                print("Retrying in 5 seconds...")
-            time.sleep(5)
-        
+                    filling.append(series_id)
+
+            anomalies = check_for_anomalies(full)
+            # Poll active metrics sooner and stable ones less often; filling windows count as volatile.
+            levels = activity_levels(metric_windows.matrix(full), anomalies, VOLATILE_SCORE).tolist()
+            poll_scheduler.report_many(
+                [series_index.metric_name(series_id) for series_id in full + filling],
+                levels + [VOLATILE] * len(filling),
+            )
+        record_windows(metric_windows)
+
+        for series_id, is_anomaly in zip(full, anomalies.tolist()):
+            result = {
+                "metric_name": series_index.metric_name(series_id),
+                "labels": series_index.labels(series_id),
+                "metric_value": metric_windows.latest(series_id),
+                "anomaly_detected": is_anomaly
+            }
+            results.append(result)
+
         # Print results in JSON format
         print(json.dumps(results, indent=4))
-        time.sleep(60)  # Wait for 1 minute before fetching the metrics again
-
-def check_for_anomalies(metric_name, metric_value):
-    # Train the Isolation Forest model
-    model = IsolationForest(contamination=0.1)
-    model.fit(np.array(metric_values_dict[metric_name]).reshape(-1, 1))
-    # Predict anomalies
-    prediction = model.predict([[metric_value]])
-    mean = np.mean(metric_values_dict[metric_name])
-    std_dev = np.std(metric_values_dict[metric_name])
-    is_anomaly = False
-
-    if prediction[0] == -1:
-        print(f"Isolation Forest detected anomaly for {metric_name}! Metric Value: {metric_value}")
-        is_anomaly = True
-
-    if abs(metric_value - mean) > STD_DEV_THRESHOLD * std_dev:
-        print(f"Standard Deviation detected anomaly for {metric_name}! Metric Value: {metric_value}, Mean: {mean}, Std Dev: {std_dev}")
-        is_anomaly = True
-
-    if is_anomaly:
+
+def check_for_anomalies(series_ids):
+    """Check the newest value of every full window in one batch, returning a boolean array."""
+    matrix = metric_windows.matrix(series_ids)
+    means, std_devs = metric_windows.moments(series_ids)
+    with DETECTION_SECONDS.labels("zscore").time():
+        std_flags, scores = evaluate_batch(matrix, STD_DEV_THRESHOLD, means, std_devs)
+    # Predict anomalies with the cached Isolation Forest models, refitting them if due
+    with DETECTION_SECONDS.labels(isolation_forest.name).time():
+        forest_flags = isolation_forest.detect(series_ids, matrix)
+
+    for i in np.flatnonzero(forest_flags | std_flags):
+        series_id = series_ids[i]
+        metric_name = series_index.describe(series_id)
+        metric_value = float(matrix[i, -1])
+        if forest_flags[i]:
+            print(f"Isolation Forest detected anomaly for {metric_name}! Metric Value: {metric_value}")
+        if std_flags[i]:
+            print(f"Standard Deviation detected anomaly for {metric_name}! Metric Value: {metric_value}, "
+                  f"Mean: {means[i]}, Std Dev: {std_devs[i]}, Score: {scores[i]:.2f}")
         print(f"Anomaly detected for {metric_name}")
-        send_to_master_agent(metric_name, metric_value)
+        send_to_master_agent(series_id, metric_value)
+
+    return forest_flags | std_flags
+
+def post_anomalies(anomalies):
+    """Send a batch of anomalies to the master agent in one request."""
+    response = requests.post(MASTER_AGENT_URL, json={"anomalies": anomalies}, timeout=MASTER_AGENT_TIMEOUT)
+    response.raise_for_status()
+    print(f"Successfully sent {len(anomalies)} anomalies to master agent.")
 
-    return is_anomaly
+# Delivers anomalies to the master agent in the background so an unreachable agent never stalls polling
+dispatcher = AnomalyDispatcher(
+    post_anomalies,
+    queue_size=DISPATCH_QUEUE_SIZE,
+    coalesce_window=DISPATCH_COALESCE_WINDOW,
+    max_batch=DISPATCH_MAX_BATCH,
+    min_interval=DISPATCH_MIN_INTERVAL,
+    dedup_interval=ALERT_DEDUP_INTERVAL,
+)
+register_dispatcher(dispatcher)
 
-def send_to_master_agent(metric_name, metric_value):
-    try:
-        response = requests.post(MASTER_AGENT_URL, json={"metric_name": metric_name, "metric_value": metric_value})
-        response.raise_for_status()
-        print(f"Successfully sent data for {metric_name} to master agent.")
-    except requests.exceptions.RequestException as e:
-        print(f"Exception occurred while sending data to master agent: {e}")
+def send_to_master_agent(series_id, metric_value):
+    """Queue the anomaly for the master agent without waiting for delivery."""
+    dispatcher.dispatch(series_id, {
+        "metric_name": series_index.metric_name(series_id),
+        "labels": series_index.labels(series_id),
+        "metric_value": metric_value,
+    })
 
 if __name__ == "__main__":
     print("Starting Prometheus polling agent...")
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
     fetch_metrics()
\ No newline at end of file
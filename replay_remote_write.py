@@ -0,0 +1,94 @@
+import glob
+import math
+import os
+import random
+import sys
+import time
+import requests
+
+from monitoring.remote_write import encode_write_request
+
+# Replays Prometheus remote write payloads against health_api's /api/v1/write,
+# so push ingestion can be tested without a live Prometheus. Payloads come from
+# the directory given as the first argument (or REMOTE_WRITE_CAPTURE_DIR), as
+# captured by health_api; with none there, synthetic payloads are generated.
+HEALTH_API_URL = "http://localhost:6075"
+CAPTURE_DIR = os.environ.get("REMOTE_WRITE_CAPTURE_DIR", "remote_write_captures")
+REPLAY_INTERVAL = 1  # Seconds between pushes; 0 sends as fast as the receiver accepts them
+REQUEST_TIMEOUT = 60  # Seconds to wait for a push to be ingested
+MAX_RETRIES = 5  # Retries of a push refused with 429 or 5xx, honouring Retry-After like Prometheus
+SYNTHETIC_METRICS = 50  # Metric names in generated payloads
+SYNTHETIC_SERIES = 1000  # Series (label sets) in generated payloads
+SYNTHETIC_PUSHES = 30  # Generated payloads
+SYNTHETIC_SAMPLES = 2  # Samples per series per generated payload
+SYNTHETIC_SCRAPE_INTERVAL = 15  # Seconds between generated samples
+SYNTHETIC_SPIKE_PUSH = 25  # Payload in which 1% of series spike
+
+HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+}
+
+def load_captures(directory):
+    """Captured payloads in the order they were received."""
+    for path in sorted(glob.glob(os.path.join(directory, "*.pb.snappy"))):
+        with open(path, "rb") as f:
+            yield f.read()
+
+def synthetic_payloads():
+    """Payloads of noisy sine waves, with spikes in one push."""
+    labels = [
+        {"__name__": f"replay_metric_{i % SYNTHETIC_METRICS}", "job": "replay", "instance": f"host-{i}"}
+        for i in range(SYNTHETIC_SERIES)
+    ]
+    start = int(time.time() * 1000) - SYNTHETIC_PUSHES * SYNTHETIC_SAMPLES * SYNTHETIC_SCRAPE_INTERVAL * 1000
+    for push in range(SYNTHETIC_PUSHES):
+        series = []
+        for i, series_labels in enumerate(labels):
+            samples = []
+            for sample in range(SYNTHETIC_SAMPLES):
+                step = push * SYNTHETIC_SAMPLES + sample
+                value = 10 + math.sin(step / 10 + i) + random.gauss(0, 0.1)
+                if push == SYNTHETIC_SPIKE_PUSH and i % 100 == 0:
+                    value *= 5
+                samples.append((start + step * SYNTHETIC_SCRAPE_INTERVAL * 1000, value))
+            series.append((series_labels, samples))
+        yield encode_write_request(series)
+
+def push(session, body):
+    """Send one payload, retrying on backpressure; returns the final status code."""
+    for attempt in range(MAX_RETRIES + 1):
+        response = session.post(f"{HEALTH_API_URL}/api/v1/write", data=body, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 429 and response.status_code < 500:
+            return response.status_code
+        delay = float(response.headers.get("Retry-After", 2 ** attempt))
+        print(f"Push refused with {response.status_code}, retrying in {delay}s")
+        time.sleep(delay)
+    return response.status_code
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else CAPTURE_DIR
+    payloads = list(load_captures(directory))
+    if payloads:
+        print(f"Replaying {len(payloads)} captured payloads from {directory}")
+    else:
+        print(f"No captured payloads in {directory}, generating {SYNTHETIC_PUSHES} synthetic payloads")
+        payloads = list(synthetic_payloads())
+
+    statuses = {}
+    total_bytes = 0
+    start = time.perf_counter()
+    with requests.Session() as session:
+        for i, body in enumerate(payloads):
+            status = push(session, body)
+            statuses[status] = statuses.get(status, 0) + 1
+            total_bytes += len(body)
+            print(f"Payload {i + 1}/{len(payloads)}: {len(body)} bytes, status {status}")
+            if REPLAY_INTERVAL and i + 1 < len(payloads):
+                time.sleep(REPLAY_INTERVAL)
+    elapsed = time.perf_counter() - start
+    print(f"Sent {len(payloads)} payloads ({total_bytes} bytes) in {elapsed:.1f}s, statuses: {statuses}")
+
+if __name__ == "__main__":
+    main()
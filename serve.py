@@ -0,0 +1,131 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+from urllib.parse import urlparse
+
+# Production entry point for health_api. One detector process owns polling,
+# scoring and all detection state, and serves the API on DETECTOR_URL, a
+# local port. Gunicorn workers serve the public port: they answer
+# /check_health from the snapshot file the detector writes and forward
+# everything else to the detector. SIGTERM or SIGINT stop the workers
+# gracefully, then the detector, which finishes its cycle and flushes
+# pending work first.
+#
+#   python serve.py             # detector plus WEB_WORKERS gunicorn workers
+#   python serve.py detector    # the detector alone (started by the above)
+HOST = "0.0.0.0"
+API_PORT = int(os.environ.get("API_PORT", "6075"))  # Public port; read here so health_api is only imported in the workers
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", "4"))  # Gunicorn worker processes serving the public port
+WEB_THREADS = int(os.environ.get("WEB_THREADS", "4"))  # Request threads per worker
+GRACEFUL_TIMEOUT = 30  # Seconds workers get to finish in-flight requests on shutdown
+DETECTOR_STOP_TIMEOUT = 60  # Seconds the detector gets to flush before it is killed
+DETECTOR_RESTART_DELAY = 5  # Seconds before restarting a detector that exited unexpectedly
+
+
+def run_detector():
+    """Run detection and the full API on the local detector port until SIGTERM or SIGINT."""
+    from werkzeug.serving import make_server
+    import health_api
+
+    address = urlparse(health_api.DETECTOR_URL)
+    server = make_server(address.hostname, address.port, health_api.app, threaded=True)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever to return, so it cannot run in this (the serving) thread.
+        threading.Thread(target=server.shutdown, name="detector-shutdown").start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    health_api.start_background()
+    print(f"Detector serving on {health_api.DETECTOR_URL}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        health_api.shutdown()
+
+
+class DetectorProcess:
+    """The detector child process, restarted if it exits while the workers are still serving."""
+
+    def __init__(self):
+        self.process = None
+        self._stopping = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, name="detector-watch", daemon=True)
+
+    def _spawn(self):
+        env = dict(os.environ, SERVE_ROLE="detector")
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "detector"], env=env)
+
+    def start(self):
+        self._spawn()
+        self._watcher.start()
+
+    def _watch(self):
+        while not self._stopping.wait(1):
+            status = self.process.poll()
+            if status is not None and not self._stopping.is_set():
+                print(f"Detector exited with status {status}, restarting in {DETECTOR_RESTART_DELAY}s")
+                if not self._stopping.wait(DETECTOR_RESTART_DELAY):
+                    self._spawn()
+
+    def stop(self):
+        self._stopping.set()
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(DETECTOR_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            print(f"Detector did not stop within {DETECTOR_STOP_TIMEOUT}s, killing it")
+            self.process.kill()
+            self.process.wait()
+
+
+def run_workers(port):
+    """Serve the public port with gunicorn, or a single threaded werkzeug server where gunicorn is unavailable."""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print("gunicorn is not installed (or not supported on this platform); serving from one process")
+        from werkzeug.serving import run_simple
+        import health_api
+        run_simple(HOST, port, health_api.app, threaded=True)
+        return
+
+    class WorkerApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{HOST}:{port}")
+            self.cfg.set("workers", WEB_WORKERS)
+            self.cfg.set("threads", WEB_THREADS)
+            self.cfg.set("graceful_timeout", GRACEFUL_TIMEOUT)
+
+        def load(self):
+            # Imported in each worker after the fork, as a worker.
+            import health_api
+            return health_api.app
+
+    WorkerApplication().run()
+
+
+def main():
+    if sys.argv[1:] == ["detector"]:
+        return run_detector()
+
+    os.environ["SERVE_ROLE"] = "worker"
+    detector = DetectorProcess()
+    detector.start()
+    supervisor = os.getpid()
+    try:
+        run_workers(API_PORT)
+    finally:
+        # Gunicorn workers are forked from here and unwind through this block when they exit.
+        if os.getpid() == supervisor:
+            print("Stopping the detector...")
+            detector.stop()
+
+
+if __name__ == "__main__":
+    main()